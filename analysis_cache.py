@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from bgm_cache import hash_file
+
+'''
+Analysis cache:
+loud_level and quiet_level have to be tuned per song, so the same voice-over is often mixed many times with different levels.
+The detection stages do not depend on those levels, so their results are kept on disk between runs:
+the loudness envelope is keyed by the voice-over content and everything that shapes the downsampling windows,
+and the silent intervals are additionally keyed by the binarization settings and silent_interval_tspan_threshold_in_ms.
+Re-tuning the levels or the fades then skips detection entirely, and re-tuning the thresholds only redoes the cheap interval search.
+
+Usage:
+python analysis_cache.py --clear
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+analysis_cache_dir = "analysis_cache"  # Directory of the cached envelopes and silent intervals
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def get_analysis_key(speech_path, downsampling_interval_in_ms, opening_silence, closing_silence, measure_key=None):
+    '''
+    Cache key of the loudness envelope of a voice-over: content hash, downsampling interval and padding silences,
+    and what the envelope measures when it is not the broadband dBFS (see voice_avoidence.get_measure_key)
+    '''
+    analysis_key = f'{hash_file(speech_path)}-{downsampling_interval_in_ms}ms-{opening_silence}s-{closing_silence}s'
+
+    return f'{analysis_key}-{measure_key}' if measure_key else analysis_key
+
+
+def write_atomically(path, write):
+    '''Write a cache file under a temporary name first, so other processes never read half a file'''
+    os.makedirs(analysis_cache_dir, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=analysis_cache_dir, suffix='.tmp')
+    with os.fdopen(file_descriptor, 'wb') as file:
+        write(file)
+    os.replace(temporary_path, path)
+
+
+def load_loudness_envelope(analysis_key):
+    '''Read back a cached loudness envelope, or return None on a cache miss'''
+    try:
+        return np.load(os.path.join(analysis_cache_dir, analysis_key + '.npy'))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def store_loudness_envelope(analysis_key, loudness_envelope):
+    '''Keep a loudness envelope for later runs'''
+    write_atomically(os.path.join(analysis_cache_dir, analysis_key + '.npy'),
+                     lambda file: np.save(file, loudness_envelope))
+
+
+def get_intervals_path(analysis_key, detection_key, silent_interval_tspan_threshold_in_ms):
+    '''Path of the silent intervals found in an envelope with the given binarization settings and threshold'''
+    file_name = f'{analysis_key}-{detection_key}-{silent_interval_tspan_threshold_in_ms}ms.json'
+
+    return os.path.join(analysis_cache_dir, file_name)
+
+
+def load_silent_intervals(analysis_key, detection_key, silent_interval_tspan_threshold_in_ms):
+    '''Read back cached silent intervals as (start_in_ms, end_in_ms) tuples, or return None on a cache miss'''
+    try:
+        with open(get_intervals_path(analysis_key, detection_key, silent_interval_tspan_threshold_in_ms),
+                  encoding='utf-8') as intervals_file:
+            return [tuple(interval) for interval in json.load(intervals_file)]
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def store_silent_intervals(analysis_key, detection_key, silent_interval_tspan_threshold_in_ms, silent_intervals):
+    '''Keep the silent intervals found with the given settings for later runs'''
+    write_atomically(get_intervals_path(analysis_key, detection_key, silent_interval_tspan_threshold_in_ms),
+                     lambda file: file.write(json.dumps(silent_intervals).encode('utf-8')))
+
+
+def clear_analysis_cache():
+    '''Drop every cached envelope and interval list'''
+    shutil.rmtree(analysis_cache_dir, ignore_errors=True)
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    global analysis_cache_dir
+
+    parser = argparse.ArgumentParser(description='Clean the voice-over analysis cache')
+    parser.add_argument('--cache-dir', default=analysis_cache_dir, help='cache directory')
+    parser.add_argument('--clear', action='store_true', required=True, help='drop the whole cache')
+    args = parser.parse_args()
+    analysis_cache_dir = args.cache_dir
+
+    clear_analysis_cache()
+
+
+if __name__ == "__main__":
+    main()
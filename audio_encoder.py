@@ -0,0 +1,115 @@
+import contextlib
+import os
+import subprocess
+import tempfile
+import wave
+
+import numpy as np
+from pydub.exceptions import CouldntEncodeError
+from pydub.utils import get_encoder_name
+
+'''
+Compressed output:
+Exporting a mix as FLAC, Opus or MP3 used to mean writing a full WAV first and transcoding it afterwards.
+open_audio_writer starts the encoder (ffmpeg) before the first frame is rendered and feeds it the PCM through a pipe,
+so the encoder runs in its own process while the next blocks are mixed, and no intermediate WAV is ever written.
+The output format follows the extension of the output path: .flac, .opus or .mp3, and WAV for any other extension, as before.
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+# Output format of every supported extension: ffmpeg codec, container, and whether the codec has a bitrate
+output_formats = {
+    '.flac': ('flac', 'flac', False),
+    '.opus': ('libopus', 'ogg', True),
+    '.mp3': ('libmp3lame', 'mp3', True),
+}
+
+# ffmpeg names of the PCM sample formats, 8-bit samples are kept signed in memory like pydub does
+raw_sample_formats = {1: 's8', 2: 's16le', 4: 's32le'}
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def get_output_format(path):
+    '''Output format of a path from its extension: one of output_formats, or 'wav' '''
+    extension = os.path.splitext(path)[1].lower()
+
+    return extension if extension in output_formats else 'wav'
+
+
+@contextlib.contextmanager
+def open_encoder_pipe(path, frame_rate, channels, sample_width, bitrate=None):
+    '''Start ffmpeg encoding raw PCM from its stdin into path, yield a function writing PCM bytes to it'''
+    codec, container, has_bitrate = output_formats[get_output_format(path)]
+    command = [get_encoder_name(), '-y', '-loglevel', 'error',
+               '-f', raw_sample_formats[sample_width], '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0',
+               '-c:a', codec]
+    if has_bitrate and bitrate:
+        command += ['-b:a', str(bitrate)]
+    command += ['-f', container, path]
+
+    # ffmpeg reports errors on stderr, which goes to a file so that a full stderr pipe can never block the encoder
+    with tempfile.TemporaryFile() as error_log:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=error_log)
+        pipe_broken = False
+        try:
+            yield process.stdin.write
+            process.stdin.close()
+        except BrokenPipeError:
+            # The encoder stopped reading, its own error message is more useful than the broken pipe
+            pipe_broken = True
+        finally:
+            if not process.stdin.closed:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pipe_broken = True
+            return_code = process.wait()
+
+        # Part of the PCM never reached the encoder, so the output is truncated even when ffmpeg exits with 0
+        if pipe_broken or return_code != 0:
+            error_log.seek(0)
+            raise CouldntEncodeError(f'Encoding {path} failed with return code {return_code}'
+                                     f'{" after the encoder stopped reading" if pipe_broken else ""}:\n'
+                                     + error_log.read().decode(errors='replace'))
+
+
+@contextlib.contextmanager
+def open_audio_writer(path, frame_rate, channels, sample_width, bitrate=None):
+    '''Open the output file in the format of its extension, yield a function writing PCM bytes to it'''
+    if get_output_format(path) != 'wav':
+        with open_encoder_pipe(path, frame_rate, channels, sample_width, bitrate) as write:
+            yield write
+        return
+
+    with wave.open(path, 'wb') as output_file:
+        output_file.setnchannels(channels)
+        output_file.setsampwidth(sample_width)
+        output_file.setframerate(frame_rate)
+        if sample_width != 1:
+            yield output_file.writeframes
+            return
+
+        # 8-bit WAV is unsigned, flipping the sign bit adds the offset of 128
+        def write_unsigned(data):
+            output_file.writeframes(np.bitwise_xor(np.frombuffer(data, dtype=np.uint8), 0x80).tobytes())
+        yield write_unsigned
+
+
+def export_audio(audio, path, bitrate=None, frames_per_block=1 << 18):
+    '''Export an AudioSegment in the format of the path extension, feeding the encoder block by block'''
+    if get_output_format(path) == 'wav':
+        audio.export(path, format='wav')
+        return
+
+    raw_data = memoryview(audio.raw_data)
+    block_size = frames_per_block * audio.frame_width
+    with open_encoder_pipe(path, audio.frame_rate, audio.channels, audio.sample_width, bitrate) as write:
+        for first_byte in range(0, len(raw_data), block_size):
+            write(raw_data[first_byte:first_byte + block_size])
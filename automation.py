@@ -0,0 +1,231 @@
+import argparse
+import csv
+import json
+import os
+
+import audio_encoder
+import instrumentation
+import streaming_mix
+import voice_avoidence as va
+
+'''
+Automation-only mode:
+Editors who mix in a DAW or an NLE only need the duck points, not the rendered audio.
+The export command runs the detection stages only (loudness envelope, silent intervals, fade-ins and fade-outs,
+starting volume) and saves the resulting BGM gain automation as JSON, CSV, Audacity labels or an EDL with markers.
+The voice-over is read block by block, so detection stays cheap even for hours of audio.
+The render command does the opposite: it mixes with the automation from a JSON or CSV file, possibly edited by hand,
+and skips the detection entirely.
+All times are on the timeline of the final mix, i.e. they include the opening silence.
+All gains are absolute BGM gains in dB: starting_volume at the start of the mix, and for every fade the gain its ramp
+starts from (from_gain) and the gain it ramps to (to_gain). They are the gains the mix renders where the ramp starts
+and ends, unless the ramp overlaps another one, whose ramp then multiplies in.
+
+Usage:
+python automation.py export [--speech speech.wav] [--output automation.json|.csv|.txt|.edl] [--fps 25]
+python automation.py render automation.json [--speech speech.wav] [--bgm bgm.mp3] [--output final.wav]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+# Export format of every output extension, Audacity labels are plain text files
+automation_formats = {'.json': 'json', '.csv': 'csv', '.txt': 'labels', '.edl': 'edl'}
+csv_columns = ["type", "start_in_ms", "duration_in_ms", "from_gain", "to_gain"]
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def get_absolute_gains(starting_volume, gain_automation):
+    '''
+    Absolute BGM gain in dB at the start of the mix, and the gains every fade ramps from and to, for a gain automation
+    in the compounding semantics of va.render_gain_curve: every fade scales the BGM before it by its from_gain,
+    and the BGM after it by its to_gain
+    '''
+    gain = starting_volume + sum(from_gain for _, _, from_gain, _ in gain_automation)
+    absolute_starting_volume = gain
+
+    ramp_gains = [None] * len(gain_automation)
+    for k in sorted(range(len(gain_automation)), key=lambda k: gain_automation[k][0]):
+        _, _, from_gain, to_gain = gain_automation[k]
+        ramp_gains[k] = (gain, gain - from_gain + to_gain)
+        gain = ramp_gains[k][1]
+
+    return absolute_starting_volume, ramp_gains
+
+
+def get_relative_gain_automation(automation):
+    '''
+    Starting volume and gain automation in the compounding semantics of va.render_gain_curve that render the absolute
+    gains of an automation (see get_absolute_gains): every fade ramps from the gain the previous one ramped to,
+    to its own to_gain, so that from_gain only records the former
+    '''
+    gain = automation["starting_volume"]
+    gain_automation = []
+    for fade in sorted(automation["fades"], key=lambda fade: fade["start_in_ms"]):
+        gain_automation.append((fade["start_in_ms"], fade["duration_in_ms"], 0, fade["to_gain"] - gain))
+        gain = fade["to_gain"]
+
+    return automation["starting_volume"], gain_automation
+
+
+def detect_automation(speech_path):
+    '''Run the detection stages only and return the BGM gain automation of the voice-over as a dict'''
+    try:
+        layout = streaming_mix.get_adjusted_speech_layout(speech_path)
+    except ValueError:
+        # Voice-overs below the frame rate of the padding silences are only handled by the in-memory path
+        layout = None
+
+    if layout is not None:
+        # Stream the voice-over through the detection, the same code path as streaming_mix
+        adjusted_tspan_in_ms = round(1000 * (layout["frame_count"] / layout["frame_rate"]))
+        with instrumentation.measure_stage('detection_pass'):
+            fade_ins, fade_outs = streaming_mix.detect_fades_streaming(speech_path, layout,
+                                                                       streaming_mix.frames_per_block)
+    else:
+        adjusted_speech, adjusted_tspan_in_ms = va.create_adjust_speech_audio(path=speech_path)
+        silent_intervals = va.detect_silent_intervals(adjusted_tspan_in_ms,
+                                                      lambda: va.create_loudness_envelope(adjusted_speech),
+                                                      source_path=speech_path)
+        fade_ins, fade_outs = va.get_fade_ins_and_outs(va.create_silent_interval_dict(silent_intervals))
+
+    # The fades of the mix compound, the exported gains do not
+    gain_automation = va.get_gain_automation(fade_ins, fade_outs)
+    starting_volume, ramp_gains = get_absolute_gains(va.determine_starting_volume(fade_ins, fade_outs), gain_automation)
+    fade_types = ["fade_in"] * len(fade_ins) + ["fade_out"] * len(fade_outs)
+    fades = [{"type": fade_type, "start_in_ms": start, "duration_in_ms": duration, "from_gain": from_gain,
+              "to_gain": to_gain} for fade_type, (start, duration, _, _), (from_gain, to_gain)
+             in zip(fade_types, gain_automation, ramp_gains)]
+
+    return {
+        "speech": os.path.basename(speech_path),
+        "tspan_in_ms": adjusted_tspan_in_ms,
+        "speech_audio_opening_silence": va.speech_audio_opening_silence,
+        "speech_audio_closing_silence": va.speech_audio_closing_silence,
+        "fade_out_tspan_at_the_end": va.fade_out_tspan_at_the_end,
+        "starting_volume": starting_volume,
+        "fades": sorted(fades, key=lambda fade: fade["start_in_ms"]),
+    }
+
+
+def format_timecode(time_in_ms, fps):
+    '''Non-drop-frame SMPTE timecode of a time in milliseconds'''
+    frames = round(time_in_ms * fps / 1000)
+    seconds, frames = divmod(frames, fps)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}:{frames:02d}'
+
+
+def describe_fade(fade):
+    '''Short label of a fade, e.g. "fade_out to -6.8 dB"'''
+    return f'{fade["type"]} to {fade["to_gain"]:+g} dB'
+
+
+def write_automation(automation, output_path, fps=25):
+    '''Save an automation in the format of the output extension: JSON, CSV, Audacity labels (.txt) or EDL'''
+    automation_format = automation_formats.get(os.path.splitext(output_path)[1].lower(), 'json')
+    fades = automation["fades"]
+
+    with open(output_path, 'w', newline='', encoding='utf-8') as output:
+        if automation_format == 'json':
+            json.dump(automation, output, indent=2)
+
+        elif automation_format == 'csv':
+            # The starting volume comes first, as a row of its own
+            writer = csv.DictWriter(output, fieldnames=csv_columns)
+            writer.writeheader()
+            writer.writerow({"type": "start", "start_in_ms": 0, "duration_in_ms": 0,
+                             "from_gain": automation["starting_volume"], "to_gain": automation["starting_volume"]})
+            writer.writerows(fades)
+
+        elif automation_format == 'labels':
+            # Audacity label track: start and end in seconds, then the label, separated by tabs
+            output.write(f'0.000000\t0.000000\tstart at {automation["starting_volume"]:+g} dB\n')
+            for fade in fades:
+                start_in_s = fade["start_in_ms"] / 1000
+                end_in_s = (fade["start_in_ms"] + fade["duration_in_ms"]) / 1000
+                output.write(f'{start_in_s:.6f}\t{end_in_s:.6f}\t{describe_fade(fade)}\n')
+
+        else:
+            # CMX 3600 EDL with one audio event and one marker per fade
+            output.write(f'TITLE: {automation["speech"]} ducking\nFCM: NON-DROP FRAME\n\n')
+            for event_number, fade in enumerate(fades, start=1):
+                record_in = format_timecode(fade["start_in_ms"], fps)
+                record_out = format_timecode(max(fade["start_in_ms"] + fade["duration_in_ms"],
+                                                 fade["start_in_ms"] + 1000 / fps), fps)
+                color = 'GREEN' if fade["type"] == 'fade_in' else 'RED'
+                output.write(f'{event_number:03d}  AX       A     C        '
+                             f'{record_in} {record_out} {record_in} {record_out}\n')
+                output.write(f'* LOC: {record_in} {color} {describe_fade(fade)} over {fade["duration_in_ms"]} ms\n\n')
+
+
+def read_automation(automation_path):
+    '''Read an automation saved as JSON or CSV; a CSV leaves the silences and the ending fade to the settings'''
+    if not automation_path.lower().endswith('.csv'):
+        with open(automation_path, encoding='utf-8') as automation_file:
+            return json.load(automation_file)
+
+    with open(automation_path, newline='', encoding='utf-8') as automation_file:
+        rows = list(csv.DictReader(automation_file))
+    starting_volume = next((float(row["from_gain"]) for row in rows if row["type"] == 'start'), va.quiet_level)
+    fades = [{"type": row["type"], "start_in_ms": float(row["start_in_ms"]),
+              "duration_in_ms": float(row["duration_in_ms"]),
+              "from_gain": float(row["from_gain"]), "to_gain": float(row["to_gain"])}
+             for row in rows if row["type"] != 'start']
+
+    return {"starting_volume": starting_volume, "fades": fades}
+
+
+def render_automation(automation, bgm_path, config=None):
+    '''Mix the voice-over at va.speech_path with the BGM following a given automation, without any detection'''
+    # The silences and the ending fade the automation was made with, when it recorded them
+    settings = {name: automation[name] for name in ("speech_audio_opening_silence", "speech_audio_closing_silence",
+                                                     "fade_out_tspan_at_the_end") if name in automation}
+    config = va.get_mix_config(**settings) if config is None else config
+
+    adjusted_speech, adjusted_tspan_in_ms = va.create_adjust_speech_audio(config)
+    if "tspan_in_ms" in automation and automation["tspan_in_ms"] != adjusted_tspan_in_ms:
+        raise ValueError(f'The automation was made for a mix of {automation["tspan_in_ms"]} ms, '
+                         f'this voice-over gives {adjusted_tspan_in_ms} ms')
+
+    starting_volume, gain_automation = get_relative_gain_automation(automation)
+    return va.overlay_ducked_bgm(adjusted_speech, va.load_bgm_audio(bgm_path), starting_volume,
+                                 gain_automation, config, fade_out_at_end=True)
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the BGM ducking automation, or mix with a given one')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='detect the duck points and save them, without mixing')
+    export_parser.add_argument('--speech', default=va.speech_path, help='voice-over WAV file')
+    export_parser.add_argument('--output', default='automation.json', help='.json, .csv, .txt (Audacity labels) or .edl')
+    export_parser.add_argument('--fps', type=int, default=25, help='frame rate of the EDL timecodes')
+    render_parser = commands.add_parser('render', help='mix with the automation of a JSON or CSV file')
+    render_parser.add_argument('automation', help='automation file written by the export command')
+    render_parser.add_argument('--speech', default=va.speech_path, help='voice-over WAV file')
+    render_parser.add_argument('--bgm', default=va.bgm_path, help='BGM file')
+    render_parser.add_argument('--output', default=va.final_path, help='output path, its extension sets the format')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        write_automation(detect_automation(args.speech), args.output, args.fps)
+    else:
+        va.speech_path = args.speech
+        final_audio = render_automation(read_automation(args.automation), args.bgm)
+        audio_encoder.export_audio(final_audio, args.output, va.final_bitrate)
+
+
+if __name__ == "__main__":
+    main()
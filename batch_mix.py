@@ -0,0 +1,207 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import time
+import traceback
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from pydub import AudioSegment
+
+import format_normalizer
+import streaming_mix
+import voice_avoidence as va
+
+'''
+Batch mode:
+Mix many voice-over files against a handful of BGMs in parallel, one worker process per CPU core.
+The jobs come from a CSV manifest with the columns speech, bgm and output, one job per row.
+Every distinct BGM is decoded only once, in the main process, converted once to every format it is mixed in
+(see va.normalize_bgm), and its PCM is placed in shared memory, so the workers read it directly instead of running ffmpeg
+again, converting it again or receiving a pickled copy.
+A failed job is reported together with its error and does not stop the rest of the batch.
+
+Usage:
+python batch_mix.py manifest.csv [--workers N] [--report report.json]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+# Decoded BGMs attached in each worker process, keyed by BGM path and voice-over path
+shared_bgms = {}
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def read_manifest(manifest_path):
+    '''Read the jobs of a batch from a CSV manifest with the columns speech, bgm and output'''
+    with open(manifest_path, newline='', encoding='utf-8') as manifest:
+        jobs = [{"speech": row["speech"], "bgm": row["bgm"], "output": row["output"]} for row in csv.DictReader(manifest)]
+
+    return jobs
+
+
+def get_mix_format(speech_path, bgm):
+    '''
+    Format of the mix of a voice-over with the BGM, worked out from the header of the voice-over (see va.get_mix_format),
+    or None when it cannot be read, in which case the job converts the BGM itself
+    '''
+    try:
+        layout = streaming_mix.get_adjusted_speech_layout(speech_path)
+    except (OSError, EOFError, ValueError, wave.Error):
+        return None
+
+    # An empty voice-over in the format of the adjusted one stands for it
+    speech = AudioSegment(data=b'', sample_width=layout["sample_width"], frame_rate=layout["frame_rate"],
+                          channels=layout["channels"])
+    return va.get_mix_format([speech, bgm])
+
+
+def share_bgm(bgm_path, speech_paths):
+    '''
+    Decode a BGM once (or map it from the decoded BGM cache), convert it once to every format the voice-overs mix it in,
+    and copy every version of its PCM into a new shared memory block
+    Returns the blocks, and the descriptor of the version each voice-over is mixed with
+    '''
+    bgm = va.load_bgm_audio(bgm_path)
+    shared_blocks, versions, descriptors = [], {}, {}
+    try:
+        for speech_path in speech_paths:
+            mix_format = get_mix_format(speech_path, bgm)
+            # Voice-overs whose format is unknown get the BGM as decoded, like those it needs no conversion for
+            bgm_format = va.get_track_format(bgm, mix_format) if mix_format else format_normalizer.get_audio_format(bgm)
+            if bgm_format not in versions:
+                version = bgm if mix_format is None else va.normalize_bgm(bgm, bgm_path, mix_format)
+                shared_block = shared_memory.SharedMemory(create=True, size=max(len(version.raw_data), 1))
+                shared_blocks.append(shared_block)
+                shared_block.buf[:len(version.raw_data)] = version.raw_data
+
+                # Everything a worker needs to attach to the block and rebuild the AudioSegment without copying it
+                versions[bgm_format] = {
+                    "name": shared_block.name,
+                    "size": len(version.raw_data),
+                    "sample_width": version.sample_width,
+                    "frame_rate": version.frame_rate,
+                    "channels": version.channels,
+                }
+            descriptors[speech_path] = versions[bgm_format]
+    except Exception:
+        for shared_block in shared_blocks:
+            shared_block.close()
+            shared_block.unlink()
+        raise
+
+    return shared_blocks, descriptors
+
+
+def attach_shared_bgms(descriptors):
+    '''
+    Worker initializer: attach every shared BGM as an AudioSegment backed directly by the shared memory
+    descriptors are keyed by (BGM path, voice-over path), the voice-overs mixed in the same format share one block
+    '''
+    attached_bgms = {}
+    for key, descriptor in descriptors.items():
+        if descriptor["name"] not in attached_bgms:
+            shared_block = shared_memory.SharedMemory(name=descriptor["name"])
+            bgm = AudioSegment(data=shared_block.buf[:descriptor["size"]], sample_width=descriptor["sample_width"],
+                               frame_rate=descriptor["frame_rate"], channels=descriptor["channels"])
+            attached_bgms[descriptor["name"]] = (shared_block, bgm)
+        # Keep the block open for the lifetime of the worker, the main process unlinks it when the batch is over
+        shared_bgms[key] = attached_bgms[descriptor["name"]]
+
+
+def run_batch_job(job):
+    '''Run one final_mix job in a worker process and report how it went instead of raising'''
+    start_time = time.perf_counter()
+    try:
+        # A worker runs one job at a time, so the module-level paths can be pointed at the current job
+        va.speech_path = job["speech"]
+        va.final_path = job["output"]
+
+        # Anything the workers print would only interleave, so it is dropped;
+        # the BGM is already in the format of the mix, so final_mix uses it as is
+        with contextlib.redirect_stdout(io.StringIO()):
+            va.final_mix(shared_bgms[job["bgm"], job["speech"]][1])
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return dict(job, ok=error is None, seconds=time.perf_counter() - start_time, error=error)
+
+
+def batch_mix(jobs, max_workers=None):
+    '''Run all jobs on a process pool, sharing each decoded BGM between the workers, and return one result per job'''
+    results = []
+    shared_blocks = []
+    descriptors = {}
+    try:
+        # Decode and convert every distinct BGM once, a BGM that cannot be decoded only fails its own jobs
+        for bgm_path in dict.fromkeys(job["bgm"] for job in jobs):
+            start_time = time.perf_counter()
+            speech_paths = list(dict.fromkeys(job["speech"] for job in jobs if job["bgm"] == bgm_path))
+            try:
+                bgm_blocks, bgm_descriptors = share_bgm(bgm_path, speech_paths)
+                shared_blocks += bgm_blocks
+                descriptors.update(((bgm_path, speech_path), descriptor)
+                                   for speech_path, descriptor in bgm_descriptors.items())
+                print(f'Decoded {bgm_path} in {len(bgm_blocks)} format(s) in {time.perf_counter() - start_time:.2f} s')
+            except Exception:
+                error = traceback.format_exc()
+                results += [dict(job, ok=False, seconds=0.0, error=error) for job in jobs if job["bgm"] == bgm_path]
+
+        runnable_jobs = [job for job in jobs if (job["bgm"], job["speech"]) in descriptors]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared_bgms,
+                                 initargs=(descriptors,)) as executor:
+            futures = [executor.submit(run_batch_job, job) for job in runnable_jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                status = 'ok' if result["ok"] else 'FAILED'
+                print(f'{status:6} {result["seconds"]:8.2f} s  {result["speech"]} -> {result["output"]}')
+                results.append(result)
+    finally:
+        for shared_block in shared_blocks:
+            shared_block.close()
+            shared_block.unlink()
+
+    return results
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mix many voice-over files against shared BGMs in parallel')
+    parser.add_argument('manifest', help='CSV file with the columns speech, bgm and output')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--report', help='write the per-job results to this JSON file')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    results = batch_mix(read_manifest(args.manifest), args.workers)
+    failures = [result for result in results if not result["ok"]]
+
+    for result in failures:
+        print(f'\n{result["speech"]} -> {result["output"]} failed:\n{result["error"]}')
+    print(f'Batch finished in {time.perf_counter() - start_time:.2f} s: '
+          f'{len(results) - len(failures)} succeeded, {len(failures)} failed')
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report:
+            json.dump(results, report, indent=2)
+
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
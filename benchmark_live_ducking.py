@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+import synthetic_audio
+import voice_avoidence as va
+
+'''
+Latency and jitter benchmark of the live mode:
+Synthesizes a voice-over and a BGM as WAV files (or takes the given ones), then plays them in real time into live_ducking.py
+through its stdin, one downsampling window at a time, and timestamps every mixed window that comes back on stdout.
+The latency of a window is the time from the capture of its first frame, one window before it is written to the pipe,
+to the moment it is read back mixed; the jitter is the spread of that latency.
+
+Usage:
+python benchmark_live_ducking.py [--seconds 60] [--lookahead-ms 20] [--speech speech.wav --bgm bgm.wav] [--report report.json]
+'''
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def read_wav_samples(path):
+    '''Read a 16-bit WAV file as a (frames, channels) array and its frame rate'''
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f'{path}: the live mode takes 16-bit PCM only')
+        frame_rate, channels = wav.getframerate(), wav.getnchannels()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16).reshape(-1, channels)
+
+    return samples, frame_rate
+
+
+def measure_latencies(speech, bgm, frame_rate, lookahead_in_ms):
+    '''Feed speech and BGM into live_ducking.py at real-time pace and return the latency of every window in ms'''
+    window_frames = va.downsampling_interval_in_ms * frame_rate // 1000
+    window_in_s = window_frames / frame_rate
+    frame_count = min(len(speech), len(bgm))
+    window_count = frame_count // window_frames
+    frames = np.concatenate([speech[:frame_count], bgm[:frame_count]], axis=1)
+    output_window_size = window_frames * 2 * max(speech.shape[1], bgm.shape[1])
+
+    live_ducking_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'live_ducking.py')
+    command = [sys.executable, live_ducking_path, '--speech-channels', str(speech.shape[1]),
+               '--bgm-channels', str(bgm.shape[1]), '--frame-rate', str(frame_rate), '--lookahead-ms', str(lookahead_in_ms)]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    # Give the interpreter time to start, so the start-up does not count as latency
+    time.sleep(1.0)
+    start_time = time.perf_counter()
+
+    def feed():
+        # Window i is complete, and can be written, when its last frame has been captured
+        for i in range(window_count):
+            time.sleep(max(start_time + (i + 1) * window_in_s - time.perf_counter(), 0))
+            process.stdin.write(frames[i * window_frames:(i + 1) * window_frames].tobytes())
+        process.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    arrival_times = []
+    for _ in range(window_count):
+        data = bytearray()
+        while len(data) < output_window_size:
+            chunk = process.stdout.read(output_window_size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        if len(data) < output_window_size:
+            break
+        arrival_times.append(time.perf_counter())
+
+    feeder.join()
+    process.wait()
+
+    # The first frame of window i is captured at start_time + i * window_in_s
+    capture_times = start_time + np.arange(len(arrival_times)) * window_in_s
+
+    return (np.array(arrival_times) - capture_times) * 1000
+
+
+def summarize_latencies(latencies_in_ms):
+    '''Latency percentiles and jitter of a run'''
+    return {
+        "windows": len(latencies_in_ms),
+        "mean_ms": float(np.mean(latencies_in_ms)),
+        "p50_ms": float(np.percentile(latencies_in_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_in_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_in_ms, 99)),
+        "max_ms": float(np.max(latencies_in_ms)),
+        "jitter_ms": float(np.std(latencies_in_ms)),
+    }
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the latency and jitter of live_ducking.py')
+    parser.add_argument('--seconds', type=float, default=60, help='length of the synthetic input')
+    parser.add_argument('--frame-rate', type=int, default=48000, help='frame rate of the synthetic input')
+    parser.add_argument('--lookahead-ms', type=int, default=20, help='lookahead of the live mode')
+    parser.add_argument('--speech', help='16-bit WAV voice-over to play instead of the synthetic one')
+    parser.add_argument('--bgm', help='16-bit WAV BGM to play instead of the synthetic one')
+    parser.add_argument('--report', help='write the summary to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        speech_path, bgm_path = args.speech, args.bgm
+        if speech_path is None:
+            speech_path = os.path.join(temporary_dir, 'speech.wav')
+            synthetic_audio.write_wav(speech_path, synthetic_audio.synthesize_speech(args.seconds, args.frame_rate),
+                                      args.frame_rate)
+        if bgm_path is None:
+            bgm_path = os.path.join(temporary_dir, 'bgm.wav')
+            synthetic_audio.write_wav(bgm_path, synthetic_audio.synthesize_bgm(args.seconds, args.frame_rate),
+                                      args.frame_rate)
+        speech, frame_rate = read_wav_samples(speech_path)
+        bgm, bgm_frame_rate = read_wav_samples(bgm_path)
+    if bgm_frame_rate != frame_rate:
+        raise SystemExit('speech and BGM must have the same frame rate')
+
+    summary = summarize_latencies(measure_latencies(speech, bgm, frame_rate, args.lookahead_ms))
+    summary.update(frame_rate=frame_rate, lookahead_ms=args.lookahead_ms)
+    print(f'{summary["windows"]} windows at {frame_rate} Hz, lookahead {args.lookahead_ms} ms')
+    print(f'latency: mean {summary["mean_ms"]:.1f} ms, p50 {summary["p50_ms"]:.1f} ms, p95 {summary["p95_ms"]:.1f} ms, '
+          f'p99 {summary["p99_ms"]:.1f} ms, max {summary["max_ms"]:.1f} ms')
+    print(f'jitter: {summary["jitter_ms"]:.2f} ms')
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report:
+            json.dump(summary, report, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import mix_client
+import mix_daemon
+import synthetic_audio
+
+'''
+Load test of the daemon mode:
+Synthesizes voice-overs and a few BGMs as WAV files (or takes the given ones), then submits jobs to mix_daemon.py from
+several client threads at once, each waiting for its job to finish before submitting the next one.
+The latency of a job is the time from its submission to the end of its wait, as the client sees it; the throughput is the
+number of jobs over the length of the whole run. The statistics of the daemon itself are reported next to them,
+and the same mix is also run a few times as cold voice_avoidence.py processes, for the start-up cost the daemon saves.
+Without --port or --socket, a daemon is started in this process on a free port.
+
+Usage:
+python benchmark_mix_daemon.py [--jobs 40] [--clients 4] [--workers 2] [--seconds 30] [--port 8765] [--report report.json]
+'''
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def run_clients(jobs, client_count, output_dir, port=None, socket_path=None):
+    '''Submit the jobs from client_count threads, each waiting for its job before the next one; returns the latencies'''
+    latencies, failures = [], []
+    next_job = iter(enumerate(jobs))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                index, (speech_path, bgm_path) = next(next_job, (None, (None, None)))
+            if index is None:
+                return
+            start_time = time.perf_counter()
+            output_path = os.path.join(output_dir, f'final_{index}.wav')
+            status, job = mix_client.submit_job(speech_path, bgm_path, output_path, port=port, socket_path=socket_path)
+            # A full queue is retried, so that the run measures the jobs rather than the rejections
+            while status == 503:
+                time.sleep(0.05)
+                status, job = mix_client.submit_job(speech_path, bgm_path, output_path, port=port, socket_path=socket_path)
+            if status == 202:
+                status, job = mix_client.wait_for_job(job["id"], port, socket_path)
+            with lock:
+                if status == 200 and job["status"] == 'done':
+                    latencies.append(time.perf_counter() - start_time)
+                else:
+                    failures.append(job)
+
+    threads = [threading.Thread(target=client) for _ in range(client_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, failures
+
+
+def run_cold_mix(speech_path, bgm_path, output_path):
+    '''Time one mix as a new voice_avoidence.py process, the way a job runs without the daemon'''
+    script = 'import sys, voice_avoidence as va; va.speech_path, va.bgm_path, va.final_path = sys.argv[1:]; va.main()'
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, '-c', script, speech_path, bgm_path, output_path], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    return time.perf_counter() - start_time
+
+
+def summarize_latencies(latencies_in_s):
+    '''Latency percentiles of a run, in seconds'''
+    return {
+        "jobs": len(latencies_in_s),
+        "mean_s": float(np.mean(latencies_in_s)),
+        "p50_s": float(np.percentile(latencies_in_s, 50)),
+        "p95_s": float(np.percentile(latencies_in_s, 95)),
+        "p99_s": float(np.percentile(latencies_in_s, 99)),
+        "max_s": float(np.max(latencies_in_s)),
+    }
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test mix_daemon.py')
+    parser.add_argument('--jobs', type=int, default=40, help='jobs to submit')
+    parser.add_argument('--clients', type=int, default=4, help='clients submitting jobs at the same time')
+    parser.add_argument('--workers', type=int, default=mix_daemon.daemon_workers,
+                        help='workers of the daemon started by the benchmark')
+    parser.add_argument('--seconds', type=float, default=30, help='length of the synthetic voice-overs')
+    parser.add_argument('--frame-rate', type=int, default=44100, help='frame rate of the synthetic input')
+    parser.add_argument('--voice-overs', type=int, default=4, help='distinct synthetic voice-overs')
+    parser.add_argument('--bgms', type=int, default=2, help='distinct synthetic BGMs')
+    parser.add_argument('--speech', help='voice-over to mix instead of the synthetic ones')
+    parser.add_argument('--bgm', help='BGM to mix instead of the synthetic ones')
+    parser.add_argument('--cold-runs', type=int, default=3, help='cold voice_avoidence.py runs to compare with, 0 to skip')
+    parser.add_argument('--port', type=int, help='local port of a running daemon to test, instead of starting one')
+    parser.add_argument('--socket', help='Unix socket of a running daemon to test, instead of starting one')
+    parser.add_argument('--report', help='write the summary to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        # The daemon opens the paths itself, so they must not depend on its working directory
+        speech_paths = [os.path.abspath(args.speech)] if args.speech else []
+        bgm_paths = [os.path.abspath(args.bgm)] if args.bgm else []
+        for i in range(0 if args.speech else args.voice_overs):
+            speech_paths.append(os.path.join(temporary_dir, f'speech_{i}.wav'))
+            synthetic_audio.write_wav(speech_paths[-1], synthetic_audio.synthesize_speech(args.seconds, args.frame_rate,
+                                                                                          seed=i), args.frame_rate)
+        for i in range(0 if args.bgm else args.bgms):
+            # The BGM covers the opening and closing silences of the mix
+            bgm_paths.append(os.path.join(temporary_dir, f'bgm_{i}.wav'))
+            synthetic_audio.write_wav(bgm_paths[-1], synthetic_audio.synthesize_bgm(args.seconds + 10, args.frame_rate,
+                                                                                    seed=i), args.frame_rate)
+        jobs = [(speech_paths[i % len(speech_paths)], bgm_paths[i % len(bgm_paths)]) for i in range(args.jobs)]
+
+        server = None
+        port, socket_path = args.port, args.socket
+        if port is None and socket_path is None:
+            server = mix_daemon.create_server(mix_daemon.MixDaemon(args.workers), port=0)
+            port = server.server_address[1]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        start_time = time.perf_counter()
+        latencies, failures = run_clients(jobs, args.clients, temporary_dir, port, socket_path)
+        elapsed_in_s = time.perf_counter() - start_time
+        _, daemon_stats = mix_client.get_stats(port, socket_path)
+
+        cold_latencies = [run_cold_mix(speech_path, bgm_path, os.path.join(temporary_dir, 'cold.wav'))
+                          for speech_path, bgm_path in jobs[:args.cold_runs]]
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    if not latencies:
+        raise SystemExit(f'every job failed, the first one with:\n{failures[0].get("error") if failures else None}')
+
+    summary = summarize_latencies(latencies)
+    summary.update(failed=len(failures), clients=args.clients, elapsed_s=elapsed_in_s,
+                   throughput_jobs_per_second=len(latencies) / elapsed_in_s, daemon=daemon_stats)
+    print(f'{summary["jobs"]} jobs from {args.clients} clients in {elapsed_in_s:.2f} s, {len(failures)} failed, '
+          f'{summary["throughput_jobs_per_second"]:.2f} jobs/s')
+    print(f'latency: mean {summary["mean_s"]:.2f} s, p50 {summary["p50_s"]:.2f} s, p95 {summary["p95_s"]:.2f} s, '
+          f'p99 {summary["p99_s"]:.2f} s, max {summary["max_s"]:.2f} s')
+    print(f'daemon: {daemon_stats["workers"]} workers, {daemon_stats["cached_bgms"]} cached BGMs, '
+          f'mean queue time {daemon_stats["queue_seconds"]["mean"]:.2f} s, '
+          f'mean run time {daemon_stats["run_seconds"]["mean"]:.2f} s')
+    if cold_latencies:
+        summary["cold_mean_s"] = float(np.mean(cold_latencies))
+        print(f'cold voice_avoidence.py run: mean {summary["cold_mean_s"]:.2f} s over {len(cold_latencies)} runs')
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report:
+            json.dump(summary, report, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import synthetic_audio
+import voice_avoidence as va
+
+'''
+Scaling benchmark of the multi-process loudness envelope:
+Synthesizes a long stereo voice-over in memory, computes its loudness envelope with 1, 2, 4 and 8 worker processes,
+checks that every result is bit-identical to the single-process one and reports the speedup of every worker count.
+The pool start-up and the copy into shared memory are part of the measured time, as they are in final_mix.
+
+Usage:
+python benchmark_parallel_envelope.py [--minutes 600] [--workers 1 2 4 8] [--repeats 3] [--output scaling.json]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+benchmark_frame_rate = 44100  # Frame rate of the synthetic voice-over
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def synthesize_benchmark_samples(minutes):
+    '''Synthesize a stereo voice-over of the given length as a (frames, 2) int16 array'''
+    speech = np.concatenate(list(synthetic_audio.synthesize_speech(minutes * 60, benchmark_frame_rate)))
+
+    return np.repeat(speech.reshape(-1, 1), 2, axis=1)
+
+
+def measure_envelope_scaling(samples, worker_counts, repeats):
+    '''Best wall time of the envelope for every worker count, after checking it against the single-process result'''
+    tspan_in_ms = round(1000 * (len(samples) / benchmark_frame_rate))
+    reference = va.compute_window_dbfs(samples, benchmark_frame_rate, tspan_in_ms, va.downsampling_interval_in_ms)
+    timings = {}
+
+    for workers in worker_counts:
+        seconds = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            loudness_envelope = va.compute_window_dbfs_parallel(samples, benchmark_frame_rate, tspan_in_ms,
+                                                                va.downsampling_interval_in_ms, workers)
+            seconds.append(time.perf_counter() - start_time)
+            if loudness_envelope.tobytes() != reference.tobytes():
+                raise AssertionError(f'The envelope computed by {workers} workers differs from the single-process one')
+        timings[workers] = min(seconds)
+
+    return timings
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the speedup of the multi-process loudness envelope')
+    parser.add_argument('--minutes', type=float, default=600, help='length of the synthetic voice-over')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker counts to measure')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per worker count, the fastest one is kept')
+    parser.add_argument('--output', help='JSON file the results are saved to')
+    args = parser.parse_args()
+
+    samples = synthesize_benchmark_samples(args.minutes)
+    timings = measure_envelope_scaling(samples, args.workers, args.repeats)
+
+    baseline_seconds = timings[args.workers[0]]
+    print(f'{args.minutes:g} min of stereo audio, {os.cpu_count()} CPUs, results bit-identical')
+    for workers, seconds in timings.items():
+        print(f'    {workers:2d} workers  {seconds:8.3f} s  {baseline_seconds / seconds:5.2f}x')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({"minutes": args.minutes, "cpu_count": os.cpu_count(),
+                       "seconds": {str(workers): seconds for workers, seconds in timings.items()}}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import synthetic_audio
+import voice_avoidence as va
+
+'''
+Benchmark of every stage of final_mix:
+Synthesizes voice-overs (speech-like bursts with pauses) and a BGM offline, for several durations and pause densities,
+then runs the stages of final_mix one by one and records the wall time and the peak RSS of each stage.
+create_downsampling_dict and record_silent_interval are measured through the functions that replaced them,
+create_loudness_envelope and find_silent_intervals.
+Every case runs in a fresh process, so the memory of one case does not hide the peak of the next one.
+The results are saved as JSON; comparing them with an earlier run flags the stages that became slower.
+The peak RSS of a stage is exact on Linux; elsewhere it is the peak of the whole process so far, or null if unknown.
+
+Usage:
+python benchmark_stages.py [--minutes 1 10 60 180] [--pauses-per-minute 5 15 30] [--output results.json]
+python benchmark_stages.py --compare baseline.json results.json
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+benchmark_frame_rate = 44100  # Frame rate of the synthetic audio
+benchmark_audio_dir = "benchmark_audio"  # Directory of the synthetic audio, kept so that later runs skip the synthesis
+regression_tolerance = 1.2  # A stage that takes longer than this many times its baseline time is reported as a regression
+regression_min_seconds = 0.05  # Smaller slowdowns are timing noise and never reported
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def get_benchmark_audio(minutes, pauses_per_minute, audio_dir):
+    '''Synthesize the voice-over of a case and the shared BGM, unless an earlier run already did'''
+    os.makedirs(audio_dir, exist_ok=True)
+    speech_path = os.path.join(audio_dir, f'speech-{minutes:g}min-{pauses_per_minute:g}ppm.wav')
+    bgm_path = os.path.join(audio_dir, f'bgm-{minutes:g}min.wav')
+
+    if not os.path.exists(speech_path):
+        synthetic_audio.write_wav(speech_path + '.tmp', synthetic_audio.synthesize_speech(
+            minutes * 60, benchmark_frame_rate, pauses_per_minute), benchmark_frame_rate)
+        os.replace(speech_path + '.tmp', speech_path)
+
+    # The BGM covers the padding silences as well, like a BGM chosen for the voice-over would
+    if not os.path.exists(bgm_path):
+        bgm_tspan_in_s = minutes * 60 + va.speech_audio_opening_silence + va.speech_audio_closing_silence
+        synthetic_audio.write_wav(bgm_path + '.tmp', synthetic_audio.synthesize_bgm(
+            bgm_tspan_in_s, benchmark_frame_rate), benchmark_frame_rate)
+        os.replace(bgm_path + '.tmp', bgm_path)
+
+    return speech_path, bgm_path
+
+
+def reset_peak_rss():
+    '''Restart the peak RSS count of the process, only possible on Linux'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def read_peak_rss_in_mb():
+    '''Peak RSS of the process since the last reset_peak_rss on Linux, since its start elsewhere, None if unknown'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def run_benchmark_case(minutes, pauses_per_minute, audio_dir):
+    '''Run the stages of final_mix on one synthetic case and return the wall time and peak RSS of every stage'''
+    speech_path, bgm_path = get_benchmark_audio(minutes, pauses_per_minute, audio_dir)
+    va.speech_path = speech_path
+    va.final_path = os.path.join(audio_dir, f'final-{minutes:g}min-{pauses_per_minute:g}ppm.wav')
+    stages = {}
+
+    def run_stage(stage_name, stage_function):
+        reset_peak_rss()
+        start_time = time.perf_counter()
+        # Anything a stage prints would only clutter the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = stage_function()
+        stages[stage_name] = {"seconds": time.perf_counter() - start_time, "peak_rss_mb": read_peak_rss_in_mb()}
+        return result
+
+    # Same steps as final_mix, one stage at a time
+    adjusted_speech, adjusted_tspan_in_ms = run_stage('create_adjust_speech_audio', va.create_adjust_speech_audio)
+    loudness_envelope = run_stage('create_loudness_envelope', lambda: va.create_loudness_envelope(adjusted_speech))
+    silent_intervals = run_stage('find_silent_intervals', lambda: va.find_silent_intervals(
+        va.binarize_loudness_envelope(loudness_envelope), adjusted_tspan_in_ms))
+    fade_ins, fade_outs = run_stage('get_fade_ins_and_outs', lambda: va.get_fade_ins_and_outs(
+        va.create_silent_interval_dict(silent_intervals)))
+    bgm = run_stage('load_bgm_audio', lambda: va.load_bgm_audio(bgm_path))
+    speech_bgm_mix = run_stage('mix_speech_with_bgm', lambda: va.mix_speech_with_bgm(
+        adjusted_speech, bgm, fade_ins, fade_outs))
+    final_audio = run_stage('fade_out_at_the_end', lambda: va.fade_out_at_the_end(speech_bgm_mix))
+    run_stage('export', lambda: final_audio.export(va.final_path, format='wav'))
+    os.remove(va.final_path)
+
+    return {
+        "minutes": minutes,
+        "pauses_per_minute": pauses_per_minute,
+        "silent_intervals": len(silent_intervals),
+        "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+
+def compare_benchmark_results(baseline, results):
+    '''List the (minutes, pauses_per_minute, stage, baseline_seconds, seconds) of the stages that became slower'''
+    baseline_cases = {(case["minutes"], case["pauses_per_minute"]): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        baseline_case = baseline_cases.get((case["minutes"], case["pauses_per_minute"]))
+        if baseline_case is None:
+            continue
+        for stage_name, stage in case["stages"].items():
+            baseline_seconds = baseline_case["stages"].get(stage_name, {}).get("seconds")
+            if baseline_seconds is None or stage["seconds"] - baseline_seconds < regression_min_seconds:
+                continue
+            if stage["seconds"] > baseline_seconds * regression_tolerance:
+                regressions.append((case["minutes"], case["pauses_per_minute"], stage_name, baseline_seconds,
+                                    stage["seconds"]))
+
+    return regressions
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the wall time and peak RSS of every stage of final_mix')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10, 60, 180], help='voice-over durations')
+    parser.add_argument('--pauses-per-minute', type=float, nargs='+', default=[5, 15, 30], help='pause densities')
+    parser.add_argument('--audio-dir', default=benchmark_audio_dir, help='directory of the synthetic audio')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are saved to')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'), help='compare two saved runs')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as baseline_file, \
+                open(args.compare[1], encoding='utf-8') as results_file:
+            regressions = compare_benchmark_results(json.load(baseline_file), json.load(results_file))
+        for minutes, pauses_per_minute, stage_name, baseline_seconds, seconds in regressions:
+            print(f'{minutes:g} min, {pauses_per_minute:g} pauses/min, {stage_name}: '
+                  f'{baseline_seconds:.2f} s -> {seconds:.2f} s')
+        print(f'{len(regressions)} regressions')
+        raise SystemExit(1 if regressions else 0)
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "frame_rate": benchmark_frame_rate,
+        "cases": [],
+    }
+    for minutes in args.minutes:
+        for pauses_per_minute in args.pauses_per_minute:
+            # A fresh process per case, so each case starts with an empty heap
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                case = executor.submit(run_benchmark_case, minutes, pauses_per_minute, args.audio_dir).result()
+            results["cases"].append(case)
+
+            print(f'{minutes:g} min, {pauses_per_minute:g} pauses/min: {case["silent_intervals"]} silent intervals, '
+                  f'{case["total_seconds"]:.2f} s')
+            for stage_name, stage in case["stages"].items():
+                peak_rss = f'{stage["peak_rss_mb"]:9.1f} MiB' if stage["peak_rss_mb"] is not None else '        n/a'
+                print(f'    {stage_name:28} {stage["seconds"]:8.2f} s  {peak_rss}')
+
+            # Save after every case, so an interrupted run keeps what it measured
+            with open(args.output, 'w', encoding='utf-8') as output:
+                json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import synthetic_audio
+import voice_avoidence as va
+
+'''
+Benchmark of the voice-band loudness measure:
+Synthesizes a long voice-over in memory and computes its loudness envelope with the broadband dBFS and with the voice-band
+measure (see compute_voice_band_dbfs), and reports the time of both and how much slower the voice band is.
+The same voice-over is then mixed with a low-frequency rumble, as left by an air conditioner or a handled microphone,
+and the silent intervals found in it by either measure are compared with those of the clean voice-over.
+
+Usage:
+python benchmark_voice_band.py [--minutes 60] [--rumble-dbfs -12] [--repeats 3] [--output voice_band.json]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+benchmark_frame_rate = 44100  # Frame rate of the synthetic voice-over
+rumble_in_hz = 45  # Frequency of the synthetic rumble, well below the speech band
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def add_rumble(samples, rumble_dbfs):
+    '''The voice-over with a sine rumble of the given RMS loudness added to it'''
+    amplitude = np.sqrt(2) * 32767 * 10 ** (rumble_dbfs / 20)
+    rumble = amplitude * np.sin(2 * np.pi * rumble_in_hz * np.arange(len(samples)) / benchmark_frame_rate)
+
+    return np.clip(samples + rumble.reshape(-1, 1), -32768, 32767).astype(np.int16)
+
+
+def measure_envelope(samples, config, repeats):
+    '''Fastest wall time of the loudness envelope over some runs, with the envelope'''
+    tspan_in_ms = round(1000 * (len(samples) / benchmark_frame_rate))
+    seconds = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        loudness_envelope = va.compute_window_dbfs(samples, benchmark_frame_rate, tspan_in_ms,
+                                                   config.downsampling_interval_in_ms)
+        if va.get_measure_key(config):
+            loudness_envelope = va.compute_voice_band_dbfs(loudness_envelope, samples, benchmark_frame_rate, tspan_in_ms,
+                                                           config.downsampling_interval_in_ms, config=config)
+        seconds.append(time.perf_counter() - start_time)
+
+    return min(seconds), loudness_envelope
+
+
+def count_silent_intervals(loudness_envelope, tspan_in_ms, config):
+    '''Silent intervals found in a loudness envelope'''
+    loudness_mask = va.binarize_loudness_envelope(loudness_envelope, config)
+
+    return len(va.find_silent_intervals(loudness_mask, tspan_in_ms, config=config))
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost and the rumble robustness of the voice-band measure')
+    parser.add_argument('--minutes', type=float, default=60, help='length of the synthetic voice-over')
+    parser.add_argument('--rumble-dbfs', type=float, default=-12, help='loudness of the rumble added to the voice-over')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per measure, the fastest one is kept')
+    parser.add_argument('--output', help='JSON file the results are saved to')
+    args = parser.parse_args()
+
+    samples = np.concatenate(list(synthetic_audio.synthesize_speech(args.minutes * 60, benchmark_frame_rate)))
+    tspan_in_ms = round(1000 * (len(samples) / benchmark_frame_rate))
+    broadband_config = va.get_mix_config(loudness_measure='broadband')
+    voice_band_config = va.get_mix_config(loudness_measure='voice_band')
+
+    broadband_seconds, clean_broadband = measure_envelope(samples, broadband_config, args.repeats)
+    voice_band_seconds, clean_voice_band = measure_envelope(samples, voice_band_config, args.repeats)
+    rumbling_samples = add_rumble(samples, args.rumble_dbfs)
+    _, rumbling_broadband = measure_envelope(rumbling_samples, broadband_config, 1)
+    _, rumbling_voice_band = measure_envelope(rumbling_samples, voice_band_config, 1)
+
+    intervals = {
+        "clean_broadband": count_silent_intervals(clean_broadband, tspan_in_ms, broadband_config),
+        "clean_voice_band": count_silent_intervals(clean_voice_band, tspan_in_ms, voice_band_config),
+        "rumble_broadband": count_silent_intervals(rumbling_broadband, tspan_in_ms, broadband_config),
+        "rumble_voice_band": count_silent_intervals(rumbling_voice_band, tspan_in_ms, voice_band_config),
+    }
+
+    audio_seconds = len(samples) / benchmark_frame_rate
+    print(f'{args.minutes:g} min of mono audio, {len(clean_broadband)} windows of {va.downsampling_interval_in_ms} ms')
+    print(f'    broadband   {broadband_seconds:8.3f} s  {audio_seconds / broadband_seconds:8.0f}x real time')
+    print(f'    voice band  {voice_band_seconds:8.3f} s  {audio_seconds / voice_band_seconds:8.0f}x real time  '
+          f'({voice_band_seconds / broadband_seconds:.2f} times the broadband)')
+    print(f'silent intervals at {va.loudness_threshold} dBFS, clean / with a {args.rumble_dbfs:g} dBFS rumble:')
+    print(f'    broadband   {intervals["clean_broadband"]:6d} / {intervals["rumble_broadband"]:6d}')
+    print(f'    voice band  {intervals["clean_voice_band"]:6d} / {intervals["rumble_voice_band"]:6d}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({"minutes": args.minutes, "rumble_dbfs": args.rumble_dbfs,
+                       "seconds": {"broadband": broadband_seconds, "voice_band": voice_band_seconds},
+                       "silent_intervals": intervals}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from pydub import AudioSegment
+
+import format_normalizer
+
+'''
+Decoded BGM cache:
+Decoding an MP3 means starting ffmpeg and decoding the whole track, every time a mix is made.
+The cache keeps the decoded PCM of every BGM as a .npy file, keyed by the SHA-256 of the file content and the sample format.
+A BGM converted to the format of a mix is cached as well, converted from its cached decoded PCM (see format_normalizer.py),
+so mixing against the same BGM again costs neither the decoding nor the conversion.
+Cached PCM is opened with mmap, so a cached BGM is ready almost immediately,
+and several worker processes mixing against the same BGM share one copy of it in the page cache.
+The least recently used entries are evicted once the cache grows beyond bgm_cache_max_bytes.
+
+Usage:
+python bgm_cache.py --list
+python bgm_cache.py --invalidate bgm.mp3
+python bgm_cache.py --clear
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+bgm_cache_dir = "bgm_cache"  # Directory of the cached PCM files
+bgm_cache_max_bytes = 4 * 1024 ** 3  # Total size above which the least recently used entries are evicted, default 4 GiB
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def hash_file(path, chunk_size=1 << 20):
+    '''SHA-256 of the file content, so that a renamed file still hits the cache and an edited one does not'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_cache_key(content_hash, frame_rate=None, channels=None, sample_width=None):
+    '''Cache key of one decoded format of a BGM: content hash, frame rate, channels and sample width, "native" if not converted'''
+    target_format = (frame_rate, channels, sample_width)
+
+    return '-'.join([content_hash] + [str(value) if value is not None else 'native' for value in target_format])
+
+
+def open_cache_entry(key):
+    '''Open a cached entry as an AudioSegment backed by the memory-mapped PCM, or return None on a cache miss'''
+    pcm_path = os.path.join(bgm_cache_dir, key + '.npy')
+    try:
+        with open(os.path.join(bgm_cache_dir, key + '.json'), encoding='utf-8') as metadata_file:
+            metadata = json.load(metadata_file)
+        samples = np.load(pcm_path, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # Mark the entry as recently used for the LRU eviction
+    os.utime(pcm_path)
+
+    # An empty file cannot be memory-mapped, np.load then returns a plain array
+    data = memoryview(samples).cast('B') if samples.size else b''
+
+    return AudioSegment(data=data, sample_width=samples.dtype.itemsize, frame_rate=metadata["frame_rate"],
+                        channels=samples.shape[1])
+
+
+def write_cache_entry(key, bgm, source_path):
+    '''Store the PCM of a decoded BGM; the files are written under temporary names first, so readers never see half an entry'''
+    os.makedirs(bgm_cache_dir, exist_ok=True)
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[bgm.sample_width]
+    samples = np.frombuffer(bgm.raw_data, dtype=dtype).reshape(-1, bgm.channels)
+    metadata = {"frame_rate": bgm.frame_rate, "source": os.path.abspath(source_path)}
+
+    for extension, write in (('.npy', lambda file: np.save(file, samples)),
+                             ('.json', lambda file: file.write(json.dumps(metadata).encode('utf-8')))):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=bgm_cache_dir, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, os.path.join(bgm_cache_dir, key + extension))
+
+
+def list_cache_entries():
+    '''List the cached entries as (key, size_in_bytes, last_used_timestamp), least recently used first'''
+    if not os.path.isdir(bgm_cache_dir):
+        return []
+
+    entries = []
+    for file_name in os.listdir(bgm_cache_dir):
+        if not file_name.endswith('.npy'):
+            continue
+        key = file_name[:-len('.npy')]
+        try:
+            stat = os.stat(os.path.join(bgm_cache_dir, file_name))
+        except FileNotFoundError:
+            continue
+        entries.append((key, stat.st_size, stat.st_mtime))
+
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def remove_cache_entry(key):
+    '''Delete the files of one entry; processes that already mapped it keep their mapping until they are done'''
+    for extension in ('.npy', '.json'):
+        try:
+            os.remove(os.path.join(bgm_cache_dir, key + extension))
+        except FileNotFoundError:
+            pass
+
+
+def evict_cache_entries(keep_key=None):
+    '''Remove the least recently used entries until the cache fits in bgm_cache_max_bytes'''
+    entries = list_cache_entries()
+    total_bytes = sum(size for _, size, _ in entries)
+
+    for key, size, _ in entries:
+        if total_bytes <= bgm_cache_max_bytes:
+            break
+        if key != keep_key:
+            remove_cache_entry(key)
+            total_bytes -= size
+
+
+def invalidate_bgm_cache(bgm_path=None):
+    '''Drop every cached format of one BGM, or the whole cache when no path is given'''
+    prefix = hash_file(bgm_path) + '-' if bgm_path is not None else ''
+    for key, _, _ in list_cache_entries():
+        if key.startswith(prefix):
+            remove_cache_entry(key)
+
+
+def load_bgm(bgm_path, frame_rate=None, channels=None, sample_width=None):
+    '''
+    Load a BGM as an AudioSegment, decoding and caching it on the first use
+    When a target format is given, the BGM is converted to it before it is cached
+    '''
+    key = get_cache_key(hash_file(bgm_path), frame_rate, channels, sample_width)
+    bgm = open_cache_entry(key)
+    if bgm is not None:
+        return bgm
+
+    # Cache miss: decode with ffmpeg and store the PCM, a converted format is made from the cached decoded PCM instead
+    if (frame_rate, channels, sample_width) == (None, None, None):
+        bgm = AudioSegment.from_file(bgm_path)
+    else:
+        bgm = format_normalizer.normalize_audio(load_bgm(bgm_path), frame_rate, channels, sample_width, track_name='bgm')
+
+    write_cache_entry(key, bgm, bgm_path)
+    evict_cache_entries(keep_key=key)
+
+    return bgm
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    global bgm_cache_dir
+
+    parser = argparse.ArgumentParser(description='Inspect or clean the decoded BGM cache')
+    parser.add_argument('--cache-dir', default=bgm_cache_dir, help='cache directory')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--list', action='store_true', help='list the cached entries, least recently used first')
+    action.add_argument('--invalidate', metavar='BGM', help='drop every cached format of this BGM file')
+    action.add_argument('--clear', action='store_true', help='drop the whole cache')
+    args = parser.parse_args()
+    bgm_cache_dir = args.cache_dir
+
+    if args.list:
+        for key, size, _ in list_cache_entries():
+            print(f'{size / 1024 ** 2:10.1f} MiB  {key}')
+    else:
+        invalidate_bgm_cache(args.invalidate)
+
+
+if __name__ == "__main__":
+    main()
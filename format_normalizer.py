@@ -0,0 +1,245 @@
+import functools
+import math
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from pydub import AudioSegment
+
+import instrumentation
+import wav_reader
+
+'''
+Format normalization:
+The voice-over and the BGM rarely share one format: a 44.1 kHz mono WAV voice-over meets a 48 kHz stereo MP3 BGM.
+Left to pydub, the conversion happens as a side effect of mixing them, and audioop.ratecv resamples by interpolating
+between neighbouring samples, which lets the high frequencies of the BGM fold back as audible aliases.
+normalize_audio converts a track to a target frame rate, channel count and sample width in one explicit step:
+channels are averaged or copied and sample widths shifted exactly like pydub does, and frame rates are converted by
+a polyphase resampler, a Kaiser-windowed sinc low-pass filter applied at the rational ratio between the two rates.
+The resampler applies all its filter phases to a block of frames as one matrix product,
+so the converted BGM is computed quickly, and only once when it is cached (see bgm_cache.py and mixer.py).
+
+Usage:
+import format_normalizer
+bgm = format_normalizer.normalize_audio(bgm, frame_rate=44100, channels=2, sample_width=2)
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+# Half length of the anti-aliasing filter, in zero crossings of its sinc: longer filters have a steeper cutoff
+resampling_zero_crossings = 10
+# Kaiser window of the filter: a higher beta attenuates the aliases more, at the cost of a wider transition band
+resampling_kaiser_beta = 5.0
+# Largest filter matrix covering a whole cycle of filter phases, beyond it (rates without a small common ratio,
+# e.g. 44056 and 44100 Hz) the phases are applied one by one
+max_resampling_matrix_entries = 1 << 22
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+@functools.lru_cache(maxsize=16)
+def get_polyphase_filters(up, down):
+    '''
+    Polyphase decomposition of the low-pass filter for resampling by up / down, with its delay in upsampled frames
+    Row p holds the taps of phase p, reversed so that they multiply the input frames in increasing order
+    '''
+    # Cutoff at the lower of the two Nyquist frequencies, relative to the Nyquist frequency of the upsampled signal
+    max_rate = max(up, down)
+    half_length = resampling_zero_crossings * max_rate
+    offsets = np.arange(-half_length, half_length + 1)
+    low_pass = np.sinc(offsets / max_rate) * np.kaiser(len(offsets), resampling_kaiser_beta)
+    # Unity gain at DC once the zeros inserted by the upsampling are taken into account
+    low_pass *= up / low_pass.sum()
+
+    taps = -(-len(low_pass) // up)
+    padded_filter = np.zeros(taps * up)
+    padded_filter[:len(low_pass)] = low_pass
+
+    return padded_filter.reshape(taps, up).T[:, ::-1].copy(), half_length
+
+
+@functools.lru_cache(maxsize=16)
+def get_resampling_matrix(up, down, cycles):
+    '''
+    All the filter phases of cycles * up consecutive output frames as one (span, cycles * up) matrix, with its input offset
+    and span: output frames r * cycles * up onwards are the span input frames from r * cycles * down + offset times the matrix
+    The matrix is None when it would hold more than max_resampling_matrix_entries, for rates without a small common ratio
+    '''
+    phase_filters, half_length = get_polyphase_filters(up, down)
+    taps = phase_filters.shape[1]
+    positions = np.arange(cycles * up) * down + half_length
+    first_frames = positions // up - taps + 1
+    offset = int(first_frames[0])
+    span = int(first_frames[-1]) + taps - offset
+    if span * cycles * up > max_resampling_matrix_entries:
+        return None, offset, span
+
+    matrix = np.zeros((span, cycles * up))
+    matrix[(first_frames - offset).reshape(-1, 1) + np.arange(taps), np.arange(cycles * up).reshape(-1, 1)] = \
+        phase_filters[positions % up]
+
+    return matrix, offset, span
+
+
+def resample_polyphase(samples, frame_rate, target_frame_rate, dtype=None, frames_per_block=1 << 18):
+    '''
+    Resample (frames, channels) integer samples from frame_rate to target_frame_rate, into samples of dtype (the same by default)
+    With rates up / down apart, every up output frames read the next down input frames through the same filter phases,
+    so a whole block is one matrix product of the strided input windows with get_resampling_matrix
+    Without such a matrix, every filter phase is one matrix product over the input frames down apart that it applies to
+    '''
+    dtype = np.dtype(dtype or samples.dtype)
+    divisor = math.gcd(frame_rate, target_frame_rate)
+    up, down = target_frame_rate // divisor, frame_rate // divisor
+    phase_filters, half_length = get_polyphase_filters(up, down)
+    taps = phase_filters.shape[1]
+    frame_count, channels = samples.shape
+    output_count = -(-frame_count * up // down)
+
+    # Cycles of at least 64 output frames, so that rate ratios like 2 / 1 still make a matrix worth multiplying
+    cycles = -(-64 // up)
+    matrix, offset, span = get_resampling_matrix(up, down, cycles)
+    if matrix is None:
+        cycles = 1
+        _, offset, span = get_resampling_matrix(up, down, cycles)
+    cycle_outputs, cycle_inputs = cycles * up, cycles * down
+
+    # 8 and 16-bit samples fit in float32, wider ones need float64; a change of sample width shifts the samples like lin2lin
+    work_dtype = np.float64 if max(samples.dtype.itemsize, dtype.itemsize) > 2 else np.float32
+    scale = 2.0 ** (8 * (dtype.itemsize - samples.dtype.itemsize))
+    if matrix is not None:
+        matrix = (matrix * scale).astype(work_dtype)
+    phase_filters = (phase_filters * scale).astype(work_dtype)
+    bounds = np.iinfo(dtype)
+
+    output = np.empty((output_count, channels), dtype=dtype)
+    block_outputs = max(frames_per_block // cycle_outputs, 1) * cycle_outputs
+    for block_first in range(0, output_count, block_outputs):
+        block_last = min(block_first + block_outputs, output_count)
+        block_cycles = -(-(block_last - block_first) // cycle_outputs)
+
+        # Input frames the block reaches, zero before the first frame and after the last one
+        first_input = block_first // cycle_outputs * cycle_inputs + offset
+        block = np.zeros(((block_cycles - 1) * cycle_inputs + span, channels), dtype=work_dtype)
+        copy_first, copy_last = max(first_input, 0), min(first_input + len(block), frame_count)
+        if copy_last > copy_first:
+            block[copy_first - first_input:copy_last - first_input] = samples[copy_first:copy_last]
+
+        if matrix is not None:
+            # One row of span input frames per cycle and channel
+            rows = np.ascontiguousarray(sliding_window_view(block, span, axis=0)[::cycle_inputs])
+            resampled = (rows.reshape(-1, span) @ matrix).reshape(block_cycles, channels, cycle_outputs)
+            resampled = resampled.transpose(0, 2, 1).reshape(-1, channels)[:block_last - block_first]
+        else:
+            # windows[i] holds the taps input frames from first_input + i, as a view
+            windows = sliding_window_view(block, taps, axis=0)
+            resampled = np.empty((block_last - block_first, channels), dtype=work_dtype)
+            for output_offset in range(min(up, block_last - block_first)):
+                position = (block_first + output_offset) * down + half_length
+                phase, first_window = position % up, position // up - taps + 1 - first_input
+                phase_outputs = len(range(output_offset, block_last - block_first, up))
+                resampled[output_offset::up] = \
+                    windows[first_window:first_window + (phase_outputs - 1) * down + 1:down] @ phase_filters[phase]
+
+        output[block_first:block_last] = np.clip(np.rint(resampled), bounds.min, bounds.max)
+
+    return output
+
+
+def get_resampled_span(first_frame, last_frame, frame_rate, target_frame_rate):
+    '''
+    Frames [first_frame, last_frame) of the input as the span of output frames of resample_polyphase that read them,
+    so that changing those input frames changes no output frame outside of it
+    '''
+    if frame_rate == target_frame_rate:
+        return first_frame, last_frame
+
+    divisor = math.gcd(frame_rate, target_frame_rate)
+    up, down = target_frame_rate // divisor, frame_rate // divisor
+    phase_filters, half_length = get_polyphase_filters(up, down)
+    taps = phase_filters.shape[1]
+
+    # Output frame m reads the taps input frames up to (m * down + half_length) // up
+    first_output = max(-(-(first_frame * up - half_length) // down), 0)
+    last_output = -(-((last_frame + taps - 1) * up - half_length) // down)
+
+    return first_output, max(last_output, first_output)
+
+
+def convert_channels(samples, channels):
+    '''Mix the channels down to mono by averaging them, or copy a mono track to every channel, like pydub set_channels'''
+    if samples.shape[1] == channels:
+        return samples
+    if channels == 1:
+        # audioop.tomono floors the average
+        mono = np.floor(samples.astype(np.float64).mean(axis=1, keepdims=True))
+        return mono.astype(samples.dtype)
+    if samples.shape[1] == 1:
+        return np.repeat(samples, channels, axis=1)
+
+    raise ValueError(f'Cannot convert {samples.shape[1]} channels to {channels}, only to and from mono')
+
+
+def convert_sample_width(samples, sample_width):
+    '''Widen or narrow samples to sample_width bytes, keeping their most significant bytes like audioop.lin2lin'''
+    dtype = np.dtype({1: np.int8, 2: np.int16, 4: np.int32}[sample_width])
+    shift = 8 * abs(sample_width - samples.dtype.itemsize)
+    if dtype == samples.dtype:
+        return samples
+    if sample_width > samples.dtype.itemsize:
+        return samples.astype(dtype) << shift
+
+    return (samples >> shift).astype(dtype)
+
+
+def get_audio_format(audio):
+    '''Frame rate, channels and sample width of an AudioSegment'''
+    return audio.frame_rate, audio.channels, audio.sample_width
+
+
+def get_samples(audio):
+    '''The (frames, channels) samples of an AudioSegment, without copying them'''
+    if isinstance(audio, wav_reader.MappedAudioSegment):
+        return audio.samples
+
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[audio.sample_width]
+    return np.frombuffer(audio.raw_data, dtype=dtype).reshape(-1, audio.channels)
+
+
+def normalize_audio(audio, frame_rate=None, channels=None, sample_width=None, track_name='audio'):
+    '''
+    Convert an AudioSegment to the given frame rate, channels and sample width, None keeping its own
+    The audio is returned as is when it already has that format; otherwise the conversion and the time it took are
+    reported to the metrics sink under track_name
+    '''
+    source_format = get_audio_format(audio)
+    target_format = tuple(value if value is not None else source_value
+                          for value, source_value in zip((frame_rate, channels, sample_width), source_format))
+    if target_format == source_format:
+        return audio
+
+    start_time = time.perf_counter()
+    samples = get_samples(audio)
+    target_dtype = {1: np.int8, 2: np.int16, 4: np.int32}[target_format[2]]
+
+    # Fewer channels are mixed down before resampling, more are copied after it, so that the fewest channels are resampled
+    if target_format[1] < source_format[1]:
+        samples = convert_channels(samples[0:len(samples)], target_format[1])
+    if target_format[0] != source_format[0]:
+        samples = resample_polyphase(samples, source_format[0], target_format[0], target_dtype)
+    samples = convert_channels(convert_sample_width(samples[0:len(samples)], target_format[2]), target_format[1])
+
+    samples = np.ascontiguousarray(samples)
+    normalized_audio = AudioSegment(data=memoryview(samples).cast('B') if samples.size else b'',
+                                    sample_width=target_format[2], frame_rate=target_format[0], channels=target_format[1])
+    instrumentation.record_metrics('normalize_format', track=track_name, source_format=list(source_format),
+                                   target_format=list(target_format), frames=len(samples),
+                                   seconds=time.perf_counter() - start_time)
+
+    return normalized_audio
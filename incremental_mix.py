@@ -0,0 +1,364 @@
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+
+import numpy as np
+from pydub import AudioSegment
+
+import audio_encoder
+import bgm_cache
+import format_normalizer
+import instrumentation
+import voice_avoidence as va
+
+'''
+Incremental re-render:
+A TTS system that regenerates single sentences of a long narration would otherwise re-run final_mix on the whole file
+for every fix. The incremental mode keeps the loudness envelope, the silent intervals and the rendered mix of the previous
+run in incremental_state_dir, and compares the new voice-over with the previous one block by block, by hash.
+Only the windows of the envelope over the changed blocks are measured again, the silent intervals are searched again
+only around them (silent_interval_tspan_threshold_in_ms on both sides, out to the nearest loud window that did not change),
+and only the frames of the mix whose voice-over or BGM gain changed are rendered again, plus the reach of the peak limiter,
+and spliced into the previous mix. The result is byte-identical to a full re-render.
+Every fade scales the whole BGM before it (see va.render_gain_curve), so a change that adds or removes a silent interval
+also renders the BGM before it again; a regenerated sentence that keeps its pauses only renders its own span.
+A voice-over that got longer or shorter shifts everything after the change, which is then all rendered again;
+other settings, another BGM or another sample format fall back to a full render.
+When the mix has another frame rate than the voice-over (a 48 kHz BGM under a 44.1 kHz voice-over), the voice-over is
+resampled once, and the changed blocks are mapped onto the frames of the mix that the resampler reads them into.
+
+Usage:
+python incremental_mix.py [--speech speech.wav] [--bgm bgm.mp3] [--output final.wav] [--state-dir incremental_state]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+incremental_state_dir = "incremental_state"  # Directory of the envelope, the silent intervals and the mix of the last run
+change_block_frames = 1 << 16  # Frames hashed together to compare two voice-overs, about 1.5 seconds at 44.1 kHz
+envelope_block_windows = 8192  # Windows computed together by va.compute_window_dbfs, whose sums the update must repeat
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def hash_blocks(samples, block_frames):
+    '''Hash every block of block_frames frames of a (frames, channels) array'''
+    return [hashlib.blake2b(np.ascontiguousarray(samples[first_frame:first_frame + block_frames]), digest_size=16).hexdigest()
+            for first_frame in range(0, len(samples), block_frames)]
+
+
+def find_changed_frames(old_hashes, new_hashes, old_frame_count, new_frame_count, block_frames):
+    '''
+    Frames [first_frame, last_frame) of the new voice-over that cover every block whose hash changed, or None if none did
+    When the length changed, everything from the first changed block to the end counts as changed
+    '''
+    changed_blocks = [block for block, (old_hash, new_hash) in enumerate(zip(old_hashes, new_hashes))
+                      if old_hash != new_hash]
+    if old_frame_count != new_frame_count:
+        first_block = changed_blocks[0] if changed_blocks else min(len(old_hashes), len(new_hashes))
+        return min(first_block * block_frames, new_frame_count), new_frame_count
+    if not changed_blocks:
+        return None
+
+    return changed_blocks[0] * block_frames, min((changed_blocks[-1] + 1) * block_frames, new_frame_count)
+
+
+def update_loudness_envelope(loudness_envelope, adjusted_speech, first_frame, last_frame, config=None):
+    '''
+    Measure again the windows of a previous loudness envelope that overlap frames [first_frame, last_frame) of the new voice-over
+    Sums of 8 and 16-bit squares are exact, so their windows can be measured on their own; wider samples, and the float32
+    products of the voice-band measure, are measured in the whole blocks of windows of a full pass, so every window gets
+    the exact value of a full pass
+    The windows after the changed frames are kept only if the voice-over kept its length
+    Returns the new envelope and the windows [first_window, last_window) that were measured
+    '''
+    config = config or va.get_mix_config()
+    samples = va.audio_to_array(adjusted_speech)
+    frame_rate, adjusted_tspan_in_ms = adjusted_speech.frame_rate, len(adjusted_speech)
+    window_count = adjusted_tspan_in_ms // config.downsampling_interval_in_ms + 1
+    frames_per_window = frame_rate * config.downsampling_interval_in_ms / 1000.0
+
+    # One window of slack on both sides of the changed frames
+    measure_key = va.get_measure_key(config)
+    block_windows = envelope_block_windows if samples.dtype.itemsize > 2 or measure_key else 1
+    first_window = max(int(first_frame / frames_per_window) - 1, 0) // block_windows * block_windows
+    last_window = window_count
+    if len(loudness_envelope) == window_count:
+        last_block = -(-(int(last_frame / frames_per_window) + 2) // block_windows)
+        last_window = min(last_block * block_windows, window_count)
+
+    window_dbfs = va.compute_window_dbfs(samples, frame_rate, adjusted_tspan_in_ms, config.downsampling_interval_in_ms,
+                                         first_window, last_window, max_windows_per_block=envelope_block_windows)
+    if measure_key:
+        window_dbfs = va.compute_voice_band_dbfs(window_dbfs, samples, frame_rate, adjusted_tspan_in_ms,
+                                                 config.downsampling_interval_in_ms, first_window, last_window,
+                                                 max_windows_per_block=envelope_block_windows, config=config)
+    loudness_envelope = np.concatenate((loudness_envelope[:first_window], window_dbfs,
+                                        loudness_envelope[last_window:window_count]))
+
+    return loudness_envelope, first_window, last_window
+
+
+def update_silent_intervals(silent_intervals, old_loudness_mask, new_loudness_mask, adjusted_tspan_in_ms, config=None):
+    '''
+    Silent intervals of the new binarized loudness, searched again only where it differs from the previous one
+    The search covers the changed windows and silent_interval_tspan_threshold_in_ms on both sides, out to the nearest loud
+    windows: a silent run is bounded by its loud windows, so the runs beyond those are the same as before
+    '''
+    config = config or va.get_mix_config()
+    downsampling_interval_in_ms = config.downsampling_interval_in_ms
+    common_windows = min(len(old_loudness_mask), len(new_loudness_mask))
+    changed_windows = np.flatnonzero(old_loudness_mask[:common_windows] != new_loudness_mask[:common_windows])
+    same_length = len(old_loudness_mask) == len(new_loudness_mask)
+    if same_length and not len(changed_windows):
+        return list(silent_intervals)
+
+    first_changed = changed_windows[0] if len(changed_windows) else common_windows
+    if not same_length:
+        first_changed = min(first_changed, common_windows - 1)
+    last_changed = changed_windows[-1] + 1 if same_length else len(new_loudness_mask)
+    margin_windows = -(-config.silent_interval_tspan_threshold_in_ms // downsampling_interval_in_ms)
+
+    # Loud windows that close the runs before and after the search, among the points the search scans
+    loud_points = np.flatnonzero(new_loudness_mask[:-(-adjusted_tspan_in_ms // downsampling_interval_in_ms)])
+    loud_before = loud_points[loud_points < first_changed - margin_windows]
+    loud_after = loud_points[loud_points >= last_changed + margin_windows] if same_length else []
+    first_point = int(loud_before[-1]) if len(loud_before) else -1
+    last_point = int(loud_after[0]) if len(loud_after) else None
+
+    # The search stops on the loud window after it, which closes the last run
+    search_tspan_in_ms = adjusted_tspan_in_ms if last_point is None else (last_point + 1) * downsampling_interval_in_ms
+    searched_intervals = va.find_silent_intervals(new_loudness_mask, search_tspan_in_ms,
+                                                  (first_point + 1) * downsampling_interval_in_ms, config)
+
+    intervals_before = [interval for interval in silent_intervals
+                        if interval[0] <= first_point * downsampling_interval_in_ms]
+    intervals_after = [interval for interval in silent_intervals
+                       if last_point is not None and interval[0] > last_point * downsampling_interval_in_ms]
+
+    return intervals_before + searched_intervals + intervals_after
+
+
+def get_bgm_gain(silent_intervals, config=None):
+    '''Starting volume and gain automation of the BGM for the given silent intervals, the way final_mix derives them'''
+    fade_ins, fade_outs = va.get_fade_ins_and_outs(va.create_silent_interval_dict(silent_intervals), config)
+
+    return va.determine_starting_volume(fade_ins, fade_outs, config), va.get_gain_automation(fade_ins, fade_outs, config)
+
+
+def find_gain_changes(old_gain, new_gain, frame_rate, frame_count):
+    '''
+    Frame spans where two BGM gains, each a (starting_volume, gain_automation, bgm_tspan_in_ms) tuple, may differ
+    The timeline is cut at every ramp boundary of either: a piece keeps its values if its constant gain is the same and
+    the same ramps, in the same order, run over it, since va.render_gain_curve then computes the very same products
+    '''
+    ramps = [va.get_fade_ramps(gain_automation, frame_rate, bgm_tspan_in_ms)
+             for _, gain_automation, bgm_tspan_in_ms in (old_gain, new_gain)]
+    boundaries = np.unique(np.clip(np.concatenate([[0, frame_count]] + [np.concatenate((ramp_starts, ramp_ends))
+                                                                         for _, ramp_starts, ramp_ends in ramps]),
+                                   0, frame_count))
+    piece_starts, piece_ends = boundaries[:-1], boundaries[1:]
+
+    constant_gains = [va.get_constant_gain_in_db(fades, ramp_starts, ramp_ends, starting_volume, piece_starts)
+                      for (fades, ramp_starts, ramp_ends), (starting_volume, _, _) in zip(ramps, (old_gain, new_gain))]
+    changed = constant_gains[0] != constant_gains[1]
+
+    running_ramps = [(ramp_starts[:, np.newaxis] <= piece_starts) & (ramp_ends[:, np.newaxis] > piece_starts)
+                     for _, ramp_starts, ramp_ends in ramps]
+    for piece in np.flatnonzero(~changed):
+        old_ramps, new_ramps = ([fades[k] for k in np.flatnonzero(running[:, piece])]
+                                for (fades, _, _), running in zip(ramps, running_ramps))
+        changed[piece] = old_ramps != new_ramps
+
+    return [(int(first_frame), int(last_frame))
+            for first_frame, last_frame in zip(piece_starts[changed], piece_ends[changed])]
+
+
+def merge_spans(spans, reach, frame_count):
+    '''Widen every frame span by reach on both sides, within the mix, and merge the ones that then overlap'''
+    merged = []
+    for first_frame, last_frame in sorted(spans):
+        first_frame, last_frame = max(first_frame - reach, 0), min(last_frame + reach, frame_count)
+        if merged and first_frame <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last_frame))
+        elif last_frame > first_frame:
+            merged.append((first_frame, last_frame))
+
+    return merged
+
+
+def load_mix_bgm(bgm_path, adjusted_speech, config):
+    '''Load the BGM converted once to the format of the mix, so that rendering several spans never converts it again'''
+    bgm = va.load_bgm_audio(bgm_path)
+
+    return va.normalize_bgm(bgm, bgm_path, va.get_mix_format([adjusted_speech, bgm], config))
+
+
+def get_settings(bgm_path, adjusted_speech, config):
+    '''Everything besides the voice-over content that a previous mix has to share to be updated instead of rendered again'''
+    settings = {"config": dataclasses.asdict(config), "bgm": bgm_cache.hash_file(bgm_path),
+                "format": [adjusted_speech.frame_rate, adjusted_speech.channels, adjusted_speech.sample_width]}
+
+    # The same round trip as the stored settings, so that the two compare equal
+    return json.loads(json.dumps(settings))
+
+
+def load_state(state_dir):
+    '''Read back the state of the last run, or return None if there is none'''
+    try:
+        with open(os.path.join(state_dir, 'state.json'), encoding='utf-8') as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    state["silent_intervals"] = [tuple(interval) for interval in state["silent_intervals"]]
+
+    return state
+
+
+def store_state(state_dir, state, loudness_envelope):
+    '''Keep the state of this run, the state file goes last so that it always describes a complete mix'''
+    np.save(os.path.join(state_dir, 'envelope.npy'), loudness_envelope)
+    temporary_path = os.path.join(state_dir, 'state.json.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, os.path.join(state_dir, 'state.json'))
+
+
+def incremental_mix(speech_path, bgm_path, output_path, state_dir=None, config=None):
+    '''
+    Mix the voice-over with the BGM into output_path, updating the mix of the last run when only part of the voice-over changed
+    Returns a summary: whether the mix was rendered fully or updated, and how many frames were measured and rendered
+    '''
+    config = config or va.get_mix_config()
+    state_dir = state_dir or incremental_state_dir
+    if va.speech_stems:
+        raise ValueError('The incremental mode mixes a single voice-over, speech_stems is not supported')
+    os.makedirs(state_dir, exist_ok=True)
+    mix_path = os.path.join(state_dir, 'mix.npy')
+
+    adjusted_speech, adjusted_tspan_in_ms = va.create_adjust_speech_audio(config, speech_path)
+    frame_count = int(adjusted_speech.frame_count())
+    with instrumentation.measure_stage('hash_speech'):
+        block_hashes = hash_blocks(va.audio_to_array(adjusted_speech), change_block_frames)
+    with instrumentation.measure_stage('decode_bgm'):
+        bgm = load_mix_bgm(bgm_path, adjusted_speech, config)
+    bgm_tspan_in_ms = adjusted_tspan_in_ms if config.fit_bgm_to_speech else len(bgm)
+    settings = get_settings(bgm_path, adjusted_speech, config)
+
+    # The voice-over is converted to the format of the mix once, like the BGM; spans of the mix are counted in its frames
+    mix_format = va.get_mix_format([adjusted_speech, bgm], config)
+    with instrumentation.measure_stage('normalize_speech'):
+        mix_speech = format_normalizer.normalize_audio(adjusted_speech, *va.get_track_format(adjusted_speech, mix_format),
+                                                       track_name='speech')
+    mix_frame_count, mix_frame_rate = int(mix_speech.frame_count()), mix_speech.frame_rate
+
+    state = load_state(state_dir)
+    if state is not None and config.fit_bgm_to_speech:
+        # Whether the BGM has to loop changes how its end is rendered
+        bgm_frame_count = int(bgm.frame_count())
+        old_mix_frame_count = -(-state["frame_count"] * mix_frame_rate // adjusted_speech.frame_rate)
+        state = state if (old_mix_frame_count > bgm_frame_count) == (mix_frame_count > bgm_frame_count) else None
+
+    if state is None or state["settings"] != settings:
+        # Full render, the same steps as final_mix with the exact envelope kept for the next run
+        with instrumentation.measure_stage('detect_silent_intervals'):
+            loudness_envelope = va.create_loudness_envelope(adjusted_speech, config, coarse_scan=False)
+            silent_intervals = va.find_silent_intervals(va.binarize_loudness_envelope(loudness_envelope, config),
+                                                        adjusted_tspan_in_ms, config=config)
+        starting_volume, gain_automation = get_bgm_gain(silent_intervals, config)
+        with instrumentation.measure_stage('mix_speech_with_bgm'):
+            mix = va.render_mix([mix_speech], bgm, starting_volume, gain_automation, config, fade_out_at_end=True)
+        np.save(mix_path, va.audio_to_array(mix))
+        summary = {"render": 'full', "windows_measured": len(loudness_envelope), "frames_rendered": mix_frame_count}
+
+    else:
+        # Only what the changed blocks reach is measured and rendered again
+        old_loudness_envelope = np.load(os.path.join(state_dir, 'envelope.npy'))
+        changed_frames = find_changed_frames(state["block_hashes"], block_hashes, state["frame_count"], frame_count,
+                                             change_block_frames)
+        loudness_envelope, silent_intervals = old_loudness_envelope, state["silent_intervals"]
+        first_window = last_window = 0
+        if changed_frames is not None:
+            with instrumentation.measure_stage('detect_silent_intervals'):
+                loudness_envelope, first_window, last_window = update_loudness_envelope(
+                    old_loudness_envelope, adjusted_speech, *changed_frames, config)
+                silent_intervals = update_silent_intervals(
+                    state["silent_intervals"], va.binarize_loudness_envelope(old_loudness_envelope, config),
+                    va.binarize_loudness_envelope(loudness_envelope, config), adjusted_tspan_in_ms, config)
+
+        # The BGM changes wherever the fades move, the voice-over wherever its blocks changed
+        old_gain = get_bgm_gain(state["silent_intervals"], config) + (state["bgm_tspan_in_ms"],)
+        starting_volume, gain_automation = get_bgm_gain(silent_intervals, config)
+        spans = find_gain_changes(old_gain, (starting_volume, gain_automation, bgm_tspan_in_ms),
+                                  mix_frame_rate, mix_frame_count)
+        if changed_frames is not None:
+            spans.append(format_normalizer.get_resampled_span(*changed_frames, adjusted_speech.frame_rate,
+                                                              mix_frame_rate))
+        if frame_count != state["frame_count"]:
+            # The ending fade-out moved with the end of the mix
+            spans.append((va.get_end_fade(mix_frame_count, mix_frame_rate, config)[0], mix_frame_count))
+        spans = merge_spans(spans, va.get_limiter_reach(mix_frame_rate, config), mix_frame_count)
+
+        # The previous mix is patched in place, or copied first when its length changes
+        old_mix_samples = np.load(mix_path, mmap_mode='r+')
+        mix_samples = old_mix_samples
+        if mix_frame_count != len(old_mix_samples):
+            mix_samples = np.lib.format.open_memmap(mix_path + '.tmp', mode='w+', dtype=old_mix_samples.dtype,
+                                                     shape=(mix_frame_count, old_mix_samples.shape[1]))
+            mix_samples[:min(mix_frame_count, len(old_mix_samples))] = old_mix_samples[:mix_frame_count]
+        # A run interrupted while patching must not leave a state that describes the previous mix
+        os.remove(os.path.join(state_dir, 'state.json'))
+        with instrumentation.measure_stage('mix_speech_with_bgm'):
+            for first_frame, last_frame in spans:
+                mix_samples[first_frame:last_frame] = va.audio_to_array(va.render_mix(
+                    [mix_speech], bgm, starting_volume, gain_automation, config, fade_out_at_end=True,
+                    first_frame=first_frame, last_frame=last_frame))
+        mix_samples.flush()
+        if mix_samples is not old_mix_samples:
+            del old_mix_samples
+            os.replace(mix_path + '.tmp', mix_path)
+
+        mix = AudioSegment(data=memoryview(mix_samples).cast('B') if mix_samples.size else b'',
+                           sample_width=mix_samples.dtype.itemsize, frame_rate=mix_frame_rate,
+                           channels=mix_samples.shape[1])
+        summary = {"render": 'incremental', "windows_measured": last_window - first_window,
+                   "frames_rendered": sum(last_frame - first_frame for first_frame, last_frame in spans)}
+
+    store_state(state_dir, {"settings": settings, "frame_count": frame_count, "bgm_tspan_in_ms": bgm_tspan_in_ms,
+                            "block_hashes": block_hashes, "silent_intervals": silent_intervals}, loudness_envelope)
+    instrumentation.record_metrics('incremental_mix', frames=frame_count, **summary)
+
+    with instrumentation.measure_stage('encode'):
+        audio_encoder.export_audio(mix, output_path, va.final_bitrate)
+
+    return summary
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mix again, rendering only what changed in the voice-over since the last run')
+    parser.add_argument('--speech', default=va.speech_path, help='voice-over WAV file')
+    parser.add_argument('--bgm', default=va.bgm_path, help='BGM file')
+    parser.add_argument('--output', default=va.final_path, help='output path, its extension sets the format')
+    parser.add_argument('--state-dir', default=incremental_state_dir, help='directory of the state of the last run')
+    args = parser.parse_args()
+
+    if va.metrics_path:
+        instrumentation.set_metrics_sink(instrumentation.json_lines_sink(va.metrics_path))
+    summary = incremental_mix(args.speech, args.bgm, args.output, args.state_dir)
+    print(f'{summary["render"]} render: {summary["windows_measured"]} windows measured, '
+          f'{summary["frames_rendered"]} frames rendered')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+
+'''
+Instrumentation:
+The steps of final_mix report how long they took and what they processed (windows scanned, intervals found, fades applied,
+buffer sizes) as events, plain dicts handed to the metrics sink.
+A sink is any callable taking one event: logging_sink and json_lines_sink cover the common cases, a callback can aggregate them.
+Without a sink, measure_stage returns a shared do-nothing context manager and record_metrics returns at once,
+so the instrumented code costs nothing measurable.
+
+Usage:
+import instrumentation
+instrumentation.set_metrics_sink(instrumentation.json_lines_sink("metrics.jsonl"))
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+metrics_sink = None  # Callable receiving every event, None disables the instrumentation
+
+# Returned by measure_stage when no sink is attached
+no_stage = contextlib.nullcontext()
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def set_metrics_sink(sink):
+    '''Attach a sink to receive the events of every following mix, or detach it with None'''
+    global metrics_sink
+    metrics_sink = sink
+
+
+def logging_sink(logger=None, level=logging.INFO):
+    '''Sink that logs every event as one JSON line'''
+    logger = logger or logging.getLogger('voice_avoidence')
+
+    return lambda event: logger.log(level, json.dumps(event))
+
+
+def json_lines_sink(path):
+    '''Sink that appends every event to a JSON-lines file, safe to share between threads'''
+    lock = threading.Lock()
+    metrics_file = open(path, 'a', encoding='utf-8')
+
+    def write_event(event):
+        with lock:
+            metrics_file.write(json.dumps(event) + '\n')
+            metrics_file.flush()
+
+    return write_event
+
+
+@contextlib.contextmanager
+def timed_stage(sink, stage_name):
+    '''Time the enclosed code and send a stage event to the sink, also when the stage fails'''
+    start_time = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        sink({"event": "stage", "stage": stage_name, "seconds": time.perf_counter() - start_time, "failed": failed,
+              "time": time.time()})
+
+
+def measure_stage(stage_name):
+    '''Context manager timing one step, usage: with measure_stage('export'): ...'''
+    sink = metrics_sink
+    if sink is None:
+        return no_stage
+
+    return timed_stage(sink, stage_name)
+
+
+def record_metrics(stage_name, **metrics):
+    '''Send the counts and sizes measured by one step to the sink'''
+    sink = metrics_sink
+    if sink is None:
+        return
+
+    sink(dict({"event": "metrics", "stage": stage_name, "time": time.time()}, **metrics))
@@ -0,0 +1,181 @@
+import argparse
+import collections
+import math
+import sys
+
+import numpy as np
+from pydub.utils import db_to_float
+
+import voice_avoidence as va
+from streaming_mix import convert_samples
+
+'''
+Live mode:
+final_mix needs the whole voice-over before it can find the silent intervals, which rules it out for live broadcasts.
+The live mode reads speech and BGM as raw 16-bit PCM from stdin or from two pipes, and writes the mix to stdout as it goes,
+one downsampling window (downsampling_interval_in_ms) at a time.
+It runs the same rules as find_a_silent_interval, incrementally: a window louder than loudness_threshold ducks the BGM,
+and the BGM comes back once the voice has been silent for silent_interval_tspan_threshold_in_ms.
+Every window is held back lookahead_in_ms before it is written, so a duck can start that long before the voice arrives.
+The latency is one window plus the lookahead, 40 ms with the defaults.
+
+Differences with final_mix, which can look into the future as far as it wants:
+the BGM only comes back after the silence has lasted the whole threshold, not from the start of the silence;
+a duck starts lookahead_in_ms before the voice and not fade_in_tspan_in_ms before it;
+and the gains are the absolute loud_level and quiet_level, without the compounding of pydub fades (see render_gain_curve).
+
+Usage:
+producer | python live_ducking.py --speech-channels 1 --bgm-channels 2 | consumer  (speech and BGM channels interleaved on stdin)
+python live_ducking.py --speech speech.pcm --bgm bgm.pcm > mix.pcm  (two pipes or files)
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+live_frame_rate = 48000  # Frame rate of the raw PCM on the inputs and the output
+lookahead_in_ms = 20  # How long every window is held back, i.e. how long before the voice a duck can start
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def read_exactly(stream, size):
+    '''Read size bytes from a pipe, fewer only at the end of the stream'''
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+
+    return bytes(data)
+
+
+def iter_live_windows(speech_stream, bgm_stream, speech_channels, bgm_channels, window_frames):
+    '''
+    Read (speech, bgm) sample arrays of window_frames frames from the inputs, until the speech ends
+    With bgm_stream None, every frame on speech_stream holds the speech channels followed by the BGM channels
+    '''
+    while True:
+        if bgm_stream is None:
+            frame_size = 2 * (speech_channels + bgm_channels)
+            data = read_exactly(speech_stream, window_frames * frame_size)
+            frames = np.frombuffer(data[:len(data) - len(data) % frame_size], dtype=np.int16)
+            frames = frames.reshape(-1, speech_channels + bgm_channels)
+            speech, bgm = frames[:, :speech_channels], frames[:, speech_channels:]
+        else:
+            data = read_exactly(speech_stream, window_frames * 2 * speech_channels)
+            speech = np.frombuffer(data[:len(data) - len(data) % (2 * speech_channels)], dtype=np.int16)
+            speech = speech.reshape(-1, speech_channels)
+            # A BGM that ends early leaves the voice alone
+            data = read_exactly(bgm_stream, len(speech) * 2 * bgm_channels)
+            bgm = np.zeros((len(speech), bgm_channels), dtype=np.int16)
+            bgm.flat[:len(data) // 2] = np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+
+        if not len(speech):
+            return
+        yield speech, bgm
+
+
+def ramp_gain(gain, target_gain, step, frame_count):
+    '''Per-frame gains of a linear ramp from gain towards target_gain, stopping at the target, like a pydub fade'''
+    gains = gain + step * np.arange(1, frame_count + 1)
+
+    return np.minimum(gains, target_gain) if step > 0 else np.maximum(gains, target_gain)
+
+
+def duck_live(input_windows, frame_rate, config=None, lookahead_in_ms=None):
+    '''
+    Mix (speech, bgm) windows on the fly and yield the mixed windows as int16 arrays, lookahead_in_ms later
+    (the module default when it is None)
+    Every input window is classified as it arrives, and the gain it decides is applied from the oldest window still held back
+    The windows should last config.downsampling_interval_in_ms, which the silences are counted in
+    '''
+    config = config or va.get_mix_config()
+    lookahead_in_ms = globals()["lookahead_in_ms"] if lookahead_in_ms is None else lookahead_in_ms
+    lookahead_windows = math.ceil(lookahead_in_ms / config.downsampling_interval_in_ms)
+    quiet_gain, loud_gain = db_to_float(config.quiet_level), db_to_float(config.loud_level)
+    fade_in_frames = max(config.fade_in_tspan_in_ms * frame_rate // 1000, 1)
+    fade_out_frames = max(config.fade_out_tspan_in_ms * frame_rate // 1000, 1)
+
+    # The stream starts with the BGM up, as if the voice had been silent for long enough already
+    gain, target_gain, step = loud_gain, loud_gain, 0.0
+    silent_tspan_in_ms = config.silent_interval_tspan_threshold_in_ms
+    held_windows = collections.deque()
+
+    def mix_oldest_window():
+        nonlocal gain
+        speech, bgm = held_windows.popleft()
+        gains = ramp_gain(gain, target_gain, step, len(speech))
+        gain = gains[-1]
+
+        # The ducked BGM is clipped and floored to 16 bits, then added to the speech and the sum hard-clipped:
+        # unlike render_mix, no peak limiter runs on the live output
+        ducked_bgm = np.floor(np.clip(bgm * gains[:, None], -32768, 32767)).astype(np.int16)
+        channels = max(speech.shape[1], bgm.shape[1])
+        mix = convert_samples(speech, channels, 2).astype(np.int32) + convert_samples(ducked_bgm, channels, 2)
+
+        return np.clip(mix, -32768, 32767).astype(np.int16)
+
+    for speech, bgm in input_windows:
+        window_tspan_in_ms = len(speech) * 1000 / frame_rate
+        window_dbfs = va.compute_window_dbfs(speech, frame_rate, window_tspan_in_ms, window_tspan_in_ms, 0, 1)
+        if va.get_measure_key(config):
+            window_dbfs = va.compute_voice_band_dbfs(window_dbfs, speech, frame_rate, window_tspan_in_ms,
+                                                     window_tspan_in_ms, 0, 1, config=config)
+        window_dbfs = window_dbfs[0]
+
+        # Same rules as find_a_silent_interval: a loud window ends the silence,
+        # a silence becomes a silent interval once it lasts silent_interval_tspan_threshold_in_ms
+        if window_dbfs > config.loudness_threshold:
+            silent_tspan_in_ms = 0
+            if target_gain != quiet_gain:
+                target_gain, step = quiet_gain, (quiet_gain - gain) / fade_out_frames
+        else:
+            silent_tspan_in_ms += config.downsampling_interval_in_ms
+            if silent_tspan_in_ms >= config.silent_interval_tspan_threshold_in_ms and target_gain != loud_gain:
+                target_gain, step = loud_gain, (loud_gain - gain) / fade_in_frames
+
+        held_windows.append((speech, bgm))
+        if len(held_windows) > lookahead_windows:
+            yield mix_oldest_window()
+
+    # End of the stream: nothing is left to look ahead at
+    while held_windows:
+        yield mix_oldest_window()
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Duck a live BGM under a live voice, raw 16-bit PCM in and out')
+    parser.add_argument('--speech', help='speech PCM file or pipe, default: speech and BGM interleaved on stdin')
+    parser.add_argument('--bgm', help='BGM PCM file or pipe, required together with --speech')
+    parser.add_argument('--speech-channels', type=int, default=1, help='channels of the speech')
+    parser.add_argument('--bgm-channels', type=int, default=2, help='channels of the BGM')
+    parser.add_argument('--frame-rate', type=int, default=live_frame_rate, help='frame rate of inputs and output')
+    parser.add_argument('--lookahead-ms', type=int, default=lookahead_in_ms, help='how long before the voice a duck starts')
+    args = parser.parse_args()
+    if (args.speech is None) != (args.bgm is None):
+        parser.error('--speech and --bgm go together')
+
+    config = va.get_mix_config()
+    window_frames = config.downsampling_interval_in_ms * args.frame_rate // 1000
+    speech_stream = open(args.speech, 'rb', buffering=0) if args.speech else sys.stdin.buffer
+    bgm_stream = open(args.bgm, 'rb', buffering=0) if args.bgm else None
+
+    input_windows = iter_live_windows(speech_stream, bgm_stream, args.speech_channels, args.bgm_channels, window_frames)
+    for mixed_window in duck_live(input_windows, args.frame_rate, config, args.lookahead_ms):
+        # Flush every window, a buffered stdout would add its own latency
+        sys.stdout.buffer.write(mixed_window.tobytes())
+        sys.stdout.buffer.flush()
+
+
+if __name__ == "__main__":
+    main()
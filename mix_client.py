@@ -0,0 +1,148 @@
+import argparse
+import http.client
+import json
+import socket
+import sys
+
+'''
+Client of the mix daemon:
+Submits jobs to mix_daemon.py, looks them up and reads its statistics, over its local port or its Unix socket.
+Paths are sent as they are and opened by the daemon, so give absolute ones unless both run in the same directory.
+Settings are the tuning variables of MixConfig, their values are parsed as JSON (--set loud_level=2.0).
+
+Usage:
+python mix_client.py submit speech.wav bgm.mp3 final.wav [--set loud_level=2.0] [--wait]
+python mix_client.py status 12 [--wait]
+python mix_client.py stats [--socket /tmp/mix_daemon.sock]
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+daemon_host = "127.0.0.1"  # Same defaults as mix_daemon.py, which is not imported to keep the client quick to start
+daemon_port = 8765
+request_timeout_in_s = 30  # Timeout of a request, on top of the time the daemon is asked to wait for a job
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''HTTPConnection over a Unix socket instead of TCP'''
+
+    def __init__(self, socket_path, timeout=request_timeout_in_s):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_daemon(method, path, body=None, port=None, socket_path=None, timeout=request_timeout_in_s):
+    '''
+    Send a request to the daemon on a local port or, with socket_path, on a Unix socket
+    Returns the HTTP status and the decoded JSON answer
+    '''
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection(daemon_host, port or daemon_port, timeout=timeout)
+    try:
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        connection.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    finally:
+        connection.close()
+
+
+def submit_job(speech, bgm, output, settings=None, port=None, socket_path=None):
+    '''Queue a mix job, returns the HTTP status and the job (or the error when the status is not 202)'''
+    job = {"speech": speech, "bgm": bgm, "output": output, "settings": settings or {}}
+    return request_daemon('POST', '/jobs', job, port, socket_path)
+
+
+def get_job(job_id, wait_in_s=0, port=None, socket_path=None):
+    '''Look a job up, after waiting up to wait_in_s seconds for it to finish'''
+    return request_daemon('GET', f'/jobs/{job_id}?wait={wait_in_s}', port=port, socket_path=socket_path,
+                          timeout=request_timeout_in_s + wait_in_s)
+
+
+def get_stats(port=None, socket_path=None):
+    '''Queue depth, job counts, latency percentiles and throughput of the daemon'''
+    return request_daemon('GET', '/stats', port=port, socket_path=socket_path)
+
+
+def wait_for_job(job_id, port=None, socket_path=None, poll_in_s=60):
+    '''Wait for a job to finish, however long it takes, and return its status and the job'''
+    while True:
+        status, job = get_job(job_id, poll_in_s, port, socket_path)
+        if status != 200 or job["status"] not in ('queued', 'running'):
+            return status, job
+
+
+def parse_settings(assignments):
+    '''Turn name=value assignments into settings, a value that is not JSON is kept as a string'''
+    settings = {}
+    for assignment in assignments:
+        name, separator, value = assignment.partition('=')
+        if not separator:
+            raise ValueError(f'Settings are given as name=value, not {assignment}')
+        try:
+            settings[name] = json.loads(value)
+        except json.JSONDecodeError:
+            settings[name] = value
+
+    return settings
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Submit mix jobs to mix_daemon.py and read its statistics')
+    parser.add_argument('--port', type=int, default=daemon_port, help='local TCP port of the daemon')
+    parser.add_argument('--socket', help='Unix socket of the daemon, instead of the TCP port')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = commands.add_parser('submit', help='queue a mix job')
+    submit_parser.add_argument('speech')
+    submit_parser.add_argument('bgm')
+    submit_parser.add_argument('output')
+    submit_parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                               help='override a tuning variable of MixConfig, can be repeated')
+    submit_parser.add_argument('--wait', action='store_true', help='wait for the job to finish')
+
+    status_parser = commands.add_parser('status', help='show a job')
+    status_parser.add_argument('job_id', type=int)
+    status_parser.add_argument('--wait', action='store_true', help='wait for the job to finish')
+
+    commands.add_parser('stats', help='show the queue depth, latency and throughput of the daemon')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        status, answer = submit_job(args.speech, args.bgm, args.output, parse_settings(args.set), args.port, args.socket)
+        if status == 202 and args.wait:
+            status, answer = wait_for_job(answer["id"], args.port, args.socket)
+    elif args.command == 'status':
+        if args.wait:
+            status, answer = wait_for_job(args.job_id, args.port, args.socket)
+        else:
+            status, answer = get_job(args.job_id, port=args.port, socket_path=args.socket)
+    else:
+        status, answer = get_stats(args.port, args.socket)
+
+    print(json.dumps(answer, indent=2))
+    if status >= 400 or answer.get("status") == 'failed':
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import argparse
+import collections
+import http.server
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+import numpy as np
+
+import audio_encoder
+import instrumentation
+import mixer
+import voice_avoidence as va
+
+'''
+Daemon mode:
+Every run of voice_avoidence.py pays for importing Python, NumPy and pydub, for starting ffmpeg and for decoding the BGM,
+although the jobs of a production pipeline arrive one after the other, mostly against the same few BGMs.
+The daemon starts once and accepts mix jobs over HTTP, on a local port or on a Unix socket, and never needs the network.
+A job gives the paths of the voice-over, the BGM and the output, and optionally overrides of the tuning variables.
+Jobs wait in a bounded queue, a submission is refused once it is full, and a fixed number of worker threads run them
+through a Mixer (see mixer.py) whose decoded BGMs stay in memory for the following jobs, whatever their settings.
+GET /stats reports the queue depth, the latency of the recent jobs and the throughput.
+
+Endpoints:
+POST /jobs           {"speech": ..., "bgm": ..., "output": ..., "settings": {"loud_level": 2.0}}, answers the job id
+GET  /jobs/<id>      the job and its timings, ?wait=<seconds> waits for it to finish first
+GET  /stats          queue depth, job counts, latency percentiles and throughput
+
+Usage:
+python mix_daemon.py [--port 8765 | --socket /tmp/mix_daemon.sock] [--workers 2] [--queue-size 64]
+python mix_client.py submit speech.wav bgm.mp3 final.wav --wait
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+daemon_host = "127.0.0.1"  # Only local clients can reach the daemon
+daemon_port = 8765
+daemon_workers = 2  # Jobs mixed at the same time
+daemon_queue_size = 64  # Jobs waiting at most, further submissions are refused until the queue drains
+daemon_bgm_cache_size = 8  # Decoded BGMs kept in memory, the least recently used ones are dropped
+daemon_job_history = 1000  # Finished jobs that can still be looked up, and over which the latency is reported
+throughput_window_in_s = 60  # Recent throughput is measured over the jobs finished in this last period
+
+logger = logging.getLogger('mix_daemon')
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def summarize_seconds(seconds):
+    '''Mean, median, 95th percentile and maximum of some durations, None without any'''
+    if not len(seconds):
+        return None
+
+    return {"mean": float(np.mean(seconds)), "p50": float(np.percentile(seconds, 50)),
+            "p95": float(np.percentile(seconds, 95)), "max": float(np.max(seconds))}
+
+
+class MixDaemon:
+    '''Job queue, worker threads and statistics of the daemon, independent of the transport the jobs arrive through'''
+
+    def __init__(self, workers=None, queue_size=None, bgm_cache_size=None):
+        self.workers = workers or daemon_workers
+        self.mixer = mixer.Mixer(bgm_cache_size=bgm_cache_size or daemon_bgm_cache_size)
+        self.queue = queue.Queue(maxsize=queue_size or daemon_queue_size)
+        self.jobs = collections.OrderedDict()
+        self.finished_jobs = collections.deque()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.job_finished = threading.Condition(self.lock)
+        self.next_job_id = 1
+        self.start_time = time.time()
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, request):
+        '''
+        Queue a job given as a dict with speech, bgm and output paths, and optional settings overriding the tuning variables
+        Returns the queued job; raises ValueError for an invalid job and queue.Full when the queue is full
+        '''
+        if not isinstance(request, dict) or not all(isinstance(request.get(key), str) for key in ("speech", "bgm", "output")):
+            raise ValueError('A job needs the speech, bgm and output paths')
+        settings = request.get("settings") or {}
+        try:
+            config = va.get_mix_config(**settings)
+        except TypeError:
+            raise ValueError(f'Unknown settings among {sorted(settings)}, see MixConfig for the available ones')
+
+        with self.lock:
+            job = {"id": self.next_job_id, "status": 'queued', "speech": request["speech"], "bgm": request["bgm"],
+                   "output": request["output"], "settings": settings, "submitted_at": time.time()}
+            try:
+                self.queue.put_nowait((job, config))
+            except queue.Full:
+                self.counts["rejected"] += 1
+                raise
+            self.next_job_id += 1
+            self.jobs[job["id"]] = job
+            self.counts["submitted"] += 1
+
+            return dict(job)
+
+    def work(self):
+        '''Worker thread: run the queued jobs one after the other, forever'''
+        while True:
+            job, config = self.queue.get()
+            with self.lock:
+                job.update(status='running', started_at=time.time())
+                self.counts["running"] += 1
+            try:
+                final_audio = self.mixer.with_config(config).mix(job["speech"], job["bgm"])
+                audio_encoder.export_audio(final_audio, job["output"], va.final_bitrate)
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+                logger.warning('Job %d failed:\n%s', job["id"], error)
+            self.finish(job, error)
+
+    def finish(self, job, error):
+        '''Record the outcome and the timings of a job, and wake up whoever waits for it'''
+        finished_at = time.time()
+        with self.lock:
+            job.update(status='failed' if error else 'done', error=error, finished_at=finished_at,
+                       queue_seconds=job["started_at"] - job["submitted_at"],
+                       run_seconds=finished_at - job["started_at"], latency_seconds=finished_at - job["submitted_at"])
+            self.counts["running"] -= 1
+            self.counts["failed" if error else "completed"] += 1
+            self.finished_jobs.append(job)
+
+            # Only the most recent finished jobs are kept
+            while len(self.finished_jobs) > daemon_job_history:
+                del self.jobs[self.finished_jobs.popleft()["id"]]
+            self.job_finished.notify_all()
+        instrumentation.record_metrics('mix_daemon_job', job_id=job["id"], ok=error is None,
+                                       queue_seconds=job["queue_seconds"], run_seconds=job["run_seconds"])
+
+    def get_job(self, job_id, wait_in_s=0):
+        '''A copy of a job, after waiting up to wait_in_s seconds for it to finish, or None for an unknown job'''
+        deadline = time.time() + wait_in_s
+        with self.lock:
+            while job_id in self.jobs and self.jobs[job_id]["status"] in ('queued', 'running'):
+                remaining_in_s = deadline - time.time()
+                if remaining_in_s <= 0:
+                    break
+                self.job_finished.wait(remaining_in_s)
+            job = self.jobs.get(job_id)
+
+            return dict(job) if job else None
+
+    def get_stats(self):
+        '''Queue depth, job counts, latency percentiles of the recent jobs and throughput'''
+        now = time.time()
+        with self.lock:
+            finished_jobs = list(self.finished_jobs)
+            counts = dict(self.counts)
+            cached_bgms = len(self.mixer.decoded_bgms)
+        uptime_in_s = now - self.start_time
+        recent_jobs = [job for job in finished_jobs if job["finished_at"] >= now - throughput_window_in_s]
+
+        return {
+            "uptime_seconds": uptime_in_s,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "running": counts.get("running", 0),
+            "submitted": counts.get("submitted", 0),
+            "completed": counts.get("completed", 0),
+            "failed": counts.get("failed", 0),
+            "rejected": counts.get("rejected", 0),
+            "cached_bgms": cached_bgms,
+            "throughput_jobs_per_second": (counts.get("completed", 0) + counts.get("failed", 0)) / uptime_in_s,
+            "recent_throughput_jobs_per_second": len(recent_jobs) / min(throughput_window_in_s, uptime_in_s),
+            "latency_seconds": summarize_seconds([job["latency_seconds"] for job in finished_jobs]),
+            "queue_seconds": summarize_seconds([job["queue_seconds"] for job in finished_jobs]),
+            "run_seconds": summarize_seconds([job["run_seconds"] for job in finished_jobs]),
+        }
+
+
+class MixRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''HTTP front of a MixDaemon, which the server holds as mix_daemon'''
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != '/jobs':
+            return self.send_json(404, {"error": f'No such endpoint: {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+            job = self.server.mix_daemon.submit(request)
+        except ValueError as error:
+            return self.send_json(400, {"error": str(error)})
+        except queue.Full:
+            return self.send_json(503, {"error": 'The job queue is full, retry later'})
+
+        self.send_json(202, job)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/stats':
+            return self.send_json(200, self.server.mix_daemon.get_stats())
+
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+            return self.send_json(404, {"error": f'No such endpoint: {self.path}'})
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            wait_in_s = float(query.get('wait', ['0'])[0])
+        except ValueError:
+            return self.send_json(400, {"error": 'wait must be a number of seconds'})
+        job = self.server.mix_daemon.get_job(int(parts[1]), wait_in_s)
+        if job is None:
+            return self.send_json(404, {"error": f'No such job: {parts[1]}'})
+
+        self.send_json(200, job)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''HTTP server on a Unix socket, with a thread per connection like http.server.ThreadingHTTPServer'''
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address, a Unix socket has none
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def create_server(mix_daemon, port=None, socket_path=None):
+    '''HTTP server of a MixDaemon on a local TCP port (0 picks a free one) or, with socket_path, on a Unix socket'''
+    if socket_path:
+        if os.path.exists(socket_path):
+            # A socket left over by a daemon that did not shut down cleanly
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, MixRequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((daemon_host, daemon_port if port is None else port), MixRequestHandler)
+    server.mix_daemon = mix_daemon
+
+    return server
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run mix jobs submitted over a local HTTP port or Unix socket')
+    parser.add_argument('--port', type=int, default=daemon_port, help=f'local TCP port, {daemon_host} only')
+    parser.add_argument('--socket', help='listen on this Unix socket instead of the TCP port')
+    parser.add_argument('--workers', type=int, default=daemon_workers, help='jobs mixed at the same time')
+    parser.add_argument('--queue-size', type=int, default=daemon_queue_size, help='jobs waiting at most')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if va.metrics_path:
+        instrumentation.set_metrics_sink(instrumentation.json_lines_sink(va.metrics_path))
+    server = create_server(MixDaemon(args.workers, args.queue_size), args.port, args.socket)
+    logger.info('Listening on %s with %d workers', args.socket or f'{daemon_host}:{server.server_address[1]}',
+                args.workers)
+    # Stopped by a service manager, shut down like on Ctrl+C so that the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import collections
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+from pydub import AudioSegment
+
+import format_normalizer
+import instrumentation
+import voice_avoidence as va
+
+'''
+In-process mixing API:
+final_mix reads its settings from the module-level variables of voice_avoidence and works on files,
+so a service that mixes with different settings at the same time would have to start a process per job.
+A Mixer holds one immutable MixConfig and mixes audio given as paths, bytes or arrays into an AudioSegment in memory,
+without reading or changing any module-level variable and without writing any file.
+Mixers can therefore run concurrently from threads, each with its own settings,
+and a long-lived Mixer keeps its recently used BGMs decoded between requests, and converted to the format of the mix,
+so that mixing against the same BGM again costs neither the decoding nor the conversion.
+
+Usage:
+mixer = Mixer(va.get_mix_config(loud_level=2.0, quiet_level=-8))
+final_audio = mixer.mix("speech.wav", bgm_bytes)
+'''
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def load_audio(source, frame_rate=None):
+    '''
+    Load audio given as an AudioSegment, a file path, the bytes of an audio file,
+    or a (frames,) or (frames, channels) integer NumPy array of PCM, which needs its frame_rate
+    '''
+    if isinstance(source, AudioSegment):
+        return source
+
+    if isinstance(source, (str, os.PathLike)):
+        return AudioSegment.from_file(os.fspath(source))
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # WAV is read by pydub itself, anything else goes through ffmpeg
+        audio_format = 'wav' if bytes(source[:4]) == b'RIFF' else None
+        return AudioSegment.from_file(io.BytesIO(source), format=audio_format)
+
+    if isinstance(source, np.ndarray):
+        if frame_rate is None:
+            raise ValueError('PCM arrays need a frame_rate')
+        if source.dtype not in (np.int8, np.int16, np.int32):
+            raise ValueError(f'PCM arrays must hold 8, 16 or 32-bit integers, not {source.dtype}')
+        samples = source.reshape(len(source), -1)
+        return AudioSegment(data=np.ascontiguousarray(samples).tobytes(), sample_width=samples.dtype.itemsize,
+                            frame_rate=frame_rate, channels=samples.shape[1])
+
+    raise TypeError(f'Cannot load audio from {type(source).__name__}')
+
+
+def get_bgm_cache_key(source):
+    '''Key of a BGM in the in-memory cache of a Mixer: the file identity of a path, the content hash of bytes'''
+    if isinstance(source, (str, os.PathLike)):
+        stat = os.stat(source)
+        return 'path', os.path.abspath(source), stat.st_mtime_ns, stat.st_size
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return 'bytes', hashlib.sha256(source).hexdigest()
+
+    # Arrays and AudioSegments are already decoded
+    return None
+
+
+class Mixer:
+    '''Mix voice-overs with BGMs in memory, all with the same MixConfig'''
+
+    def __init__(self, config=None, bgm_cache_size=4):
+        # Without a config, the module-level variables are read once, here
+        self.config = config or va.get_mix_config()
+        self.bgm_cache_size = bgm_cache_size
+        self.decoded_bgms = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def with_config(self, config):
+        '''A Mixer with other settings that shares the decoded BGMs of this one, e.g. for a job with its own overrides'''
+        mixer = Mixer(config, self.bgm_cache_size)
+        mixer.decoded_bgms, mixer.lock = self.decoded_bgms, self.lock
+
+        return mixer
+
+    def load_bgm(self, bgm, frame_rate=None, bgm_format=None):
+        '''
+        Load a BGM, from the in-memory cache when the same file or bytes were mixed recently
+        With bgm_format, a (frame_rate, channels, sample_width) tuple, the BGM is converted to it from the decoded BGM,
+        and cached converted next to it
+        '''
+        if bgm_format is not None:
+            decoded_bgm = self.load_bgm(bgm, frame_rate)
+            if format_normalizer.get_audio_format(decoded_bgm) == tuple(bgm_format):
+                return decoded_bgm
+
+        key = get_bgm_cache_key(bgm)
+        if key is None:
+            if bgm_format is None:
+                return load_audio(bgm, frame_rate)
+            return format_normalizer.normalize_audio(decoded_bgm, *bgm_format, track_name='bgm')
+        if bgm_format is not None:
+            key += tuple(bgm_format),
+
+        with self.lock:
+            if key in self.decoded_bgms:
+                self.decoded_bgms.move_to_end(key)
+                return self.decoded_bgms[key]
+
+        # Decode or convert outside of the lock, so other mixes do not wait for it
+        if bgm_format is None:
+            decoded_bgm = load_audio(bgm, frame_rate)
+        else:
+            decoded_bgm = format_normalizer.normalize_audio(decoded_bgm, *bgm_format, track_name='bgm')
+        with self.lock:
+            self.decoded_bgms[key] = decoded_bgm
+            while len(self.decoded_bgms) > self.bgm_cache_size:
+                self.decoded_bgms.popitem(last=False)
+
+        return decoded_bgm
+
+    def mix(self, speech, bgm, frame_rate=None):
+        '''
+        Run every step of final_mix and return the mixed audio as an AudioSegment, va.audio_to_array turns it into an array
+        frame_rate is only needed for inputs given as arrays
+        '''
+        config = self.config
+        speech = load_audio(speech, frame_rate)
+        decoded_bgm = self.load_bgm(bgm, frame_rate)
+
+        # The BGM is converted to the format of the mix once, the following mixes against it reuse it converted
+        bgm_format = va.get_track_format(decoded_bgm, va.get_mix_format([speech, decoded_bgm], config))
+        with instrumentation.measure_stage('normalize_bgm'):
+            bgm = self.load_bgm(bgm, frame_rate, bgm_format)
+
+        # Step 1: Add the silences at the beginning and the end
+        adjusted_speech, adjusted_tspan_in_ms = va.pad_speech_audio(speech, config)
+
+        # Steps 2 to 4: Detect the silent intervals and determine the fade-in and fade-out points
+        loudness_envelope = va.create_loudness_envelope(adjusted_speech, config)
+        silent_intervals = va.find_silent_intervals(va.binarize_loudness_envelope(loudness_envelope, config),
+                                                    adjusted_tspan_in_ms, config=config)
+        fade_ins, fade_outs = va.get_fade_ins_and_outs(va.create_silent_interval_dict(silent_intervals), config)
+
+        # Steps 5 and 6: Mix and fade out at the end, in one pass
+        return va.mix_speech_with_bgm(adjusted_speech, bgm, fade_ins, fade_outs, config, fade_out_at_end=True)
@@ -0,0 +1,294 @@
+import itertools
+import math
+import subprocess
+import wave
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo
+
+import audio_encoder
+import instrumentation
+import voice_avoidence as va
+
+'''
+Streaming mode:
+final_mix keeps the whole voice-over, the whole BGM and the whole mix in memory, which takes gigabytes for multi-hour audiobooks.
+The streaming mode reads the voice-over and the BGM in blocks of frames_per_block frames and writes the mix block by block,
+so the peak memory depends on the block size and not on the length of the input.
+It makes two passes over the voice-over: a detection pass, then a rendering pass together with the BGM.
+Two passes are needed because every fade changes the BGM gain over the whole timeline (see render_gain_curve),
+so the rendering needs the complete list of fades before the first block is written.
+The output matches final_mix as long as the BGM has the same frame rate as the voice-over.
+Otherwise the BGM is resampled first, by format_normalizer.py when the decoded BGM cache is enabled and by ffmpeg when it is not.
+The mix has the format of the voice-over, so the mix format settings (va.mix_frame_rate and so on) are not supported.
+A final_path ending in .flac, .opus or .mp3 is encoded block by block as the mix is rendered (see audio_encoder.py).
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+frames_per_block = 1 << 18  # Number of frames read, mixed and written at a time, about 6 seconds at 44.1 kHz
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def wav_bytes_to_array(data, sample_width, channels):
+    '''Convert raw WAV frames into a (frames, channels) array, with the same sample values pydub uses after loading'''
+    if sample_width == 1:
+        # 8-bit WAV is unsigned, pydub shifts it to signed
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128).astype(np.int8)
+    elif sample_width == 3:
+        # pydub widens 24-bit samples to 32-bit by prepending a padding byte, 0xFF for negative samples
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = (raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24) | np.where(raw[:, 2] > 0x7f, 0xff, 0)
+    else:
+        samples = np.frombuffer(data, dtype={2: np.int16, 4: np.int32}[sample_width])
+
+    return samples.reshape(-1, channels)
+
+
+def convert_samples(samples, channels, sample_width):
+    '''Widen samples to more channels or a larger sample width, the same way AudioSegment overlay and concatenation do'''
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sample_width]
+
+    # audioop.lin2lin keeps the most significant bytes, i.e. shifts the samples left
+    if samples.dtype != dtype:
+        samples = samples.astype(dtype) << (8 * (sample_width - samples.dtype.itemsize))
+
+    # A mono track is copied to every channel
+    if samples.shape[1] != channels:
+        samples = np.repeat(samples, channels, axis=1)
+
+    return samples
+
+
+def iter_wav_blocks(path, block_frames):
+    '''Read a WAV file block by block'''
+    with wave.open(path, 'rb') as wav:
+        sample_width, channels = wav.getsampwidth(), wav.getnchannels()
+        while True:
+            data = wav.readframes(block_frames)
+            if not data:
+                break
+            yield wav_bytes_to_array(data, sample_width, channels)
+
+
+def iter_decoded_blocks(path, frame_rate, channels, block_frames):
+    '''Decode any file ffmpeg can read into 16-bit PCM at the given format, block by block, through a pipe'''
+    command = [AudioSegment.converter, '-v', 'error', '-i', path,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(frame_rate), '-ac', str(channels), '-']
+    frame_width = 2 * channels
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        while True:
+            data = process.stdout.read(block_frames * frame_width)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % frame_width], dtype=np.int16).reshape(-1, channels)
+        stderr = process.stderr.read()
+
+    if process.returncode != 0:
+        raise CouldntDecodeError(f'Decoding failed. ffmpeg returned error code: {process.returncode}\n\n{stderr.decode()}')
+
+
+def rechunk(blocks, block_frames):
+    '''Regroup a stream of sample blocks of any size into blocks of exactly block_frames frames (the last one may be shorter)'''
+    pending = []
+    pending_frames = 0
+    for block in blocks:
+        pending.append(block)
+        pending_frames += len(block)
+        while pending_frames >= block_frames:
+            merged = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield merged[:block_frames]
+            pending = [merged[block_frames:]]
+            pending_frames -= block_frames
+    if pending_frames:
+        yield np.concatenate(pending)
+
+
+def get_adjusted_speech_layout(speech_path):
+    '''
+    Work out the format and the frame layout of the adjusted voice-over without loading it
+    The silences of create_adjust_speech_audio are 16-bit mono at 11025 Hz, and concatenation settles on the widest format,
+    so the padding lengths are measured on silences converted the same way (see va.get_padding_frames)
+    '''
+    with wave.open(speech_path, 'rb') as speech:
+        frame_rate, channels, speech_frames = speech.getframerate(), speech.getnchannels(), speech.getnframes()
+        # pydub loads 24-bit audio as 32-bit
+        sample_width = 4 if speech.getsampwidth() == 3 else speech.getsampwidth()
+
+    silence = AudioSegment.silent(duration=0)
+    if frame_rate < silence.frame_rate:
+        raise ValueError(f'Streaming mode needs a voice-over of at least {silence.frame_rate} Hz, got {frame_rate} Hz')
+    opening_frames, closing_frames = va.get_padding_frames(frame_rate)
+
+    layout = {
+        "frame_rate": frame_rate,
+        "channels": channels,
+        "sample_width": max(sample_width, silence.sample_width),
+        "opening_frames": opening_frames,
+        "speech_frames": speech_frames,
+        "closing_frames": closing_frames,
+    }
+    layout["frame_count"] = layout["opening_frames"] + layout["speech_frames"] + layout["closing_frames"]
+
+    return layout
+
+
+def iter_adjusted_speech_blocks(speech_path, layout, block_frames):
+    '''Read the adjusted voice-over block by block, the opening and closing silences are generated on the fly'''
+    dtype = {2: np.int16, 4: np.int32}[layout["sample_width"]]
+
+    def pieces():
+        yield np.zeros((layout["opening_frames"], layout["channels"]), dtype=dtype)
+        for block in iter_wav_blocks(speech_path, block_frames):
+            yield convert_samples(block, layout["channels"], layout["sample_width"])
+        yield np.zeros((layout["closing_frames"], layout["channels"]), dtype=dtype)
+
+    return rechunk(pieces(), block_frames)
+
+
+def iter_bgm_blocks(bgm_path, frame_rate, channels, block_frames, frame_count=None):
+    '''
+    Read the BGM block by block at the frame rate of the voice-over
+    With the decoded BGM cache enabled the blocks are sliced from the memory-mapped PCM,
+    otherwise a WAV file at that frame rate is read directly and anything else is decoded and resampled by ffmpeg
+    With fit_bgm_to_speech, the BGM is looped or trimmed to frame_count frames
+    '''
+    if va.fit_bgm_to_speech and frame_count is not None:
+        # The loop is indexed from one decoded copy of the BGM, memory-mapped when the decoded BGM cache is enabled
+        samples = va.audio_to_array(va.load_bgm_audio(bgm_path, frame_rate=frame_rate))
+        crossfade_frames = int(va.bgm_loop_crossfade_in_ms * (frame_rate / 1000.0))
+        return (va.loop_bgm_block(samples, first_frame, min(first_frame + block_frames, frame_count), crossfade_frames)
+                for first_frame in range(0, frame_count, block_frames))
+
+    if va.use_bgm_cache:
+        bgm = va.load_bgm_audio(bgm_path, frame_rate=frame_rate)
+        samples = va.audio_to_array(bgm)
+        return (samples[first_frame:first_frame + block_frames] for first_frame in range(0, len(samples), block_frames))
+
+    if bgm_path.lower().endswith('.wav'):
+        with wave.open(bgm_path, 'rb') as bgm:
+            bgm_frame_rate = bgm.getframerate()
+        if bgm_frame_rate == frame_rate:
+            return iter_wav_blocks(bgm_path, block_frames)
+
+    bgm_channels = int(mediainfo(bgm_path).get('channels', channels))
+    return rechunk(iter_decoded_blocks(bgm_path, frame_rate, max(bgm_channels, channels), block_frames), block_frames)
+
+
+def detect_fades_streaming(speech_path, layout, block_frames):
+    '''Detection pass: stream the adjusted voice-over through the loudness envelope and the silent interval search'''
+    adjusted_tspan_in_ms = round(1000 * (layout["frame_count"] / layout["frame_rate"]))
+    envelope_blocks = va.stream_loudness_envelope(iter_adjusted_speech_blocks(speech_path, layout, block_frames),
+                                                  layout["frame_rate"], layout["frame_count"])
+
+    if va.use_analysis_cache or va.loudness_detector != 'threshold':
+        # The envelope is small (one value per downsampling window), so it is collected whole to be cached,
+        # or for the hysteresis, whose burst filter looks at the silences on both sides of a burst
+        silent_intervals = va.detect_silent_intervals(adjusted_tspan_in_ms,
+                                                      lambda: np.concatenate(list(envelope_blocks)),
+                                                      source_path=speech_path)
+    else:
+        loudness_mask_blocks = (va.binarize_loudness_envelope(envelope) for envelope in envelope_blocks)
+        silent_intervals = list(va.stream_silent_intervals(loudness_mask_blocks, adjusted_tspan_in_ms))
+
+    return va.get_fade_ins_and_outs(va.create_silent_interval_dict(silent_intervals))
+
+
+def render_mix_blocks(speech_path, bgm_path, layout, fade_ins, fade_outs, block_frames):
+    '''
+    Rendering pass: yield the mixed audio block by block, with the BGM gain automation, the final fade-out and the peak limiter
+    applied the same way as voice_avoidence.render_mix
+    '''
+    frame_rate = layout["frame_rate"]
+    starting_volume = va.determine_starting_volume(fade_ins, fade_outs)
+    gain_automation = va.get_gain_automation(fade_ins, fade_outs)
+    end_fade = va.get_end_fade(layout["frame_count"], frame_rate)
+
+    speech_blocks = iter_adjusted_speech_blocks(speech_path, layout, block_frames)
+    bgm_source = iter_bgm_blocks(bgm_path, frame_rate, layout["channels"], block_frames, layout["frame_count"])
+
+    # The first BGM block settles the format of the mix, which stays the same after the BGM runs out
+    first_bgm_block = next(bgm_source, np.zeros((0, 1), dtype=np.int16))
+    bgm_blocks = itertools.chain([first_bgm_block], bgm_source)
+    channels = max(layout["channels"], first_bgm_block.shape[1])
+    sample_width = max(layout["sample_width"], first_bgm_block.dtype.itemsize)
+
+    def mix_blocks():
+        first_frame = 0
+        for speech_block in speech_blocks:
+            # Overlay: both tracks are widened to the larger format and summed as floats, the limiter replaces the clipping
+            mix_block = convert_samples(speech_block, channels, sample_width).astype(np.float64)
+
+            # The BGM may be shorter than the voice-over, in which case the rest of the voice-over plays alone
+            bgm_block = next(bgm_blocks, first_bgm_block[:0])[:len(speech_block)]
+            if len(bgm_block):
+                # The length of the BGM is not known up front, which is fine: fades past its end never touch existing frames
+                gain_curve = va.render_gain_curve(gain_automation, starting_volume, frame_rate, math.inf,
+                                                  first_frame, first_frame + len(bgm_block))
+                bgm_block = convert_samples(bgm_block, channels, sample_width)
+                mix_block[:len(bgm_block)] += np.floor(bgm_block * gain_curve[:, np.newaxis])
+            va.apply_end_fade(mix_block, first_frame, frame_rate, end_fade)
+            yield mix_block
+            first_frame += len(speech_block)
+
+        # Stop decoding the rest of a BGM that is longer than the voice-over
+        bgm_source.close()
+
+    return va.limit_peaks(mix_blocks(), {1: np.int8, 2: np.int16, 4: np.int32}[sample_width], frame_rate)
+
+
+def final_mix_streaming(bgm_path, block_frames=None):
+    '''Generate the same mixed audio file as final_mix, with memory bounded by the block size'''
+    block_frames = block_frames or frames_per_block
+    if va.speech_stems:
+        raise ValueError('Voice stems (speech_stems) are only mixed by voice_avoidence.final_mix')
+    if (va.mix_frame_rate, va.mix_channels, va.mix_sample_width) != (None, None, None):
+        raise ValueError('The mix format (mix_frame_rate, mix_channels, mix_sample_width) is only applied by '
+                         'voice_avoidence.final_mix')
+
+    # Step 1: Work out the layout of the adjusted voice-over from the WAV header
+    layout = get_adjusted_speech_layout(va.speech_path)
+
+    # Steps 2 to 4: Detect the silent intervals and determine the fade-in and fade-out points
+    with instrumentation.measure_stage('detection_pass'):
+        fade_ins, fade_outs = detect_fades_streaming(va.speech_path, layout, block_frames)
+    instrumentation.record_metrics('get_fade_ins_and_outs', fade_ins=len(fade_ins), fade_outs=len(fade_outs))
+
+    # Steps 5 and 6: Mix, fade out at the end and write the output block by block
+    with instrumentation.measure_stage('rendering_pass'):
+        mix_blocks = render_mix_blocks(va.speech_path, bgm_path, layout, fade_ins, fade_outs, block_frames)
+        first_block = next(mix_blocks)
+        peak_block_bytes = first_block.nbytes
+
+        # A compressed output is encoded by ffmpeg in parallel, while the next blocks are being mixed
+        with audio_encoder.open_audio_writer(va.final_path, layout["frame_rate"], first_block.shape[1],
+                                             first_block.dtype.itemsize, va.final_bitrate) as write:
+            write(first_block.tobytes())
+            for mix_block in mix_blocks:
+                write(mix_block.tobytes())
+                peak_block_bytes = max(peak_block_bytes, mix_block.nbytes)
+    instrumentation.record_metrics('rendering_pass', block_frames=block_frames, peak_block_bytes=peak_block_bytes)
+
+
+##############################################################################
+# Execute the function
+##############################################################################
+
+
+def main():
+    if va.metrics_path:
+        instrumentation.set_metrics_sink(instrumentation.json_lines_sink(va.metrics_path))
+    final_mix_streaming(va.bgm_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import wave
+
+import numpy as np
+
+'''
+Synthetic audio for the benchmarks:
+Speech-like bursts separated by pauses, and a BGM made of a few sustained chords, generated offline so that the benchmarks
+need no audio files and give the same input on every machine.
+The audio is generated block by block, so hours of it can be written to disk without holding them in memory.
+'''
+
+
+##############################################################################
+# Define variables
+##############################################################################
+
+synthesis_block_in_s = 60  # Length of the blocks the audio is generated in
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def get_speech_bursts(tspan_in_s, pauses_per_minute, rng):
+    '''
+    Plan the bursts of the voice-over as (start_in_s, end_in_s, amplitude, syllables_per_s), separated by pauses of 0.3 to 3 s
+    One burst plus one pause lasts 60 / pauses_per_minute seconds on average
+    '''
+    cycle_in_s = 60 / pauses_per_minute if pauses_per_minute else tspan_in_s
+    bursts = []
+    position_in_s = 0.0
+    while position_in_s < tspan_in_s:
+        pause_in_s = rng.uniform(0.3, 3.0)
+        burst_in_s = max(cycle_in_s - pause_in_s, 0.3) * rng.uniform(0.5, 1.5)
+        bursts.append((position_in_s, position_in_s + burst_in_s, rng.uniform(0.2, 0.6), rng.uniform(3, 6)))
+        position_in_s += burst_in_s + pause_in_s
+
+    return np.array(bursts)
+
+
+def iter_block_times(tspan_in_s, frame_rate):
+    '''Yield the index and the frame times in seconds of every synthesis block, in float64 so that hours keep their precision'''
+    frame_count = int(tspan_in_s * frame_rate)
+    block_frames = synthesis_block_in_s * frame_rate
+    for block_index, first_frame in enumerate(range(0, frame_count, block_frames)):
+        yield block_index, np.arange(first_frame, min(first_frame + block_frames, frame_count)) / frame_rate
+
+
+def synthesize_speech(tspan_in_s, frame_rate=44100, pauses_per_minute=10, seed=0):
+    '''
+    Synthesize a mono 16-bit voice-over block by block: syllable-modulated harmonic bursts separated by pauses
+    pauses_per_minute sets how often the speaker stops, i.e. how many silent intervals the detection will find
+    '''
+    rng = np.random.default_rng(seed)
+    bursts = get_speech_bursts(tspan_in_s, pauses_per_minute, rng)
+    pitch = 2 * np.pi * rng.uniform(100, 220)
+
+    for block_index, time_in_s in iter_block_times(tspan_in_s, frame_rate):
+        # Syllable envelope of the bursts that overlap this block, zero during the pauses
+        envelope = np.zeros(len(time_in_s))
+        first_burst = np.searchsorted(bursts[:, 1], time_in_s[0], side='right')
+        last_burst = np.searchsorted(bursts[:, 0], time_in_s[-1], side='right')
+        for start_in_s, end_in_s, amplitude, syllables_per_s in bursts[first_burst:last_burst]:
+            inside = slice(np.searchsorted(time_in_s, start_in_s), np.searchsorted(time_in_s, end_in_s))
+            envelope[inside] = amplitude * np.abs(np.sin(np.pi * syllables_per_s * (time_in_s[inside] - start_in_s)))
+
+        # A voice-like harmonic tone with some breath noise, and a faint noise floor in the pauses
+        block_rng = np.random.default_rng((seed, block_index))
+        phase = np.mod(pitch * time_in_s, 2 * np.pi)
+        tone = (np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)) / 1.75
+        speech = envelope * (tone + 0.1 * block_rng.standard_normal(len(time_in_s)))
+        speech += 0.001 * block_rng.standard_normal(len(time_in_s))
+
+        yield (np.clip(speech, -1, 1) * 32767).astype(np.int16).reshape(-1, 1)
+
+
+def synthesize_bgm(tspan_in_s, frame_rate=44100, channels=2, seed=1):
+    '''Synthesize a 16-bit BGM block by block: a progression of sustained triads, one every 2 seconds'''
+    rng = np.random.default_rng(seed)
+    chord_count = int(tspan_in_s // 2) + 1
+    roots = 110 * 2 ** (rng.integers(0, 12, chord_count) / 12)
+    thirds = 2 ** (rng.choice([3, 4], chord_count) / 12)
+
+    for _, time_in_s in iter_block_times(tspan_in_s, frame_rate):
+        chords = (time_in_s // 2).astype(np.int64)
+        bgm = np.zeros(len(time_in_s))
+        for ratios in (1, thirds[chords], 2 ** (7 / 12)):
+            bgm += np.sin(np.mod(2 * np.pi * roots[chords] * ratios * time_in_s, 2 * np.pi)) / 3
+
+        yield np.repeat((bgm * 0.5 * 32767).astype(np.int16).reshape(-1, 1), channels, axis=1)
+
+
+def write_wav(path, sample_blocks, frame_rate):
+    '''Write (frames, channels) 16-bit blocks as a WAV file'''
+    with wave.open(path, 'wb') as wav:
+        wav.setsampwidth(2)
+        wav.setframerate(frame_rate)
+        for block_index, samples in enumerate(sample_blocks):
+            if block_index == 0:
+                wav.setnchannels(samples.shape[1])
+            wav.writeframes(samples.tobytes())
@@ -1,5 +1,19 @@
+import concurrent.futures
+import dataclasses
+import functools
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
 from pydub import AudioSegment
 
+import analysis_cache
+import audio_encoder
+import bgm_cache
+import format_normalizer
+import instrumentation
+import wav_reader
+
 '''
 Basic explanation:
 The program will scan the entire audio by default at intervals of 0.02 seconds. (Downsampling mode)
@@ -15,7 +29,7 @@ Operational tips:
 All the parameters mentioned above can be set, but the default values can cope with most situations.
 Only loud_level and quiet_level need to be set for each song, because the average volume of different songs varies greatly. See below for details.
 2. 
-The prints starting with "Debug:..." can be deleted without affecting the function.
+Timings and counts of every step are reported through instrumentation.py, set metrics_path to collect them in a file.
 3. 
 Pay attention to the audio format of the input and output. By default, the bgm is MP3, and the original voice-over and the output mix are WAV. 
 If there is any change, please be sure to set the corresponding format for AudioSegment.
@@ -43,27 +57,171 @@ quiet_level = -6.8  # bgm intensity within the non-silent segment, voice avoided
 fade_in_tspan_in_ms = 700  # Duration required to switch from quiet_level to loud_level
 fade_out_tspan_in_ms = 800  # Definition opposite to the above
 
+# Noise-robust detection on the float loudness envelope (see binarize_with_hysteresis), for recordings with ambient noise:
+# "threshold" is the plain loudness_threshold binarization, "hysteresis" adds the settings below
+loudness_detector = "threshold"
+loudness_release_threshold = -26  # A loud stretch starts above loudness_threshold and only ends below this loudness
+loudness_smoothing_in_ms = 0  # Moving average of the loudness envelope before the thresholds, 0 to disable
+min_gap_in_ms = 200  # Silences shorter than this between two loud stretches are bridged
+min_burst_in_ms = 100  # Loud bursts shorter than this (a cough, a chair creak) are ignored...
+burst_guard_silence_in_ms = 800  # ...when they have at least this much silence on both sides
+# What the detection measures in every window (see compute_voice_band_dbfs): "broadband" is the dBFS of the whole window,
+# "voice_band" only the part of it in the speech band, so low-frequency rumble or music bleed in the voice-over track
+# no longer holds the loudness above the thresholds; it leaves out the energy outside the band, so it reads lower than the
+# broadband dBFS and loudness_threshold may need lowering by a few dB
+loudness_measure = "broadband"
+voice_band_low_in_hz = 300
+voice_band_high_in_hz = 3400
+# Coarse-to-fine scan (see scan_window_dbfs): windows inside coarse windows of this length whose peak is below the
+# loudness threshold are skipped, since they cannot be loud; 0 computes every window
+coarse_scan_interval_in_ms = 0
+# Processes computing the loudness envelope of long voice-overs (see compute_window_dbfs_parallel), 1 for this process only
+envelope_workers = 1
+
+# Loop a bgm shorter than the voice-over, and trim a longer one, to exactly the length of the mix
+fit_bgm_to_speech = False
+bgm_loop_crossfade_in_ms = 2000  # Crossfade where the looped bgm starts over
+
+# Lookahead peak limiter at the end of the mix (see limit_peaks), instead of hard clipping where loud speech meets the
+# boosted bgm: the peaks of the mix never exceed limiter_ceiling_in_dbfs, and the mix below it is left untouched
+limiter_ceiling_in_dbfs = 0.0
+limiter_lookahead_in_ms = 5  # The gain starts going down this long before a peak...
+limiter_release_in_ms = 50  # ...and stays down this long after it, before going back up
+
+# Format every track is converted to before the mix (see format_normalizer.py), None for the largest among the tracks;
+# frame rates are converted by a polyphase resampler, and the BGM is kept converted by the decoded BGM cache and by a Mixer
+mix_frame_rate = None
+mix_channels = None
+mix_sample_width = None
+
 # File paths, please set according to your needs
 speech_path = "speech.wav"  # Voice path
 bgm_path = "bgm.mp3"  # bgm path
+# Separate voice stems driving one bgm (e.g. the host and the guest of an interview, a sound-effects track),
+# used instead of speech_path when not empty; each entry is a path, or a (path, loudness_threshold) pair for its own threshold
+speech_stems = []
 final_path = "final.wav"  # Output path for the mixed voice + bgm audio (default .wav) 
+# .flac, .opus and .mp3 output paths are encoded on the fly by ffmpeg (see audio_encoder.py), at this bitrate for Opus and MP3
+final_bitrate = "192k"
+
+# Keep the decoded bgm in bgm_cache_dir (see bgm_cache.py), so the same bgm is not decoded again on the next run
+use_bgm_cache = False
+# Keep the loudness envelope and the silent intervals in analysis_cache_dir (see analysis_cache.py),
+# so mixing the same voice-over again with other levels or fades skips the detection
+use_analysis_cache = False
+# Memory-map a 16 or 32-bit PCM voice-over instead of reading it (see wav_reader.py), with the opening and closing silences
+# as offsets rather than zeros, so loading takes no time and only the frames a step touches are read
+memory_map_speech = True
+# Append the timing and the counts of every step as JSON lines to this file (see instrumentation.py), None to disable
+metrics_path = None
 
 
 ##############################################################################
 # Define functions
 ##############################################################################
 
-def create_adjust_speech_audio():
+@dataclasses.dataclass(frozen=True)
+class MixConfig:
+    '''
+    Immutable set of the tuning parameters above, so that mixes with different settings can run side by side
+    Every function that depends on the tuning takes an optional config, and falls back to the module-level variables without it
+    '''
+    speech_audio_opening_silence: float
+    speech_audio_closing_silence: float
+    fade_out_tspan_at_the_end: float
+    downsampling_interval_in_ms: int
+    loudness_threshold: float
+    silent_interval_tspan_threshold_in_ms: int
+    loud_level: float
+    quiet_level: float
+    fade_in_tspan_in_ms: int
+    fade_out_tspan_in_ms: int
+    loudness_detector: str
+    loudness_release_threshold: float
+    loudness_smoothing_in_ms: int
+    min_gap_in_ms: int
+    min_burst_in_ms: int
+    burst_guard_silence_in_ms: int
+    loudness_measure: str
+    voice_band_low_in_hz: float
+    voice_band_high_in_hz: float
+    coarse_scan_interval_in_ms: int
+    envelope_workers: int
+    fit_bgm_to_speech: bool
+    bgm_loop_crossfade_in_ms: int
+    limiter_ceiling_in_dbfs: float
+    limiter_lookahead_in_ms: int
+    limiter_release_in_ms: int
+    mix_frame_rate: Optional[int]
+    mix_channels: Optional[int]
+    mix_sample_width: Optional[int]
+
+
+def get_mix_config(**overrides):
+    '''Snapshot the module-level tuning variables as a MixConfig, with some of them optionally overridden'''
+    tuning = {field.name: globals()[field.name] for field in dataclasses.fields(MixConfig)}
+
+    return MixConfig(**dict(tuning, **overrides))
+
+
+def create_adjust_speech_audio(config=None, path=None):
     '''
     Create the complete voice-over audio with silent segments at the beginning and end
     Otherwise, if the bgm and the original voice-over are of the same length, it will appear abrupt and awkward
+    The voice-over is read from path, speech_path by default
     '''
+    path = path or speech_path
+    # A voice-over that can be memory-mapped is used in place, with virtual silences
+    if memory_map_speech:
+        with instrumentation.measure_stage('map_speech'):
+            adjusted_speech = map_adjusted_speech(path, config)
+        if adjusted_speech is not None:
+            return adjusted_speech, len(adjusted_speech)
+
     # Load the voice file
-    speech = AudioSegment.from_file(speech_path, format="wav")
+    with instrumentation.measure_stage('decode_speech'):
+        speech = AudioSegment.from_file(path, format="wav")
+
+    return pad_speech_audio(speech, config)
+
+
+def get_padding_frames(frame_rate, config=None):
+    '''
+    Frame counts of the opening and closing silences that pad_speech_audio adds to a voice-over of the given frame rate
+    The silences are 16-bit mono at 11025 Hz, so they are measured after the same conversion concatenation makes
+    '''
+    config = config or get_mix_config()
+    opening_silence = AudioSegment.silent(duration=config.speech_audio_opening_silence * 1000)
+    closing_silence = AudioSegment.silent(duration=config.speech_audio_closing_silence * 1000)
+
+    return (int(opening_silence.set_frame_rate(frame_rate).frame_count()),
+            int(closing_silence.set_frame_rate(frame_rate).frame_count()))
+
+
+def map_adjusted_speech(path, config=None):
+    '''
+    Memory-map a voice-over WAV as the same adjusted voice-over pad_speech_audio makes, the silences being only offsets
+    Returns None when pydub has to load it: 8 or 24-bit and float WAV files, or a frame rate below the one of the silences
+    '''
+    try:
+        samples, frame_rate = wav_reader.map_wav_samples(path)
+    except ValueError:
+        return None
+    if frame_rate < AudioSegment.silent(duration=0).frame_rate:
+        return None
+
+    opening_frames, closing_frames = get_padding_frames(frame_rate, config)
+
+    return wav_reader.MappedAudioSegment(wav_reader.PaddedSamples(samples, opening_frames, closing_frames), frame_rate)
+
+
+def pad_speech_audio(speech, config=None):
+    '''Add the opening and closing silences to a loaded voice-over, return it with its length in milliseconds'''
+    config = config or get_mix_config()
 
     # Create the silent segments for the beginning and end
-    opening_silence = AudioSegment.silent(duration=speech_audio_opening_silence * 1000)
-    closing_silence = AudioSegment.silent(duration=speech_audio_closing_silence * 1000)
+    opening_silence = AudioSegment.silent(duration=config.speech_audio_opening_silence * 1000)
+    closing_silence = AudioSegment.silent(duration=config.speech_audio_closing_silence * 1000)
 
     # Combine the silence at the beginning, the speech, and the silence at the end
     adjusted_speech = opening_silence + speech + closing_silence
@@ -74,94 +232,654 @@ def create_adjust_speech_audio():
     return adjusted_speech, adjusted_tspan_in_ms
 
 
-def create_downsampling_dict(adjust_speech_audio):
-    '''Create a downsampling dictionary, binarize the loudness at each downsampling point'''
-    # Initialize
-    downsampling_dict = {}
-    curr_time_in_ms = 0
+def create_adjust_speech_stems(config=None):
+    '''
+    Load every voice stem of speech_stems and adjust them like create_adjust_speech_audio
+    Returns the adjusted stems, their common length in milliseconds and the loudness threshold of each (None for the default)
+    '''
+    stems, loudness_thresholds = [], []
+    with instrumentation.measure_stage('decode_speech'):
+        for stem in speech_stems:
+            stem_path, loudness_threshold = stem if isinstance(stem, (tuple, list)) else (stem, None)
+            stems.append(AudioSegment.from_file(stem_path, format="wav"))
+            loudness_thresholds.append(loudness_threshold)
 
-    # Get the audio length
-    adjusted_tspan = len(adjust_speech_audio)
+    adjusted_stems, adjusted_tspan_in_ms = pad_speech_stems(stems, config)
 
-    # Traverse the audio for sampling every 20 milliseconds (default value)
-    while curr_time_in_ms <= adjusted_tspan:
-        # Get the audio segment for the current time period
-        sample = adjust_speech_audio[curr_time_in_ms:curr_time_in_ms + downsampling_interval_in_ms]
-        # Determine if the volume is above the threshold and write the result into the dictionary
-        downsampling_dict[curr_time_in_ms] = sample.dBFS > loudness_threshold
-        # Update the time
-        curr_time_in_ms += downsampling_interval_in_ms
+    return adjusted_stems, adjusted_tspan_in_ms, loudness_thresholds
 
-    return downsampling_dict
 
+def pad_speech_stems(stems, config=None):
+    '''Convert the stems to one common format, pad the shorter ones with silence and add the opening and closing silences'''
+    stems = AudioSegment._sync(*stems)
+    frame_counts = [len(stem.raw_data) // stem.frame_width for stem in stems]
+    stems = [stem + stem._spawn(b'\0' * ((max(frame_counts) - frame_count) * stem.frame_width))
+             for stem, frame_count in zip(stems, frame_counts)]
+    adjusted_stems = [pad_speech_audio(stem, config)[0] for stem in stems]
 
-def find_a_silent_interval(downsampling_dict, search_origin_in_ms, adjusted_tspan_in_ms):
-    '''Find the next qualifying silent interval'''
-    # Initialize the start and end times of the silent interval
-    silent_interval_start_time_in_ms = search_origin_in_ms
-    silent_interval_end_time_in_ms = search_origin_in_ms
+    return adjusted_stems, len(adjusted_stems[0])
 
-    # Traverse the audio for sampling every 20 milliseconds (default value)
-    for i in range(search_origin_in_ms, adjusted_tspan_in_ms, downsampling_interval_in_ms):
-        # If the current time point exceeds the length of the audio, return None
-        if i >= adjusted_tspan_in_ms:
-            return None
-        
-        # If the current point is silent
-        if not downsampling_dict[i]:
-            # Update the end time of the silent interval
-            silent_interval_end_time_in_ms = i
+
+def audio_to_array(audio):
+    '''
+    Expose the PCM data of an AudioSegment as a (frames, channels) NumPy array
+    The array is a read-only view of the raw bytes, so no copy of the audio is made;
+    a memory-mapped voice-over gives its PaddedSamples, which slice like the array would
+    '''
+    if isinstance(audio, wav_reader.MappedAudioSegment):
+        return audio.samples
+
+    # pydub stores 8-bit audio as signed values, just like audioop expects
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[audio.sample_width]
+    samples = np.frombuffer(audio.raw_data, dtype=dtype)
+
+    return samples.reshape(-1, audio.channels)
+
+
+def get_window_frames(frame_rate, tspan_in_ms, interval_in_ms, first_window, last_window):
+    '''First and (exclusive) last frame of the downsampling windows [first_window, last_window), as AudioSegment slicing gives them'''
+    # Same window start points as the original while loop: 0, 20, 40, ... up to and including the audio length
+    window_starts_in_ms = np.arange(first_window, last_window) * interval_in_ms
+    window_ends_in_ms = np.minimum(window_starts_in_ms + interval_in_ms, tspan_in_ms)
+
+    # Convert milliseconds to frame positions the same way AudioSegment slicing does
+    start_frames = (window_starts_in_ms * (frame_rate / 1000.0)).astype(np.int64)
+    end_frames = (window_ends_in_ms * (frame_rate / 1000.0)).astype(np.int64)
+
+    return start_frames, end_frames
+
+
+def compute_window_dbfs(samples, frame_rate, tspan_in_ms, interval_in_ms, first_window=0, last_window=None,
+                        first_frame=0, frame_count=None, max_windows_per_block=8192):
+    '''
+    Compute the dBFS of every downsampling window in one batched pass
+    The window boundaries, the RMS rounding and the silence padding of the last window follow pydub exactly,
+    so the result is identical to slicing the AudioSegment and reading .dBFS window by window
+    When streaming, samples may hold only part of the audio: samples[0] is frame first_frame of an audio of frame_count frames,
+    and only the windows [first_window, last_window) are computed
+    '''
+    channels = samples.shape[1]
+    frame_count = first_frame + len(samples) if frame_count is None else frame_count
+    last_window = tspan_in_ms // interval_in_ms + 1 if last_window is None else last_window
+    max_possible_amplitude = float(2 ** (samples.dtype.itemsize * 8 - 1))
+    start_frames, end_frames = get_window_frames(frame_rate, tspan_in_ms, interval_in_ms, first_window, last_window)
+
+    # A window that starts past the last frame has no data at all and pydub does not pad it
+    sample_counts = np.where(start_frames < frame_count, (end_frames - start_frames) * channels, 0)
+    sum_squares = np.zeros(len(start_frames))
+
+    # 8 and 16-bit samples are exact in float32, which halves the memory traffic; 32-bit samples need float64
+    work_dtype = np.float64 if samples.dtype.itemsize > 2 else np.float32
+
+    # Process the windows block by block so the converted samples never cover the whole file at once
+    for first in range(0, len(start_frames), max_windows_per_block):
+        last = min(first + max_windows_per_block, len(start_frames))
+        block_start = min(start_frames[first], frame_count)
+        block_end = min(end_frames[last - 1], frame_count)
+        if block_end <= block_start:
+            continue
+        block = samples[block_start - first_frame:block_end - first_frame].astype(work_dtype)
+
+        # Frame offsets of every window inside the block, clipped to the data that actually exists
+        offsets = np.clip(start_frames[first:last], block_start, block_end) - block_start
+        lengths = np.clip(end_frames[first:last], block_start, block_end) - block_start - offsets
+
+        if lengths[0] > 0 and np.all(lengths == lengths[0]):
+            # Common case: equally long windows, reshape to (windows, samples) and reduce every row at once
+            windows = block.reshape(last - first, -1)
+            sum_squares[first:last] = np.einsum('ij,ij->i', windows, windows, dtype=np.float64)
         else:
-            # If the current point is not silent, and the silent interval is already long enough
-            if silent_interval_end_time_in_ms + downsampling_interval_in_ms - silent_interval_start_time_in_ms >= silent_interval_tspan_threshold_in_ms:
-                # The silent interval is long enough, return the start and end times
-                return silent_interval_start_time_in_ms, silent_interval_end_time_in_ms
-            else:
-                # Reset the start time, looking for the next possible silent interval
-                silent_interval_start_time_in_ms = i + downsampling_interval_in_ms
-                silent_interval_end_time_in_ms = i + downsampling_interval_in_ms
-    
-    # Check if there is a long enough silent interval at the end of the file
-    if silent_interval_end_time_in_ms - silent_interval_start_time_in_ms >= silent_interval_tspan_threshold_in_ms:
-        return silent_interval_start_time_in_ms, min(silent_interval_end_time_in_ms, adjusted_tspan_in_ms)
+            # Uneven windows (odd frame rates or the tail of the file): fold the channels, then reduceat
+            frame_squares = np.einsum('ij,ij->i', block, block, dtype=np.float64)
+            non_empty = lengths > 0
+            sum_squares[first:last][non_empty] = np.add.reduceat(frame_squares, offsets[non_empty])
 
-    # If a long enough silent interval is not found, return None
-    return None
+    # audioop.rms truncates the root mean square to an integer before pydub converts it to dBFS
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rms = np.floor(np.sqrt(sum_squares / sample_counts))
+        rms[sample_counts == 0] = 0
+        window_dbfs = 20 * np.log10(rms / max_possible_amplitude)
 
+    return window_dbfs
 
-def record_silent_interval(downsampling_dict, adjusted_tspan_in_ms):
-    '''Record the valid silent intervals'''
-    silent_interval_dict = {}
-    silent_interval_id = 1
-    search_origin_in_ms = 0
 
-    # Start scanning from the beginning of the audio, looking for all silent intervals
-    while search_origin_in_ms < adjusted_tspan_in_ms:
-        # Find the silent interval starting from the current point
-        result = find_a_silent_interval(downsampling_dict, search_origin_in_ms, adjusted_tspan_in_ms)
-        
-        # If a silent interval is found
-        if result is not None:
-            silent_interval_start_time_in_ms, silent_interval_end_time_in_ms = result
-
-            # Record the silent interval
-            silent_interval_dict[silent_interval_id] = {
-                "s": silent_interval_start_time_in_ms,
-                "e": silent_interval_end_time_in_ms,
-            }
-            silent_interval_id += 1  # Prepare a new ID for the next silent interval
-
-            # Update the search origin to the first time point after the found silent interval
-            search_origin_in_ms = silent_interval_end_time_in_ms + downsampling_interval_in_ms
+@functools.lru_cache(maxsize=8)
+def get_voice_band_basis(window_frames, frame_rate, low_in_hz, high_in_hz):
+    '''
+    Hann-windowed cosines and sines of the DFT bins of a window_frames window whose frequency lies in [low_in_hz, high_in_hz],
+    as a (window_frames, 2 * bins) float32 matrix: the product of windows with it is the part of their rfft in the band
+    '''
+    bins = np.arange(window_frames // 2 + 1)
+    bins = bins[(bins * frame_rate / window_frames >= low_in_hz) & (bins * frame_rate / window_frames <= high_in_hz)]
+    # DC and the Nyquist frequency are not in a speech band, every bin stands for its negative frequency as well
+    bins = bins[(bins > 0) & (2 * bins < window_frames)]
+    phases = 2 * np.pi * np.outer(np.arange(window_frames), bins) / window_frames
+    hann = np.hanning(window_frames).reshape(-1, 1)
+
+    return np.concatenate((np.cos(phases) * hann, np.sin(phases) * hann), axis=1).astype(np.float32)
+
+
+def compute_voice_band_dbfs(window_dbfs, samples, frame_rate, tspan_in_ms, interval_in_ms, first_window=0, last_window=None,
+                            first_frame=0, frame_count=None, max_windows_per_block=8192, config=None):
+    '''
+    Voice-band loudness of the windows whose broadband dBFS compute_window_dbfs gave (same arguments):
+    the dBFS scaled by the share of the window energy between voice_band_low_in_hz and voice_band_high_in_hz
+    Rather than a whole rfft per window, the batch of Hann-windowed windows is multiplied with the DFT basis of the band bins
+    only (a few dozen at 20 ms), and the total energy comes from the windowed samples by Parseval's theorem
+    The share is at most 1, so a window is never louder in the band than broadband: the coarse scan stays exact
+    '''
+    config = config or get_mix_config()
+    channels = samples.shape[1]
+    frame_count = first_frame + len(samples) if frame_count is None else frame_count
+    last_window = first_window + len(window_dbfs) if last_window is None else last_window
+    start_frames, end_frames = get_window_frames(frame_rate, tspan_in_ms, interval_in_ms, first_window, last_window)
+
+    # Windows are one frame shorter now and then at odd frame rates, those are padded with a zero
+    window_frames = int(np.ceil(interval_in_ms * frame_rate / 1000.0))
+    basis = get_voice_band_basis(window_frames, frame_rate, config.voice_band_low_in_hz, config.voice_band_high_in_hz)
+    hann_squares = np.square(np.hanning(window_frames)).astype(np.float32)
+    band_shares = np.zeros(len(start_frames))
+
+    for first in range(0, len(start_frames), max_windows_per_block):
+        last = min(first + max_windows_per_block, len(start_frames))
+        block_start = min(start_frames[first], frame_count)
+        block_end = min(end_frames[last - 1], frame_count)
+        if block_end <= block_start:
+            continue
+        block = samples[block_start - first_frame:block_end - first_frame].astype(np.float32)
+        offsets = np.clip(start_frames[first:last], block_start, block_end) - block_start
+        lengths = np.clip(end_frames[first:last], block_start, block_end) - block_start - offsets
+
+        if np.all(lengths == window_frames):
+            windows = block.reshape(last - first, window_frames, channels)
         else:
-            # If no silent interval is found, or the end of the audio is reached, end the loop
-            break
+            # Gather the windows from the block followed by one window of zeros, and zero what is past their end
+            block = np.concatenate((block, np.zeros((window_frames, channels), dtype=np.float32)))
+            frame_offsets = np.arange(window_frames)
+            windows = block[offsets.reshape(-1, 1) + frame_offsets]
+            windows[frame_offsets >= lengths.reshape(-1, 1)] = 0
+
+        # One row per window and channel, the energies of the channels are added up
+        rows = windows.transpose(0, 2, 1).reshape(-1, window_frames)
+        band_coefficients = rows @ basis
+        band_energy = np.einsum('ij,ij->i', band_coefficients, band_coefficients).reshape(-1, channels).sum(axis=1)
+        total_energy = (np.square(rows) @ hann_squares).reshape(-1, channels).sum(axis=1)
+
+        # Parseval: the energy of all 2 * bins spectral lines is window_frames times the energy of the windowed samples
+        with np.errstate(divide='ignore', invalid='ignore'):
+            band_shares[first:last] = np.where(total_energy > 0, 2 * band_energy / (window_frames * total_energy), 0)
+
+    with np.errstate(divide='ignore'):
+        return window_dbfs + 10 * np.log10(np.minimum(band_shares, 1.0))
+
+
+def get_measure_key(config=None):
+    '''Short description of what the loudness envelope measures, None for the broadband dBFS'''
+    config = config or get_mix_config()
+    if config.loudness_measure == 'broadband':
+        return None
+    if config.loudness_measure == 'voice_band':
+        return f'voice_band-{config.voice_band_low_in_hz}-{config.voice_band_high_in_hz}Hz'
+
+    raise ValueError(f'Unknown loudness_measure {config.loudness_measure!r}, use "broadband" or "voice_band"')
+
+
+def compute_shared_window_dbfs(shared_memory_name, shape, dtype, frame_rate, tspan_in_ms, interval_in_ms,
+                               first_window, last_window):
+    '''Worker of compute_window_dbfs_parallel: compute some windows of the PCM held in shared memory, without copying it'''
+    shared_samples = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        samples = np.ndarray(shape, dtype=dtype, buffer=shared_samples.buf)
+        window_dbfs = compute_window_dbfs(samples, frame_rate, tspan_in_ms, interval_in_ms, first_window, last_window)
+        # The view has to go before the shared memory can be closed
+        del samples
+        return window_dbfs
+    finally:
+        shared_samples.close()
+
+
+def compute_window_dbfs_parallel(samples, frame_rate, tspan_in_ms, interval_in_ms, workers, max_windows_per_block=8192):
+    '''
+    Same result as compute_window_dbfs, bit for bit, computed by a pool of worker processes
+    The PCM is copied once into shared memory, and every worker reads its chunk of windows from there,
+    so no samples are ever pickled; the chunks are whole blocks of compute_window_dbfs, so every block sums the same values
+    '''
+    window_count = tspan_in_ms // interval_in_ms + 1
+    blocks_per_chunk = -(-window_count // (max(workers, 1) * max_windows_per_block))
+    windows_per_chunk = blocks_per_chunk * max_windows_per_block
+    if workers <= 1 or window_count <= windows_per_chunk:
+        return compute_window_dbfs(samples, frame_rate, tspan_in_ms, interval_in_ms)
+
+    shared_samples = shared_memory.SharedMemory(create=True, size=samples.nbytes)
+    try:
+        shared_array = np.ndarray(samples.shape, dtype=samples.dtype, buffer=shared_samples.buf)
+        # Copied block by block, since a memory-mapped voice-over only materializes the frames that are sliced
+        for first_frame in range(0, len(samples), 1 << 20):
+            shared_array[first_frame:first_frame + (1 << 20)] = samples[first_frame:first_frame + (1 << 20)]
+        del shared_array
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = [executor.submit(compute_shared_window_dbfs, shared_samples.name, samples.shape, samples.dtype.str,
+                                      frame_rate, tspan_in_ms, interval_in_ms,
+                                      first_window, min(first_window + windows_per_chunk, window_count))
+                      for first_window in range(0, window_count, windows_per_chunk)]
+            return np.concatenate([chunk.result() for chunk in chunks])
+    finally:
+        shared_samples.close()
+        shared_samples.unlink()
+
+
+def scan_window_dbfs(samples, frame_rate, tspan_in_ms, interval_in_ms, silence_bound_in_dbfs, coarse_interval_in_ms,
+                     max_groups_per_block=4096):
+    '''
+    Coarse-to-fine loudness envelope, returned with the number of windows it skipped
+    A cheap coarse pass takes the peak of every coarse_interval_in_ms: no window is louder (in RMS) than its peak,
+    so all the windows of a coarse window whose peak is below silence_bound_in_dbfs are silent for sure and left at -inf;
+    only the other ones, the sound and its boundaries with the silences, are computed at full resolution
+    '''
+    frame_count, channels = samples.shape
+    window_count = tspan_in_ms // interval_in_ms + 1
+    windows_per_group = max(coarse_interval_in_ms // interval_in_ms, 1)
+    max_possible_amplitude = float(2 ** (samples.dtype.itemsize * 8 - 1))
+
+    # Coarse windows are whole groups of windows, starting on the same frames as the windows of compute_window_dbfs
+    group_starts_in_ms = np.arange(0, window_count, windows_per_group) * interval_in_ms
+    group_first_frames = np.minimum((group_starts_in_ms * (frame_rate / 1000.0)).astype(np.int64), frame_count)
+
+    # Peak of every coarse window by reductions over the raw samples, which are not even converted to float,
+    # a few thousand coarse windows at a time so that a memory-mapped voice-over is only sliced in blocks
+    peaks = np.zeros(len(group_first_frames))
+    non_empty_groups = np.count_nonzero(group_first_frames < frame_count)
+    for first in range(0, non_empty_groups, max_groups_per_block):
+        last = min(first + max_groups_per_block, non_empty_groups)
+        block_end = group_first_frames[last] if last < len(group_first_frames) else frame_count
+        flat_samples = samples[group_first_frames[first]:block_end].reshape(-1)
+        offsets = (group_first_frames[first:last] - group_first_frames[first]) * channels
+        peaks[first:last] = np.maximum(np.maximum.reduceat(flat_samples, offsets).astype(np.float64),
+                                       -np.minimum.reduceat(flat_samples, offsets).astype(np.float64))
+    with np.errstate(divide='ignore'):
+        silent_groups = 20 * np.log10(peaks / max_possible_amplitude) < silence_bound_in_dbfs
+
+    # Compute every run of coarse windows that may hold sound in one call
+    window_dbfs = np.full(window_count, -np.inf)
+    windows_computed = 0
+    starts, ends, silent = get_runs(silent_groups)
+    for start, end in zip(starts[~silent] * windows_per_group, ends[~silent] * windows_per_group):
+        last_window = min(end, window_count)
+        window_dbfs[start:last_window] = compute_window_dbfs(samples, frame_rate, tspan_in_ms, interval_in_ms,
+                                                             start, last_window)
+        windows_computed += last_window - start
+
+    return window_dbfs, int(window_count - windows_computed)
+
+
+def get_silence_bound(config=None):
+    '''
+    Loudness below which the exact value of a window cannot change the binarization, or None if every value matters
+    Smoothing mixes the neighbouring windows into each value, so the coarse-to-fine scan is only used without it
+    '''
+    config = config or get_mix_config()
+    if not config.coarse_scan_interval_in_ms:
+        return None
+
+    if config.loudness_detector == 'threshold':
+        return config.loudness_threshold
+    if config.loudness_detector == 'hysteresis' and not config.loudness_smoothing_in_ms:
+        return min(config.loudness_threshold, config.loudness_release_threshold)
+
+    return None
+
+
+def create_loudness_envelope(adjust_speech_audio, config=None, coarse_scan=True):
+    '''
+    Create the loudness envelope, i.e. the dBFS of each downsampling window, as a compact array
+    With coarse_scan_interval_in_ms, the windows that are silent for sure are skipped and hold -inf (see scan_window_dbfs),
+    which binarizes the same; coarse_scan=False computes the exact value of every window, e.g. to be cached
+    '''
+    config = config or get_mix_config()
+    samples = audio_to_array(adjust_speech_audio)
+
+    frame_rate, tspan_in_ms = adjust_speech_audio.frame_rate, len(adjust_speech_audio)
+
+    # Sums of 8 and 16-bit squares are exact in float64, so computing the windows run by run gives the very same bits
+    silence_bound_in_dbfs = get_silence_bound(config) if coarse_scan else None
+    if silence_bound_in_dbfs is not None and samples.dtype.itemsize <= 2:
+        loudness_envelope, windows_skipped = scan_window_dbfs(samples, frame_rate, tspan_in_ms,
+                                                              config.downsampling_interval_in_ms,
+                                                              silence_bound_in_dbfs, config.coarse_scan_interval_in_ms)
+        instrumentation.record_metrics('create_loudness_envelope', windows=len(loudness_envelope),
+                                       windows_skipped=windows_skipped)
+    else:
+        loudness_envelope = compute_window_dbfs_parallel(samples, frame_rate, tspan_in_ms,
+                                                         config.downsampling_interval_in_ms, config.envelope_workers)
+
+    if get_measure_key(config) is not None:
+        with instrumentation.measure_stage('compute_voice_band_dbfs'):
+            loudness_envelope = compute_voice_band_dbfs(loudness_envelope, samples, frame_rate, tspan_in_ms,
+                                                        config.downsampling_interval_in_ms, config=config)
+
+    return loudness_envelope
+
+
+def stream_loudness_envelope(sample_blocks, frame_rate, frame_count, config=None):
+    '''
+    Compute the loudness envelope from consecutive blocks of PCM, yielding the dBFS of the windows completed by each block
+    Only the frames of the window that is still incomplete are kept between blocks
+    '''
+    config = config or get_mix_config()
+    downsampling_interval_in_ms = config.downsampling_interval_in_ms
+
+    # Same length in milliseconds as len() of the whole AudioSegment
+    tspan_in_ms = round(1000 * (frame_count / frame_rate))
+    window_count = tspan_in_ms // downsampling_interval_in_ms + 1
+    frames_per_window = downsampling_interval_in_ms * (frame_rate / 1000.0)
+
+    def measure_windows(samples, first_window, last_window, first_frame):
+        window_dbfs = compute_window_dbfs(samples, frame_rate, tspan_in_ms, downsampling_interval_in_ms,
+                                          first_window, last_window, first_frame, frame_count)
+        if get_measure_key(config) is None:
+            return window_dbfs
+        return compute_voice_band_dbfs(window_dbfs, samples, frame_rate, tspan_in_ms, downsampling_interval_in_ms,
+                                       first_window, last_window, first_frame, frame_count, config=config)
+
+    pending_samples = None
+    pending_first_frame = 0
+    next_window = 0
+    for block in sample_blocks:
+        pending_samples = block if pending_samples is None else np.concatenate((pending_samples, block))
+        available_frames = pending_first_frame + len(pending_samples)
+
+        # The windows ending inside the frames read so far are complete
+        candidates = np.arange(next_window, min(int(available_frames / frames_per_window) + 2, window_count))
+        window_ends_in_ms = np.minimum((candidates + 1) * downsampling_interval_in_ms, tspan_in_ms)
+        end_frames = (window_ends_in_ms * (frame_rate / 1000.0)).astype(np.int64)
+        last_window = next_window + int(np.searchsorted(end_frames, available_frames, side='right'))
+        if last_window == next_window:
+            continue
+
+        yield measure_windows(pending_samples, next_window, last_window, pending_first_frame)
+
+        # Drop the frames before the first incomplete window
+        next_first_frame = int(min(last_window * downsampling_interval_in_ms, tspan_in_ms) * (frame_rate / 1000.0))
+        pending_samples = pending_samples[next_first_frame - pending_first_frame:]
+        pending_first_frame = next_first_frame
+        next_window = last_window
+
+    # The remaining windows reach past the last frame and are padded with silence, like the last AudioSegment slice
+    if next_window < window_count:
+        if pending_samples is None:
+            pending_samples = np.zeros((0, 1), dtype=np.int16)
+        yield measure_windows(pending_samples, next_window, window_count, pending_first_frame)
+
+
+def binarize_loudness_envelope(loudness_envelope, config=None):
+    '''Binarize the loudness envelope with the selected loudness_detector, True for loud windows'''
+    config = config or get_mix_config()
+
+    if config.loudness_detector == 'threshold':
+        return loudness_envelope > config.loudness_threshold
+    if config.loudness_detector == 'hysteresis':
+        return binarize_with_hysteresis(loudness_envelope, config)
+
+    raise ValueError(f'Unknown loudness_detector {config.loudness_detector!r}, use "threshold" or "hysteresis"')
+
+
+def get_detection_key(config=None):
+    '''Short description of the binarization settings, used to key the cached silent intervals'''
+    config = config or get_mix_config()
+
+    if config.loudness_detector == 'threshold':
+        return f'{config.loudness_threshold}dB'
+    return (f'{config.loudness_detector}-{config.loudness_threshold}dB-{config.loudness_release_threshold}dB-'
+            f'{config.loudness_smoothing_in_ms}-{config.min_gap_in_ms}-{config.min_burst_in_ms}-'
+            f'{config.burst_guard_silence_in_ms}ms')
+
+
+def smooth_loudness_envelope(loudness_envelope, smoothing_windows):
+    '''Centered moving average of the loudness envelope over smoothing_windows windows, averaged in power, not in dB'''
+    if smoothing_windows <= 1 or not len(loudness_envelope):
+        return loudness_envelope
+
+    # Digital silence is -inf dBFS, i.e. a power of zero
+    power = np.power(10.0, np.asarray(loudness_envelope, dtype=np.float64) / 10)
+    cumulative_power = np.concatenate(([0.0], np.cumsum(power)))
+
+    # Running sums from the cumulative sum, the windows are cut short at both ends of the envelope
+    window_indexes = np.arange(len(power))
+    first = np.maximum(window_indexes - smoothing_windows // 2, 0)
+    last = np.minimum(window_indexes - smoothing_windows // 2 + smoothing_windows, len(power))
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10((cumulative_power[last] - cumulative_power[first]) / (last - first))
+
+
+def get_runs(mask):
+    '''Split a boolean array into runs of equal values, return the starts, the (exclusive) ends and the values'''
+    boundaries = np.flatnonzero(mask[1:] != mask[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(mask)]))
+
+    return starts, ends, mask[starts]
+
+
+def fill_runs(mask, starts, ends, value):
+    '''Set the non-adjacent runs [starts, ends) of a boolean array to value, with one cumulative sum instead of a loop'''
+    coverage = np.zeros(len(mask) + 1, dtype=np.int64)
+    # Runs never touch each other, so no index appears twice
+    coverage[starts] += 1
+    coverage[ends] -= 1
+    covered = np.cumsum(coverage[:-1]) > 0
+
+    return mask | covered if value else mask & ~covered
+
+
+def binarize_with_hysteresis(loudness_envelope, config=None):
+    '''
+    Noise-robust binarization of the loudness envelope, in linear time and without a loop over the windows:
+    1. the envelope is optionally smoothed over loudness_smoothing_in_ms
+    2. dual-threshold hysteresis: a window turns loud above loudness_threshold, and the windows after it stay loud
+       until the loudness falls below loudness_release_threshold, so noise hovering around one threshold does not flicker
+    3. silences shorter than min_gap_in_ms between two loud stretches are bridged
+    4. loud bursts shorter than min_burst_in_ms with at least burst_guard_silence_in_ms of silence on both sides are dropped
+    '''
+    config = config or get_mix_config()
+    interval_in_ms = config.downsampling_interval_in_ms
+    loudness_envelope = smooth_loudness_envelope(loudness_envelope,
+                                                 -(-config.loudness_smoothing_in_ms // interval_in_ms))
+    if not len(loudness_envelope):
+        return np.zeros(0, dtype=bool)
+
+    # Every window above or below both thresholds decides the state, the windows in between keep the last decision
+    above = loudness_envelope > config.loudness_threshold
+    decisive = above | (loudness_envelope < config.loudness_release_threshold)
+    last_decisive = np.maximum.accumulate(np.where(decisive, np.arange(len(decisive)), -1))
+    loudness_mask = (last_decisive >= 0) & above[last_decisive]
+
+    # Bridge the short silences, only those with a loud stretch on both sides
+    starts, ends, loud = get_runs(loudness_mask)
+    short_gaps = ~loud & (starts > 0) & (ends < len(loudness_mask)) & \
+        ((ends - starts) * interval_in_ms < config.min_gap_in_ms)
+    loudness_mask = fill_runs(loudness_mask, starts[short_gaps], ends[short_gaps], True)
+
+    # Runs alternate, so the neighbours of a loud run are silences; the ends of the audio count as long silences
+    starts, ends, loud = get_runs(loudness_mask)
+    run_tspans_in_ms = (ends - starts) * interval_in_ms
+    guard_tspans_in_ms = np.concatenate(([np.inf], run_tspans_in_ms, [np.inf]))
+    short_bursts = loud & (run_tspans_in_ms < config.min_burst_in_ms) & \
+        (guard_tspans_in_ms[:-2] >= config.burst_guard_silence_in_ms) & \
+        (guard_tspans_in_ms[2:] >= config.burst_guard_silence_in_ms)
+
+    return fill_runs(loudness_mask, starts[short_bursts], ends[short_bursts], False)
+
+
+def create_stems_loudness_mask(adjusted_stems, loudness_thresholds, config=None):
+    '''Binarize the loudness envelope of every stem with its own threshold, and combine them: True where anyone is speaking'''
+    config = config or get_mix_config()
+
+    loudness_mask = None
+    for stem, loudness_threshold in zip(adjusted_stems, loudness_thresholds):
+        stem_config = config if loudness_threshold is None else \
+            dataclasses.replace(config, loudness_threshold=loudness_threshold)
+        # The coarse scan skips what is silent for this stem's own threshold
+        stem_mask = binarize_loudness_envelope(create_loudness_envelope(stem, stem_config), stem_config)
+        loudness_mask = stem_mask if loudness_mask is None else loudness_mask | stem_mask
+
+    return loudness_mask
+
+
+def create_downsampling_dict(adjust_speech_audio, config=None):
+    '''
+    Create a downsampling dictionary, binarize the loudness at each downsampling point
+    Kept for backward compatibility, the dictionary is built from the vectorized loudness envelope
+    '''
+    config = config or get_mix_config()
+    loudness_mask = binarize_loudness_envelope(create_loudness_envelope(adjust_speech_audio, config), config)
+
+    # Key every binarized window by its start time in milliseconds, as before
+    interval_in_ms = config.downsampling_interval_in_ms
+    return dict(zip(range(0, len(loudness_mask) * interval_in_ms, interval_in_ms), loudness_mask.tolist()))
+
+
+def stream_silent_intervals(loudness_mask_blocks, adjusted_tspan_in_ms, search_origin_in_ms=0, config=None):
+    '''
+    Find the qualifying silent intervals in one run-length pass over the binarized loudness
+    The binarized loudness may arrive in blocks of any size: each (start_in_ms, end_in_ms) is yielded as soon as it is complete,
+    and only the start of the silent run that is still open is carried from one block to the next
+    '''
+    config = config or get_mix_config()
+    downsampling_interval_in_ms = config.downsampling_interval_in_ms
+    silent_interval_tspan_threshold_in_ms = config.silent_interval_tspan_threshold_in_ms
+
+    # Only the downsampling points from the search origin up to (not including) the end of the audio are scanned
+    first_point = -(-search_origin_in_ms // downsampling_interval_in_ms)
+    last_point = -(-adjusted_tspan_in_ms // downsampling_interval_in_ms)
+
+    # Start of the silent run that is still open, in downsampling points
+    run_start = first_point
+    block_start = 0
+    for loudness_mask in loudness_mask_blocks:
+        loud = np.asarray(loudness_mask, dtype=bool)
+        scan_start = min(max(first_point - block_start, 0), len(loud))
+        scan_end = max(min(last_point - block_start, len(loud)), scan_start)
+        loud_points = np.flatnonzero(loud[scan_start:scan_end]) + block_start + scan_start
+        block_start += len(loud)
+        if not len(loud_points):
+            continue
+
+        # Every loud point closes the silent run in front of it, which counts its full length
+        run_starts = np.concatenate(([run_start], loud_points[:-1] + 1))
+        run_ends = loud_points
+        run_start = int(loud_points[-1]) + 1
+        long_enough = (run_ends - run_starts) * downsampling_interval_in_ms >= silent_interval_tspan_threshold_in_ms
+        interval_starts, interval_ends = run_starts[long_enough], run_ends[long_enough] - 1
+
+        # With a threshold no longer than one downsampling interval, every loud point is reported on its own as well
+        if silent_interval_tspan_threshold_in_ms <= downsampling_interval_in_ms:
+            interval_starts = np.concatenate((interval_starts, loud_points))
+            interval_ends = np.concatenate((interval_ends, loud_points))
+            order = np.argsort(interval_starts, kind='stable')
+            interval_starts, interval_ends = interval_starts[order], interval_ends[order]
+
+        # Convert the downsampling points back into milliseconds
+        yield from zip((interval_starts * downsampling_interval_in_ms).tolist(),
+                       (interval_ends * downsampling_interval_in_ms).tolist())
+
+    # A silent tail at the end of the file is measured from its first to its last point, one interval shorter
+    tail_tspan_in_ms = (last_point - 1 - run_start) * downsampling_interval_in_ms
+    if last_point > run_start and tail_tspan_in_ms >= silent_interval_tspan_threshold_in_ms:
+        yield run_start * downsampling_interval_in_ms, (last_point - 1) * downsampling_interval_in_ms
+
+
+def find_silent_intervals(loudness_mask, adjusted_tspan_in_ms, search_origin_in_ms=0, config=None):
+    '''
+    Find all qualifying silent intervals in one run-length pass over the binarized loudness
+    Returns a list of (start_in_ms, end_in_ms) tuples, where both ends are downsampling points inside the silence
+    '''
+    return list(stream_silent_intervals([loudness_mask], adjusted_tspan_in_ms, search_origin_in_ms, config))
+
 
-    return silent_interval_dict
+def create_loudness_mask(downsampling_dict, adjusted_tspan_in_ms, config=None):
+    '''Convert a downsampling dictionary into the binarized loudness array used by find_silent_intervals'''
+    config = config or get_mix_config()
 
+    return np.array([downsampling_dict[i] for i in range(0, adjusted_tspan_in_ms, config.downsampling_interval_in_ms)],
+                    dtype=bool)
 
-def get_fade_ins_and_outs(silent_interval_dict):
+
+def create_silent_interval_dict(silent_intervals):
+    '''Number the silent intervals from 1, in the {id: {"s": start, "e": end}} layout'''
+    return {silent_interval_id: {"s": start, "e": end}
+            for silent_interval_id, (start, end) in enumerate(silent_intervals, start=1)}
+
+
+def find_a_silent_interval(downsampling_dict, search_origin_in_ms, adjusted_tspan_in_ms, config=None):
+    '''
+    Find the next qualifying silent interval
+    Kept for backward compatibility, the search is done by find_silent_intervals
+    '''
+    loudness_mask = create_loudness_mask(downsampling_dict, adjusted_tspan_in_ms, config)
+    silent_intervals = find_silent_intervals(loudness_mask, adjusted_tspan_in_ms, search_origin_in_ms, config)
+
+    # If a long enough silent interval is not found, return None
+    return silent_intervals[0] if silent_intervals else None
+
+
+def record_silent_interval(downsampling_dict, adjusted_tspan_in_ms, config=None):
+    '''
+    Record the valid silent intervals
+    Kept for backward compatibility, the search is done by find_silent_intervals
+    '''
+    loudness_mask = create_loudness_mask(downsampling_dict, adjusted_tspan_in_ms, config)
+
+    return create_silent_interval_dict(find_silent_intervals(loudness_mask, adjusted_tspan_in_ms, config=config))
+
+
+def detect_silent_intervals(adjusted_tspan_in_ms, compute_loudness_envelope, config=None, source_path=None):
+    '''
+    Run the detection stages on the adjusted voice-over: loudness envelope, binarization and silent interval search
+    compute_loudness_envelope is called only when the envelope is needed, with the analysis cache enabled
+    the results of a voice-over analysed before are read back instead of computed again
+    source_path is the file the voice-over was loaded from, which keys the analysis cache; without it nothing is cached
+    '''
+    config = config or get_mix_config()
+    analysis_key = None
+    if use_analysis_cache and source_path is not None:
+        analysis_key = analysis_cache.get_analysis_key(source_path, config.downsampling_interval_in_ms,
+                                                       config.speech_audio_opening_silence,
+                                                       config.speech_audio_closing_silence, get_measure_key(config))
+
+        # Same voice-over and same thresholds: nothing to detect
+        silent_intervals = analysis_cache.load_silent_intervals(analysis_key, get_detection_key(config),
+                                                                config.silent_interval_tspan_threshold_in_ms)
+        if silent_intervals is not None:
+            instrumentation.record_metrics('detect_silent_intervals', analysis_cache='intervals',
+                                           intervals_found=len(silent_intervals))
+            return silent_intervals
+
+    # Same voice-over with other thresholds: only the binarization and the interval search run again
+    loudness_envelope = analysis_cache.load_loudness_envelope(analysis_key) if analysis_key else None
+    envelope_cached = loudness_envelope is not None
+    if loudness_envelope is None:
+        loudness_envelope = compute_loudness_envelope()
+        if analysis_key:
+            analysis_cache.store_loudness_envelope(analysis_key, loudness_envelope)
+
+    loudness_mask = binarize_loudness_envelope(loudness_envelope, config)
+    silent_intervals = find_silent_intervals(loudness_mask, adjusted_tspan_in_ms, config=config)
+    instrumentation.record_metrics('detect_silent_intervals',
+                                   analysis_cache='envelope' if envelope_cached else None,
+                                   windows_scanned=len(loudness_mask), loud_windows=int(np.count_nonzero(loudness_mask)),
+                                   intervals_found=len(silent_intervals))
+
+    if analysis_key:
+        analysis_cache.store_silent_intervals(analysis_key, get_detection_key(config),
+                                              config.silent_interval_tspan_threshold_in_ms, silent_intervals)
+
+    return silent_intervals
+
+
+def get_fade_ins_and_outs(silent_interval_dict, config=None):
     '''Establish a list of fade-in and fade-out points'''
+    config = config or get_mix_config()
     fade_ins = []
     fade_outs = []
 
@@ -172,7 +890,7 @@ def get_fade_ins_and_outs(silent_interval_dict):
 
         # Calculate the fade-in and fade-out points
         fade_in_time = start_time
-        fade_out_time = end_time - fade_in_tspan_in_ms
+        fade_out_time = end_time - config.fade_in_tspan_in_ms
 
         # If the fade-in point is valid (greater than 0), add it to the list
         if fade_in_time > 0:
@@ -190,101 +908,500 @@ def get_fade_ins_and_outs(silent_interval_dict):
     return fade_ins, fade_outs
 
 
-def determine_starting_volume(fade_ins, fade_outs):
+def determine_starting_volume(fade_ins, fade_outs, config=None):
     '''Determine if the BGM should enter with a loud or soft volume'''
+    config = config or get_mix_config()
+
     # If there are no fade-in and fade-out points, the audio might be a continuous voice-over, so we default to starting from quiet_level
     if not fade_ins and not fade_outs:
-        return quiet_level
+        return config.quiet_level
 
     # If there are fade-in points but no fade-out points, it implies there is a voice-over at the beginning that continues until the end of the audio
     if fade_ins and not fade_outs:
-        return quiet_level
+        return config.quiet_level
 
     # If there are fade-out points but no fade-in points, it implies there is no voice-over at the beginning
     if not fade_ins and fade_outs:
-        return loud_level
+        return config.loud_level
 
     # If the first fade-out point is before the first fade-in point, it implies there is no voice-over at the beginning, and the BGM should start from loud_level
     if fade_outs[0] < fade_ins[0]:
-        return loud_level
+        return config.loud_level
 
     # Otherwise, the audio should start from quiet_level
-    return quiet_level
+    return config.quiet_level
 
 
-def mix_speech_with_bgm(adjusted_speech, bgm_path, fade_ins, fade_outs):
-    '''Execute voice-over avoidance and mix the audio'''
-    # Load the BGM audio from the path
-    bgm = AudioSegment.from_file(bgm_path)
+def load_bgm_audio(bgm_path, frame_rate=None, channels=None, sample_width=None):
+    '''Load the BGM, through the decoded BGM cache when it is enabled, optionally converted to the given format'''
+    if use_bgm_cache:
+        return bgm_cache.load_bgm(bgm_path, frame_rate, channels, sample_width)
 
-    # Determine the initial volume of the BGM
-    starting_volume = determine_starting_volume(fade_ins, fade_outs)
-    print(f'Debug: starting_volume = {starting_volume}')
-    
-    # Adjust the initial volume of the BGM audio
-    bgm = bgm + starting_volume
+    return format_normalizer.normalize_audio(AudioSegment.from_file(bgm_path), frame_rate, channels, sample_width,
+                                             track_name='bgm')
 
-    # Apply fade-in and fade-out effects
-    for fade_in in fade_ins:
-        # Fade in the BGM after the silence (BGM transitions from quiet to loud)
-        bgm = bgm.fade(from_gain=quiet_level, to_gain=loud_level, start=fade_in, duration=fade_in_tspan_in_ms)
 
-    for fade_out in fade_outs:
-        # Fade out the BGM before the voice-over starts (BGM transitions from loud to quiet)
-        bgm = bgm.fade(from_gain=loud_level, to_gain=quiet_level, start=fade_out, duration=fade_out_tspan_in_ms)
+def get_mix_format(tracks, config=None):
+    '''Frame rate, channels and sample width of the mix: those of mix_frame_rate and so on, the largest among the tracks for None'''
+    config = config or get_mix_config()
+    largest_format = [max(values) for values in zip(*map(format_normalizer.get_audio_format, tracks))]
 
-    # Combine the voice-over audio with the volume-adjusted BGM
-    speech_bgm_mix = adjusted_speech.overlay(bgm)
+    return tuple(value if value is not None else largest_value for value, largest_value in
+                 zip((config.mix_frame_rate, config.mix_channels, config.mix_sample_width), largest_format))
 
-    # Output the final audio
-    return speech_bgm_mix
+
+def get_track_format(track, mix_format):
+    '''
+    Format a track is converted to for the mix, which is the mix format except that mono tracks stay mono:
+    they are added to every channel of the mix by broadcasting, which is what copying them to every channel does
+    '''
+    frame_rate, channels, sample_width = mix_format
+
+    return frame_rate, 1 if track.channels == 1 else channels, sample_width
 
 
-def fade_out_at_the_end(speech_bgm_mix):
-    '''Add a fade-out effect at the end of the audio'''
-    # Convert the fade-out time from seconds to milliseconds, ensuring it is an integer
-    fade_out_duration_ms = int(fade_out_tspan_at_the_end * 1000)
+def normalize_bgm(bgm, bgm_path, mix_format):
+    '''
+    Convert the BGM to the format of the mix, through the decoded BGM cache when it is enabled,
+    so that the next mixes against the same BGM find it already converted
+    '''
+    bgm_format = get_track_format(bgm, mix_format)
+    if use_bgm_cache and bgm_format != format_normalizer.get_audio_format(bgm):
+        return bgm_cache.load_bgm(bgm_path, *bgm_format)
 
-    # Calculate the start time for the fade-out
-    fade_out_start = len(speech_bgm_mix) - fade_out_duration_ms
+    return format_normalizer.normalize_audio(bgm, *bgm_format, track_name='bgm')
 
-    # Split the audio: fade-out part and the rest
-    pre_fade_out, fade_out_part = speech_bgm_mix[:fade_out_start], speech_bgm_mix[fade_out_start:]
 
-    # Apply the fade-out effect only to the fade-out part
-    fade_out_part = fade_out_part.fade_out(duration=fade_out_duration_ms)
+def get_gain_automation(fade_ins, fade_outs, config=None):
+    '''List every fade as (start_in_ms, duration_in_ms, from_gain, to_gain), in the order they are applied to the BGM'''
+    config = config or get_mix_config()
 
-    # Reassemble the non-fade-out part and the part after fade-out
-    speech_bgm_mix = pre_fade_out + fade_out_part
+    # Fade in the BGM after the silence (BGM transitions from quiet to loud)
+    gain_automation = [(fade_in, config.fade_in_tspan_in_ms, config.quiet_level, config.loud_level)
+                       for fade_in in fade_ins]
 
-    return speech_bgm_mix
+    # Fade out the BGM before the voice-over starts (BGM transitions from loud to quiet)
+    gain_automation += [(fade_out, config.fade_out_tspan_in_ms, config.loud_level, config.quiet_level)
+                        for fade_out in fade_outs]
 
+    return gain_automation
 
-def final_mix(bgm_path):
-    '''Integrate all steps to generate the final mixed audio file'''
-    # Step 1: Create the adjusted voice-over audio with silence at the beginning and the end
-    adjusted_speech, adjusted_tspan_in_ms = create_adjust_speech_audio()
 
-    # Step 2: Generate a downsampling dictionary to identify silent intervals
-    downsampling_dict = create_downsampling_dict(adjusted_speech)
-    print(f'Debug: downsampling_dict = {str(downsampling_dict)[:1500]}...')
+def render_gain_curve(gain_automation, starting_volume, frame_rate, tspan_in_ms, first_frame, last_frame):
+    '''
+    Render the linear BGM gain of every frame in [first_frame, last_frame)
+    The curve is the product of all fades as AudioSegment.fade applies them: each fade scales the audio before it by from_gain,
+    ramps linearly (one step per millisecond, or per frame for fades up to 100 ms), and scales the audio after it by to_gain
+    '''
+    frames = np.arange(first_frame, last_frame)
+    ms_to_frame = frame_rate / 1000.0
+    fades, ramp_starts, ramp_ends = get_fade_ramps(gain_automation, frame_rate, tspan_in_ms)
+    gain_curve = 10 ** (get_constant_gain_in_db(fades, ramp_starts, ramp_ends, starting_volume, frames) / 20)
+
+    # Multiply in the linear ramp of every fade that overlaps the requested frames
+    for k in np.flatnonzero((ramp_starts < last_frame) & (ramp_ends > first_frame)):
+        start, duration, from_gain, to_gain = fades[k]
+        from_power = 10 ** (from_gain / 20)
+        in_ramp = slice(max(ramp_starts[k], first_frame) - first_frame, min(ramp_ends[k], last_frame) - first_frame)
+        if duration > 100:
+            # Coarse fade: one gain step per millisecond
+            step_boundaries = (np.arange(start, start + duration + 1) * ms_to_frame).astype(np.int64)
+            steps = np.searchsorted(step_boundaries, frames[in_ramp], side='right') - 1
+        else:
+            # Precise fade: one gain step per frame
+            steps = frames[in_ramp] - ramp_starts[k]
+            duration = (start + duration) * ms_to_frame - start * ms_to_frame
+        gain_curve[in_ramp] *= from_power + (10 ** (to_gain / 20) - from_power) / duration * steps
+
+    return gain_curve
+
+
+def get_fade_ramps(gain_automation, frame_rate, tspan_in_ms):
+    '''The fades of a gain automation that change the gain, clamped to the BGM like pydub does, and the frames their ramps span'''
+    ms_to_frame = frame_rate / 1000.0
+
+    # Where each fade starts and where the audio after it begins
+    fades = [(min(tspan_in_ms, start), duration, from_gain, to_gain)
+             for start, duration, from_gain, to_gain in gain_automation if from_gain != 0 or to_gain != 0]
+    ramp_starts = np.array([int(start * ms_to_frame) for start, _, _, _ in fades], dtype=np.int64)
+    ramp_ends = np.array([int(min(start + duration, tspan_in_ms) * ms_to_frame) for start, duration, _, _ in fades],
+                         dtype=np.int64)
+
+    return fades, ramp_starts, ramp_ends
+
+
+def get_constant_gain_in_db(fades, ramp_starts, ramp_ends, starting_volume, frames):
+    '''
+    Gain in dB of the given frames, leaving out the ramps (see get_fade_ramps):
+    outside its ramp every fade contributes a constant gain, from_gain before it starts and to_gain once it is over
+    '''
+    from_gains = np.array([from_gain for _, _, from_gain, _ in fades], dtype=np.float64)
+    to_gains = np.array([to_gain for _, _, _, to_gain in fades], dtype=np.float64)
+
+    order = np.argsort(ramp_starts, kind='stable')
+    from_gains_before = np.concatenate(([0.0], np.cumsum(from_gains[order])))
+    started_count = np.searchsorted(ramp_starts[order], frames, side='right')
+    order = np.argsort(ramp_ends, kind='stable')
+    to_gains_after = np.concatenate(([0.0], np.cumsum(to_gains[order])))
+    finished_count = np.searchsorted(ramp_ends[order], frames, side='right')
+
+    return starting_volume + (from_gains_before[-1] - from_gains_before[started_count]) + to_gains_after[finished_count]
+
+
+def loop_bgm_block(samples, first_frame, last_frame, crossfade_frames):
+    '''
+    Frames [first_frame, last_frame) of the BGM repeated without end, computed by indexing the source samples
+    Every repetition starts crossfade_frames before the previous one ends, and the two overlap with a linear crossfade,
+    so no repeated copy of the BGM is ever built, however long the output
+    '''
+    crossfade_frames = min(crossfade_frames, len(samples) // 2)
+    loop_frames = len(samples) - crossfade_frames
+    if last_frame <= loop_frames:
+        return samples[first_frame:last_frame]
+
+    # An empty BGM loops into silence
+    if not loop_frames:
+        return np.zeros((last_frame - first_frame, samples.shape[1]), dtype=samples.dtype)
+
+    frames = np.arange(first_frame, last_frame)
+    positions = frames % loop_frames
+    block = samples[positions]
+
+    # At a seam, the head of this repetition fades in while the tail of the previous one fades out
+    seam = np.flatnonzero((frames >= loop_frames) & (positions < crossfade_frames))
+    if len(seam):
+        fade_in = ((positions[seam] + 0.5) / crossfade_frames)[:, np.newaxis]
+        crossfaded = samples[positions[seam]] * fade_in + samples[positions[seam] + loop_frames] * (1 - fade_in)
+        block[seam] = np.round(crossfaded)
+
+    return block
+
+
+def apply_gain_automation(audio, starting_volume, gain_automation, frames_per_block=1 << 20, frame_count=None,
+                          loop_crossfade_in_ms=0):
+    '''
+    Apply the starting volume and all fades to the audio in a single pass over its samples
+    With frame_count, the audio is trimmed or looped (see loop_bgm_block) to exactly frame_count frames on the way
+    '''
+    samples = audio_to_array(audio)
+    tspan_in_ms = len(audio)
+    if frame_count is None:
+        frame_count = len(samples)
+    else:
+        # Same rounding as len() of an AudioSegment of frame_count frames
+        tspan_in_ms = round(1000 * (frame_count / audio.frame_rate))
+    crossfade_frames = int(loop_crossfade_in_ms * (audio.frame_rate / 1000.0))
+    mixed_samples = np.empty((frame_count, samples.shape[1]), dtype=samples.dtype)
+    sample_info = np.iinfo(samples.dtype)
+
+    # Render the gain curve block by block and apply it with one vectorized multiply per block
+    for first_frame in range(0, frame_count, frames_per_block):
+        last_frame = min(first_frame + frames_per_block, frame_count)
+        block = render_ducked_bgm_block(samples, starting_volume, gain_automation, audio.frame_rate, tspan_in_ms,
+                                        first_frame, last_frame, frame_count, crossfade_frames)
+        mixed_samples[first_frame:last_frame] = np.clip(block, sample_info.min, sample_info.max)
+
+    return audio._spawn(mixed_samples.tobytes())
+
+
+def render_ducked_bgm_block(samples, starting_volume, gain_automation, frame_rate, tspan_in_ms, first_frame, last_frame,
+                            frame_count=None, crossfade_frames=0):
+    '''
+    Frames [first_frame, last_frame) of the BGM with the starting volume and all fades applied, as floats that are not clipped
+    A frame_count beyond the end of the BGM samples loops them (see loop_bgm_block)
+    '''
+    gain_curve = render_gain_curve(gain_automation, starting_volume, frame_rate, tspan_in_ms, first_frame, last_frame)
+    if frame_count is not None and frame_count > len(samples):
+        block = loop_bgm_block(samples, first_frame, last_frame, crossfade_frames)
+    else:
+        block = samples[first_frame:last_frame]
+
+    # Round towards minus infinity, like audioop.mul
+    return np.floor(block * gain_curve[:, np.newaxis])
+
+
+def get_end_fade(frame_count, frame_rate, config=None):
+    '''
+    Locate the fade-out at the end of a mix of frame_count frames, the way fade_out_at_the_end always cut it with pydub:
+    returns its first frame, the length in milliseconds of the part it covers, and its gain automation within that part
+    '''
+    config = config or get_mix_config()
+    fade_out_duration_ms = int(config.fade_out_tspan_at_the_end * 1000)
+
+    mix_tspan_in_ms = round(1000 * (frame_count / frame_rate))
+    fade_out_first_frame = int((mix_tspan_in_ms - fade_out_duration_ms) * (frame_rate / 1000.0))
+    fade_out_tspan_in_ms = round(1000 * ((frame_count - fade_out_first_frame) / frame_rate))
+    end_fade_automation = [(fade_out_tspan_in_ms - fade_out_duration_ms, fade_out_duration_ms, 0, -120)]
+
+    return fade_out_first_frame, fade_out_tspan_in_ms, end_fade_automation
+
+
+def apply_end_fade(block, first_frame, frame_rate, end_fade):
+    '''Apply the fade-out at the end of the mix (see get_end_fade) in place to a float block starting at first_frame'''
+    fade_out_first_frame, fade_out_tspan_in_ms, end_fade_automation = end_fade
+    fade_start = max(first_frame, fade_out_first_frame)
+    last_frame = first_frame + len(block)
+    if last_frame <= fade_start:
+        return
+
+    fade_curve = render_gain_curve(end_fade_automation, 0, frame_rate, fade_out_tspan_in_ms,
+                                   fade_start - fade_out_first_frame, last_frame - fade_out_first_frame)
+    faded = block[fade_start - first_frame:]
+    faded *= fade_curve[:, np.newaxis]
+    np.floor(faded, out=faded)
+
+
+def sliding_minimum(values, window):
+    '''Minimum of every values[i:i + window], in linear time whatever the window (van Herk/Gil-Werman)'''
+    block_count = -(-len(values) // window)
+    padded = np.full(block_count * window, np.inf)
+    padded[:len(values)] = values
+    blocks = padded.reshape(block_count, window)
+
+    # Any window spans the end of one block and the start of the next one
+    minimum_to_block_end = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1)
+    minimum_from_block_start = np.minimum.accumulate(blocks, axis=1).reshape(-1)
+    window_starts = np.arange(len(values) - window + 1)
+
+    return np.minimum(minimum_to_block_end[window_starts], minimum_from_block_start[window_starts + window - 1])
+
+
+def get_limiter_reach(frame_rate, config=None):
+    '''Number of frames on either side of a frame of the mix that can change its value after limit_peaks'''
+    config = config or get_mix_config()
+    lookahead_frames = max(int(config.limiter_lookahead_in_ms * (frame_rate / 1000.0)), 1)
+
+    # The held gain of a frame looks hold_frames ahead, and the moving average over the lookahead adds lookahead_frames
+    return int(config.limiter_release_in_ms * (frame_rate / 1000.0)) + 2 * lookahead_frames + 1
+
+
+def limit_peaks(mix_blocks, dtype, frame_rate, config=None):
+    '''
+    Lookahead peak limiter: turn float blocks of the mix, of any size, into blocks of dtype samples that never exceed the ceiling
+    The gain each frame needs is held from limiter_lookahead_in_ms before it to limiter_release_in_ms after it (a sliding
+    minimum), then smoothed by a moving average over the lookahead, so it never jumps and is never above what any frame needs
+    Frames that need no limiting keep their exact value; the blocks come out limiter_lookahead_in_ms late, all at the end
+    '''
+    config = config or get_mix_config()
+    sample_info = np.iinfo(dtype)
+    ceiling = 10 ** (config.limiter_ceiling_in_dbfs / 20) * -float(sample_info.min)
+    ceiling_max, ceiling_min = min(ceiling, sample_info.max), -min(ceiling, -float(sample_info.min))
+    lookahead_frames = max(int(config.limiter_lookahead_in_ms * (frame_rate / 1000.0)), 1)
+    hold_frames = int(config.limiter_release_in_ms * (frame_rate / 1000.0)) + lookahead_frames + 1
+    history_frames = hold_frames - 2
+
+    def limit(samples, needed_gains):
+        # needed_gains runs from history_frames before the samples to lookahead_frames after them
+        if needed_gains.min() >= 1:
+            limited = samples
+        else:
+            # Gains rounded down to multiples of 2 ** -30 add up exactly, so the result does not depend on the block sizes
+            held_gains = np.floor(sliding_minimum(needed_gains, hold_frames) * 2 ** 30) / 2 ** 30
+            cumulative_gains = np.concatenate(([0.0], np.cumsum(held_gains)))
+            gains = (cumulative_gains[lookahead_frames:] - cumulative_gains[:-lookahead_frames]) / lookahead_frames
+            limited = np.floor(samples * gains[:, np.newaxis])
+        # Rounding down may still overshoot a negative ceiling by less than one step
+        return np.clip(limited, np.ceil(ceiling_min), np.floor(ceiling_max)).astype(dtype)
+
+    # Gains needed by the frames before the pending ones, the frames before the mix need none
+    past_gains = np.ones(history_frames)
+    pending_samples = pending_gains = None
+    for block in mix_blocks:
+        # Peaks of every frame, channel by channel: reducing along a short axis is much slower in NumPy
+        frame_maximum, frame_minimum = block[:, 0].copy(), block[:, 0].copy()
+        for channel in range(1, block.shape[1]):
+            np.maximum(frame_maximum, block[:, channel], out=frame_maximum)
+            np.minimum(frame_minimum, block[:, channel], out=frame_minimum)
+        overshoot = np.maximum(frame_maximum / ceiling_max, frame_minimum / ceiling_min)
+        block_gains = 1 / np.maximum(overshoot, 1)
+        if pending_samples is None:
+            pending_samples, pending_gains = block, block_gains
+        else:
+            pending_samples = np.concatenate((pending_samples, block))
+            pending_gains = np.concatenate((pending_gains, block_gains))
+
+        # Every frame whose lookahead has arrived can go
+        output_frames = len(pending_samples) - lookahead_frames
+        if output_frames <= 0:
+            continue
+        gains = np.concatenate((past_gains, pending_gains))
+        yield limit(pending_samples[:output_frames], gains[:history_frames + output_frames + lookahead_frames])
+        past_gains = gains[output_frames:output_frames + history_frames]
+        pending_samples, pending_gains = pending_samples[output_frames:], pending_gains[output_frames:]
 
-    # Step 3: Record all the silent intervals found in the voice-over audio
-    silent_interval_dict = record_silent_interval(downsampling_dict, adjusted_tspan_in_ms)
-    print(f'Debug: silent_interval_dict = {str(silent_interval_dict)}')
+    # The frames after the end of the mix need no gain reduction either
+    if pending_samples is not None and len(pending_samples):
+        yield limit(pending_samples, np.concatenate((past_gains, pending_gains, np.ones(lookahead_frames))))
+
+
+def render_mix(adjusted_stems, bgm, starting_volume, gain_automation, config=None, fade_out_at_end=False,
+               frames_per_block=1 << 18, first_frame=0, last_frame=None):
+    '''
+    Mix the adjusted voice stems and the ducked BGM with NumPy, block by block, into one preallocated output buffer:
+    per block, the BGM gain automation, the sum of all tracks, the ending fade-out when fade_out_at_end is set,
+    and the peak limiter instead of clipping; only the output holds the whole mix
+    With first_frame and last_frame, only those frames of the mix are rendered and returned, e.g. to patch a previous mix:
+    the limiter also runs over get_limiter_reach frames on both sides, so they come out exactly as in the whole mix
+    '''
+    config = config or get_mix_config()
+
+    # Every track is converted to the format of the mix, tracks already in it (like a BGM from normalize_bgm) are used as is
+    tracks = adjusted_stems + [bgm]
+    mix_format = get_mix_format(tracks, config)
+    channels = mix_format[1]
+    segments = [format_normalizer.normalize_audio(track, *get_track_format(track, mix_format), track_name=track_name)
+                for track, track_name in zip(tracks, ['speech'] * len(adjusted_stems) + ['bgm'])]
+    stem_samples = [audio_to_array(segment) for segment in segments[:-1]]
+    bgm_samples = audio_to_array(segments[-1])
+    frame_rate = segments[0].frame_rate
+    frame_count = len(stem_samples[0])
+
+    # With fit_bgm_to_speech, the BGM is looped or trimmed to cover exactly the voice-over
+    bgm_frame_count, bgm_tspan_in_ms = len(bgm_samples), len(segments[-1])
+    if config.fit_bgm_to_speech:
+        bgm_frame_count, bgm_tspan_in_ms = frame_count, len(segments[0])
+    crossfade_frames = int(config.bgm_loop_crossfade_in_ms * (frame_rate / 1000.0))
+    end_fade = get_end_fade(frame_count, frame_rate, config)
+    last_frame = frame_count if last_frame is None else min(last_frame, frame_count)
+    limiter_reach = get_limiter_reach(frame_rate, config)
+    mix_first_frame = max(first_frame - limiter_reach, 0)
+    mix_last_frame = min(last_frame + limiter_reach, frame_count)
+
+    def mix_blocks():
+        for block_first in range(mix_first_frame, mix_last_frame, frames_per_block):
+            block_last = min(block_first + frames_per_block, mix_last_frame)
+            block = np.zeros((block_last - block_first, channels))
+            for samples in stem_samples:
+                block += samples[block_first:block_last]
+
+            # The BGM may be shorter than the voice-over, in which case the rest of the voice-over plays alone
+            bgm_last_frame = min(block_last, bgm_frame_count)
+            if bgm_last_frame > block_first:
+                block[:bgm_last_frame - block_first] += render_ducked_bgm_block(
+                    bgm_samples, starting_volume, gain_automation, frame_rate, bgm_tspan_in_ms,
+                    block_first, bgm_last_frame, bgm_frame_count, crossfade_frames)
+            if fade_out_at_end:
+                apply_end_fade(block, block_first, frame_rate, end_fade)
+            yield block
+
+    output = bytearray(max(last_frame - first_frame, 0) * channels * segments[0].sample_width)
+    output_samples = np.frombuffer(output, dtype=stem_samples[0].dtype).reshape(-1, channels)
+    output_frame = mix_first_frame
+    for limited_block in limit_peaks(mix_blocks(), output_samples.dtype, frame_rate, config):
+        # The frames rendered for the limiter only are dropped
+        block_first, block_last = max(output_frame, first_frame), min(output_frame + len(limited_block), last_frame)
+        if block_last > block_first:
+            output_samples[block_first - first_frame:block_last - first_frame] = \
+                limited_block[block_first - output_frame:block_last - output_frame]
+        output_frame += len(limited_block)
+
+    return segments[0]._spawn(output, {'channels': channels, 'frame_width': channels * segments[0].sample_width})
+
+
+def mix_speech_with_bgm(adjusted_speech, bgm_path, fade_ins, fade_outs, config=None, fade_out_at_end=False):
+    '''
+    Execute voice-over avoidance and mix the audio
+    adjusted_speech may also be a list of adjusted voice stems (see create_adjust_speech_stems)
+    bgm_path may also be an AudioSegment that has already been decoded, which is then used as is
+    fade_out_at_end applies the fade-out of fade_out_at_the_end in the same pass
+    '''
+    config = config or get_mix_config()
+
+    # Load the BGM audio from the path, and convert it to the format of the mix in a stage of its own
+    if isinstance(bgm_path, AudioSegment):
+        bgm = bgm_path
+    else:
+        with instrumentation.measure_stage('decode_bgm'):
+            bgm = load_bgm_audio(bgm_path)
+        adjusted_stems = adjusted_speech if isinstance(adjusted_speech, list) else [adjusted_speech]
+        with instrumentation.measure_stage('normalize_bgm'):
+            bgm = normalize_bgm(bgm, bgm_path, get_mix_format(adjusted_stems + [bgm], config))
+
+    # Determine the initial volume of the BGM
+    starting_volume = determine_starting_volume(fade_ins, fade_outs, config)
+
+    # Collect the fade-in and fade-out effects into one gain automation
+    gain_automation = get_gain_automation(fade_ins, fade_outs, config)
+    instrumentation.record_metrics('mix_speech_with_bgm', starting_volume=starting_volume,
+                                   fades_applied=len(gain_automation), bgm_buffer_bytes=len(bgm.raw_data))
+
+    # Output the final audio
+    return overlay_ducked_bgm(adjusted_speech, bgm, starting_volume, gain_automation, config, fade_out_at_end)
+
+
+def overlay_ducked_bgm(adjusted_speech, bgm, starting_volume, gain_automation, config=None, fade_out_at_end=False):
+    '''
+    Apply a gain automation to the BGM and mix it under the voice-over (see render_mix)
+    adjusted_speech may also be a list of adjusted voice stems, which are all mixed with the BGM in one summation
+    '''
+    adjusted_stems = adjusted_speech if isinstance(adjusted_speech, list) else [adjusted_speech]
+
+    return render_mix(adjusted_stems, bgm, starting_volume, gain_automation, config, fade_out_at_end)
+
+
+def fade_out_at_the_end(speech_bgm_mix, config=None):
+    '''Add a fade-out effect at the end of the audio, on one copy of it where only the faded frames are rewritten'''
+    faded_mix = bytearray(speech_bgm_mix.raw_data)
+    samples = np.frombuffer(faded_mix, dtype={1: np.int8, 2: np.int16, 4: np.int32}[speech_bgm_mix.sample_width])
+    samples = samples.reshape(-1, speech_bgm_mix.channels)
+
+    # Fade the last frames as floats, then write them back over the copy
+    end_fade = get_end_fade(len(samples), speech_bgm_mix.frame_rate, config)
+    fade_out_first_frame = min(end_fade[0], len(samples))
+    faded_part = samples[fade_out_first_frame:].astype(np.float64)
+    apply_end_fade(faded_part, fade_out_first_frame, speech_bgm_mix.frame_rate, end_fade)
+    samples[fade_out_first_frame:] = faded_part
+
+    return speech_bgm_mix._spawn(faded_mix)
+
+
+def final_mix(bgm_path, config=None):
+    '''Integrate all steps to generate the final mixed audio file'''
+    # Read the tuning once, so that every step of this mix uses the same settings
+    config = config or get_mix_config()
+    source_path = speech_path
+
+    # Step 1: Create the adjusted voice-over audio (or all the voice stems) with silence at the beginning and the end
+    with instrumentation.measure_stage('create_adjust_speech_audio'):
+        if speech_stems:
+            adjusted_speech, adjusted_tspan_in_ms, loudness_thresholds = create_adjust_speech_stems(config)
+        else:
+            adjusted_speech, adjusted_tspan_in_ms = create_adjust_speech_audio(config, source_path)
+    # Counted from the frames, since the raw data of a memory-mapped voice-over is never materialized
+    instrumentation.record_metrics('create_adjust_speech_audio', speech_buffer_bytes=sum(
+        int(adjusted_stem.frame_count()) * adjusted_stem.frame_width
+        for adjusted_stem in (adjusted_speech if speech_stems else [adjusted_speech])))
+
+    # Steps 2 and 3: Binarize the loudness envelope and record all the silent intervals found in the voice-over audio
+    with instrumentation.measure_stage('detect_silent_intervals'):
+        if speech_stems:
+            # The BGM ducks whenever anyone is speaking, with the loudness of every stem binarized on its own
+            loudness_mask = create_stems_loudness_mask(adjusted_speech, loudness_thresholds, config)
+            silent_intervals = find_silent_intervals(loudness_mask, adjusted_tspan_in_ms, config=config)
+            instrumentation.record_metrics('detect_silent_intervals', stems=len(adjusted_speech),
+                                           windows_scanned=len(loudness_mask),
+                                           loud_windows=int(np.count_nonzero(loudness_mask)),
+                                           intervals_found=len(silent_intervals))
+        else:
+            # A cached envelope has to hold the exact value of every window
+            silent_intervals = detect_silent_intervals(adjusted_tspan_in_ms, lambda: create_loudness_envelope(
+                adjusted_speech, config, coarse_scan=not use_analysis_cache), config, source_path)
+        silent_interval_dict = create_silent_interval_dict(silent_intervals)
 
     # Step 4: Determine the fade-in and fade-out points
-    fade_ins, fade_outs = get_fade_ins_and_outs(silent_interval_dict)
-    print(f'Debug: fade_ins: {fade_ins}, fade_outs = {fade_outs}')
+    with instrumentation.measure_stage('get_fade_ins_and_outs'):
+        fade_ins, fade_outs = get_fade_ins_and_outs(silent_interval_dict, config)
+    instrumentation.record_metrics('get_fade_ins_and_outs', fade_ins=len(fade_ins), fade_outs=len(fade_outs))
 
     # Step 5: Mix the voice-over audio with the background music, applying fade-in and fade-out effects
-    speech_bgm_mix = mix_speech_with_bgm(adjusted_speech, bgm_path, fade_ins, fade_outs)
-
-    # Step 6: Add a fade-out effect at the end of the mixed audio
-    final_audio = fade_out_at_the_end(speech_bgm_mix)
+    # Step 6: Add a fade-out effect at the end of the mixed audio, in the same pass
+    with instrumentation.measure_stage('mix_speech_with_bgm'):
+        final_audio = mix_speech_with_bgm(adjusted_speech, bgm_path, fade_ins, fade_outs, config, fade_out_at_end=True)
+    instrumentation.record_metrics('mix_speech_with_bgm', mix_buffer_bytes=len(final_audio.raw_data))
 
     # Save the final mixed audio to the specified output path
-    final_audio.export(final_path, format='wav')
+    with instrumentation.measure_stage('encode'):
+        audio_encoder.export_audio(final_audio, final_path, final_bitrate)
 
 
 ##############################################################################
@@ -293,6 +1410,8 @@ def final_mix(bgm_path):
 
 
 def main():
+    if metrics_path:
+        instrumentation.set_metrics_sink(instrumentation.json_lines_sink(metrics_path))
     final_mix(bgm_path)
 
 
@@ -308,5 +1427,6 @@ However, for ordinary voice recordings, this design might be affected by ambient
 To address this issue, you can consider a simple upgrade to the program:
 1. Do not binarize the results of the downsampling. All loudness levels are expressed in float, which facilitates the definite integration of future segment loudness.
 2. A simpler treatment is to filter out overly brief noises. For example, ignore any sound that is shorter than 0.1 seconds and surrounded by silence of more than 0.8 seconds.
+(Both are now available: set loudness_detector = "hysteresis", see binarize_with_hysteresis.)
 More complex deep learning methods may provide better results, but that would defeat the purpose of designing this simple program.
 '''
@@ -0,0 +1,162 @@
+import os
+import struct
+
+import numpy as np
+from pydub import AudioSegment
+
+'''
+Memory-mapped WAV reading:
+AudioSegment.from_file reads the whole voice-over into one bytes object, and adding the opening and closing silences
+copies all of it once more, before a single window has been measured.
+A 16 or 32-bit PCM WAV needs no decoding at all, so its data chunk is memory-mapped and exposed as a NumPy view instead,
+and the silences around it are only frame offsets (see PaddedSamples): nothing is read until a stage touches the frames,
+and only the touched pages of the file are brought into memory, straight from the page cache.
+Other formats (8 and 24-bit, float) are left to pydub, which converts their samples on loading.
+
+Usage:
+import wav_reader
+samples, frame_rate = wav_reader.map_wav_samples("speech.wav")
+'''
+
+
+##############################################################################
+# Define functions
+##############################################################################
+
+def read_wav_format(path):
+    '''
+    Find the format and the data chunk of a WAV file without reading its audio
+    Returns a dict of frame_rate, channels, sample_width, data_offset and frame_count,
+    or raises ValueError for anything but a RIFF/WAVE file of 16 or 32-bit integer PCM
+    '''
+    with open(path, 'rb') as wav:
+        riff_header = wav.read(12)
+        if len(riff_header) < 12 or riff_header[:4] != b'RIFF' or riff_header[8:] != b'WAVE':
+            raise ValueError(f'{path} is not a RIFF/WAVE file')
+
+        wav_format = None
+        while True:
+            chunk_header = wav.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+            if chunk_id == b'fmt ':
+                fmt_chunk = wav.read(chunk_size)
+                if len(fmt_chunk) < 16:
+                    raise ValueError(f'{path} has a truncated fmt chunk')
+                audio_format, channels, frame_rate, _, _, bits_per_sample = struct.unpack_from('<HHIIHH', fmt_chunk)
+                # WAVE_FORMAT_EXTENSIBLE keeps the actual format in the first two bytes of its sub-format GUID
+                if audio_format == 0xFFFE and len(fmt_chunk) >= 26:
+                    audio_format = struct.unpack_from('<H', fmt_chunk, 24)[0]
+                wav_format = {"audio_format": audio_format, "frame_rate": frame_rate, "channels": channels,
+                              "sample_width": bits_per_sample // 8}
+                # Chunks are word-aligned, an odd chunk is followed by a padding byte
+                wav.seek(chunk_size % 2, os.SEEK_CUR)
+
+            elif chunk_id == b'data':
+                if wav_format is None:
+                    raise ValueError(f'{path} has no fmt chunk before its data chunk')
+                data_offset = wav.tell()
+                # Like pydub, a data chunk claiming more than the file holds ends with the file
+                data_size = min(chunk_size, os.fstat(wav.fileno()).st_size - data_offset)
+                break
+
+            else:
+                wav.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if wav_format.pop("audio_format") != 1 or wav_format["sample_width"] not in (2, 4) or not wav_format["channels"]:
+        raise ValueError(f'{path} is not 16 or 32-bit integer PCM, which is the only format that can be memory-mapped')
+
+    wav_format["data_offset"] = data_offset
+    wav_format["frame_count"] = data_size // (wav_format["sample_width"] * wav_format["channels"])
+
+    return wav_format
+
+
+def map_wav_samples(path):
+    '''
+    Memory-map the data chunk of a 16 or 32-bit PCM WAV file as a read-only (frames, channels) array
+    Returns the array and the frame rate, or raises ValueError for the formats read_wav_format does not accept
+    '''
+    wav_format = read_wav_format(path)
+    dtype = np.dtype({2: '<i2', 4: '<i4'}[wav_format["sample_width"]])
+    shape = (wav_format["frame_count"], wav_format["channels"])
+
+    # An empty data chunk cannot be memory-mapped
+    if not wav_format["frame_count"]:
+        return np.zeros(shape, dtype=dtype), wav_format["frame_rate"]
+
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=wav_format["data_offset"], shape=shape)
+
+    return samples, wav_format["frame_rate"]
+
+
+class PaddedSamples:
+    '''
+    (frames, channels) array-like of samples between a virtual opening and closing silence, which take no memory
+    Slicing frames returns a NumPy array: the samples themselves (e.g. a view of the memory-mapped file) when the slice
+    lies inside them, otherwise a new array of just the sliced frames, zero where they fall in the silences
+    '''
+
+    def __init__(self, samples, opening_frames, closing_frames):
+        self.samples = samples
+        self.opening_frames = opening_frames
+        self.closing_frames = closing_frames
+        self.dtype = samples.dtype
+        self.shape = (opening_frames + len(samples) + closing_frames, samples.shape[1])
+        self.nbytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, frames):
+        first_frame, last_frame, step = frames.indices(len(self))
+        if step != 1:
+            raise IndexError('PaddedSamples only supports contiguous slices of frames')
+        last_frame = max(last_frame, first_frame)
+
+        # Frame positions inside the samples
+        first_sample, last_sample = first_frame - self.opening_frames, last_frame - self.opening_frames
+        if 0 <= first_sample and last_sample <= len(self.samples):
+            return self.samples[first_sample:last_sample]
+
+        block = np.zeros((last_frame - first_frame, self.shape[1]), dtype=self.dtype)
+        copy_first, copy_last = max(first_sample, 0), min(last_sample, len(self.samples))
+        if copy_last > copy_first:
+            block[copy_first - first_sample:copy_last - first_sample] = self.samples[copy_first:copy_last]
+
+        return block
+
+
+class MappedAudioSegment(AudioSegment):
+    '''
+    AudioSegment backed by PaddedSamples: its format and length are known without reading any audio,
+    and the samples are only copied into bytes if a pydub operation asks for raw_data
+    voice_avoidence.audio_to_array hands out the PaddedSamples directly, so the mixing stages never make that copy
+    '''
+
+    def __init__(self, samples, frame_rate):
+        self.samples = samples
+        self.sample_width = samples.dtype.itemsize
+        self.frame_rate = frame_rate
+        self.channels = samples.shape[1]
+        self.frame_width = self.channels * self.sample_width
+        self._materialized_data = None
+
+    @property
+    def _data(self):
+        if self._materialized_data is None:
+            self._materialized_data = self.samples[0:len(self.samples)].tobytes()
+        return self._materialized_data
+
+    def frame_count(self, ms=None):
+        if ms is not None:
+            return super().frame_count(ms)
+        return float(len(self.samples))
+
+    def _spawn(self, data, overrides={}):
+        '''The results of pydub operations are ordinary AudioSegments holding their own data'''
+        template = AudioSegment(data=b'', sample_width=self.sample_width, frame_rate=self.frame_rate,
+                                channels=self.channels)
+        return template._spawn(data, overrides)